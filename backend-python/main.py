@@ -3,12 +3,13 @@
 基于 FastAPI 框架
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 import uvicorn
 import os
+import json
 from datetime import datetime
 
 from models import ChatRequest, ChatResponse, BehaviorBatchRequest
@@ -17,6 +18,12 @@ from services.ai_provider import AIProvider
 from services.redis_manager import RedisManager
 from services.user_profile_service import UserProfileService
 from services.session_manager import SessionManager
+from services.chat_turn_service import ChatTurnService
+from services.persona_cache import PersonaCache
+from services.turn_commit_queue import TurnCommitQueue
+from services.behavior_dedup import BehaviorDedup
+from services import behavior_wire
+from pydantic import ValidationError
 from services.background_tasks import BackgroundTaskManager, task_manager as bg_task_manager
 from services.behavior_analyzer import behavior_analyzer
 
@@ -44,22 +51,32 @@ app.add_middleware(
 chat_service = ChatService()
 
 # 初始化 Redis 和用户画像服务
+# 同步客户端供后台任务线程使用，请求处理路径使用异步客户端（有界连接池）
 redis_client = RedisManager.get_client()
+async_redis_client = RedisManager.get_async_client()
 
 # 🆕 初始化 LLM 分析器（用于画像深度分析）
 try:
     from services.llm_enhanced_analyzer import LLMEnhancedAnalyzer
     llm_analyzer = LLMEnhancedAnalyzer(chat_service.ai_provider)
-    profile_service = UserProfileService(redis_client, llm_analyzer)
+    profile_service = UserProfileService(redis_client, llm_analyzer, async_redis=async_redis_client)
     print("✅ 用户画像服务已启用LLM深度分析")
 except Exception as e:
     print(f"⚠️  LLM分析器加载失败，使用基础画像: {str(e)}")
-    profile_service = UserProfileService(redis_client)
+    profile_service = UserProfileService(redis_client, async_redis=async_redis_client)
 
-session_manager = SessionManager(redis_client)
+session_manager = SessionManager(redis_client, async_redis=async_redis_client)
+persona_cache = PersonaCache(async_redis_client)
+turn_commit_queue = TurnCommitQueue(async_redis_client, profile_service)
+behavior_dedup = BehaviorDedup(async_redis_client)
+chat_turn_service = ChatTurnService(async_redis_client, session_manager, profile_service, persona_cache, turn_commit_queue)
 # 初始化后台任务管理器
+# BACKGROUND_TASKS_ENABLED=false 时 Web 进程不处理后台任务，交给独立的 worker.py 进程
 from services import background_tasks
-background_tasks.task_manager = BackgroundTaskManager(session_manager, profile_service)
+if os.getenv("BACKGROUND_TASKS_ENABLED", "true").lower() == "true":
+    background_tasks.task_manager = BackgroundTaskManager(session_manager, profile_service)
+else:
+    print("ℹ️  后台任务已禁用（由独立工作进程处理）")
 
 @app.get("/")
 async def root():
@@ -84,13 +101,24 @@ async def health_check():
         "status": "ok",
         "timestamp": datetime.now().isoformat(),
         "message": "桌面宠物后端服务运行中",
-        "ai_services": provider_info
+        "ai_services": provider_info,
+        "turn_commit_queue": {
+            "pending": turn_commit_queue.pending(),
+            **turn_commit_queue.stats
+        },
+        "session_summaries": (
+            background_tasks.task_manager.summary_executor.stats()
+            if background_tasks.task_manager else None
+        )
     }
 
 # 启动后台任务
 @app.on_event("startup")
 async def startup_event():
     """应用启动时的初始化"""
+    await chat_service.open()
+    await persona_cache.start()
+    await turn_commit_queue.start()
     if background_tasks.task_manager:
         background_tasks.task_manager.start()
     print("✅ 桌面宠物后端服务已启动")
@@ -100,6 +128,10 @@ async def shutdown_event():
     """应用关闭时的清理"""
     if background_tasks.task_manager:
         background_tasks.task_manager.stop()
+    await turn_commit_queue.stop()
+    await chat_service.close()
+    await persona_cache.stop()
+    await RedisManager.close_async()
     RedisManager.close()
     print("✅ 桌面宠物后端服务已关闭")
 
@@ -112,95 +144,31 @@ async def send_message(request: ChatRequest):
         if not request.message or not request.message.strip():
             raise HTTPException(status_code=400, detail="消息不能为空")
         
-        # 获取或创建用户ID
-        user_id = profile_service.get_user_id(request.user_id or "default")
-        
-        # 初始化用户画像（如果不存在）
-        profile = profile_service.get_user_profile(user_id)
-        if not profile:
-            await profile_service.init_user(user_id)
+        user_message = request.message.strip()
         
-        # 获取或创建会话
-        session_id = session_manager.get_or_create_session(user_id)
+        # 回合上下文加载（画像、会话、历史、宠物配置一次性流水线读取）
+        turn = await chat_turn_service.load_turn_context(request.user_id or "default")
+        user_id = turn["user_id"]
+        session_id = turn["session_id"]
         
         print(f"[{datetime.now().strftime('%H:%M:%S')}] 用户 {user_id[:8]} (会话:{session_id[:8]}) 发送消息: {request.message}")
         
-        # 添加用户消息到会话上下文
-        session_manager.add_message_to_session(session_id, "user", request.message.strip())
-        
-        # 获取短期上下文（只用最近20条）
-        session_context = session_manager.get_session_context(session_id, limit=20)
-        
-        # 转换为AI需要的格式
-        conversation_history = [
-            {"role": msg["role"], "content": msg["content"]}
-            for msg in session_context[:-1]  # 排除刚添加的用户消息
-        ]
-        
-        # 🆕 获取宠物配置的 System Prompt
-        pet_system_prompt = redis_client.get("pet:config:system_prompt")
-        if pet_system_prompt:
-            pet_system_prompt = pet_system_prompt.decode('utf-8') if isinstance(pet_system_prompt, bytes) else pet_system_prompt
-        else:
-            # 默认 System Prompt
-            pet_system_prompt = "你是一个可爱的桌面宠物，名叫小猫咪。你性格活泼开朗，喜欢和用户互动聊天。回复要简短、可爱、有趣，适当使用表情符号。"
-        
-        # 获取宠物名称
-        pet_name = redis_client.get("pet:config:name")
-        if pet_name:
-            pet_name = pet_name.decode('utf-8') if isinstance(pet_name, bytes) else pet_name
-        else:
-            pet_name = "小猫咪"
-        
-        # 获取个性化上下文（基于长期画像）
-        context_prompt = profile_service.get_chat_context_prompt(user_id)
-        
-        # 构建增强的对话历史
-        enhanced_history = []
-        
-        # 1. 首先添加宠物的基础 System Prompt
-        enhanced_history.append({
-            "role": "system",
-            "content": f"{pet_system_prompt}\n\n你的名字是：{pet_name}"
-        })
-        
-        # 2. 然后添加用户画像上下文（如果有）
-        if context_prompt:
-            enhanced_history.append({
-                "role": "system",
-                "content": f"【用户画像参考】\n{context_prompt}"
-            })
-        
-        # 3. 最后添加对话历史
-        enhanced_history.extend(conversation_history)
+        # 构建增强的对话历史（宠物 System Prompt + 用户画像 + 会话上下文）
+        enhanced_history = chat_turn_service.build_enhanced_history(turn)
         
         # 调用AI服务
         reply = await chat_service.send_message(
-            request.message.strip(),
+            user_message,
             enhanced_history
         )
         
-        # 保存AI回复到会话
-        session_manager.add_message_to_session(session_id, "assistant", reply)
-        
-        # 同时保存到长期历史（用于画像分析）
-        profile_service.save_chat_message(user_id, "user", request.message.strip())
-        profile_service.save_chat_message(user_id, "assistant", reply)
+        # 回合提交（会话上下文同步写入，长期历史、行为、计数、亲密度进入提交队列）
+        result = await chat_turn_service.commit_turn(turn, user_message, reply)
         
-        # 更新用户行为
-        profile_service.record_behavior(user_id, "chat", {"message_length": len(request.message)})
-        profile_service.update_last_seen(user_id)
-        profile_service.increment_interaction(user_id)
-        
-        # 检查是否需要触发会话总结（异步处理）
-        if session_manager.should_trigger_summary(session_id):
-            session_manager.mark_session_for_summary(session_id)
+        if result["summary_queued"]:
             print(f"[{datetime.now().strftime('%H:%M:%S')}] 会话 {session_id[:8]} 已加入总结队列")
         
-        # 更新亲密度
-        intimacy_score, relationship_level = profile_service.update_intimacy_score(user_id)
-        
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] AI回复 (亲密度:{intimacy_score}, 关系:{relationship_level}): {reply}")
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] AI回复 (会话消息数:{result['message_count']}): {reply}")
         
         return ChatResponse(
             success=True,
@@ -227,14 +195,14 @@ async def send_message(request: ChatRequest):
 async def get_current_session(user_id: str = "default"):
     """获取当前会话信息"""
     try:
-        uid = profile_service.get_user_id(user_id)
-        session_id = session_manager.get_active_session(uid)
+        uid = await profile_service.get_user_id_async(user_id)
+        session_id = await session_manager.get_active_session_async(uid)
         
         if not session_id:
             return {"success": True, "session": None}
         
-        session_data = session_manager.get_session_data(session_id)
-        context = session_manager.get_session_context(session_id, limit=10)
+        session_data = await session_manager.get_session_data_async(session_id)
+        context = await session_manager.get_session_context_async(session_id, limit=10)
         
         return {
             "success": True,
@@ -253,8 +221,8 @@ async def get_current_session(user_id: str = "default"):
 async def end_session(session_id: str):
     """手动结束会话"""
     try:
-        session_manager.end_session(session_id)
-        session_manager.mark_session_for_summary(session_id)
+        await session_manager.end_session_async(session_id)
+        await session_manager.mark_session_for_summary_async(session_id)
         
         return {
             "success": True,
@@ -269,7 +237,7 @@ async def end_session(session_id: str):
 async def get_session_summary(session_id: str):
     """获取会话总结"""
     try:
-        summary = session_manager.get_session_summary(session_id)
+        summary = await session_manager.get_session_summary_async(session_id)
         
         if not summary:
             return {
@@ -287,30 +255,49 @@ async def get_session_summary(session_id: str):
 
 @app.post("/api/chat/stream")
 async def send_message_stream(request: ChatRequest):
-    """流式发送消息（可选功能）"""
+    """流式发送消息（SSE，使用会话管理，流结束后提交回合）"""
     try:
         if not request.message or not request.message.strip():
             raise HTTPException(status_code=400, detail="消息不能为空")
         
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] 开始流式响应: {request.message}")
+        user_message = request.message.strip()
+        
+        # 与非流式接口相同的回合上下文和增强历史
+        turn = await chat_turn_service.load_turn_context(request.user_id or "default")
+        enhanced_history = chat_turn_service.build_enhanced_history(turn)
+        
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] 用户 {turn['user_id'][:8]} (会话:{turn['session_id'][:8]}) 开始流式响应: {request.message}")
         
         async def generate():
+            parts = []
             try:
                 async for chunk in chat_service.send_message_stream(
-                    request.message.strip(),
-                    request.conversation_history or []
+                    user_message,
+                    enhanced_history
                 ):
-                    yield f"data: {chunk}\n\n"
+                    parts.append(chunk)
+                    yield f"data: {json.dumps({'chunk': chunk}, ensure_ascii=False)}\n\n"
+                
+                # 流结束后提交完整回复
+                reply = "".join(parts).strip()
+                if reply:
+                    result = await chat_turn_service.commit_turn(turn, user_message, reply)
+                    if result["summary_queued"]:
+                        print(f"[{datetime.now().strftime('%H:%M:%S')}] 会话 {turn['session_id'][:8]} 已加入总结队列")
+                    print(f"[{datetime.now().strftime('%H:%M:%S')}] AI流式回复 (会话消息数:{result['message_count']}): {reply}")
+                
                 yield "data: [DONE]\n\n"
             except Exception as e:
                 print(f"流式响应错误: {str(e)}")
-                yield f"data: {{'error': '发生错误'}}\n\n"
+                yield f"data: {json.dumps({'error': '发生错误'}, ensure_ascii=False)}\n\n"
         
         return StreamingResponse(
             generate(),
             media_type="text/event-stream"
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"流式聊天错误: {str(e)}")
         raise HTTPException(status_code=500, detail="发生错误")
@@ -329,8 +316,8 @@ async def record_behavior(
         if not behavior_type:
             raise HTTPException(status_code=400, detail="行为类型不能为空")
         
-        uid = profile_service.get_user_id(user_id)
-        profile_service.record_behavior(uid, behavior_type, metadata or {})
+        uid = await profile_service.get_user_id_async(user_id)
+        await profile_service.record_behavior_async(uid, behavior_type, metadata or {})
         
         return {
             "success": True,
@@ -342,38 +329,128 @@ async def record_behavior(
         raise HTTPException(status_code=500, detail="记录行为失败")
 
 
-@app.post("/api/behaviors/batch")
-async def record_behaviors_batch(request: BehaviorBatchRequest):
-    """批量记录用户行为"""
+@app.post("/api/behaviors/batch", openapi_extra={
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {"schema": BehaviorBatchRequest.model_json_schema()},
+            "application/x-ndjson": {"schema": {"type": "string", "description": "批次头 + 每行一条紧凑行为"}},
+            "application/msgpack": {"schema": {"type": "string", "format": "binary"}}
+        }
+    }
+})
+async def record_behaviors_batch(request: Request):
+    """批量记录用户行为（按 Content-Type 接受 JSON、NDJSON 或 msgpack，可 gzip 压缩）"""
+    try:
+        batch = BehaviorBatchRequest.model_validate(behavior_wire.decode_batch(
+            await request.body(),
+            request.headers.get("content-type"),
+            request.headers.get("content-encoding")
+        ))
+    except behavior_wire.UnsupportedEncodingError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False))
+    except behavior_wire.WireFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return await ingest_behavior_batch(batch)
+
+
+async def ingest_behavior_batch(request: BehaviorBatchRequest):
+    """写入一个已解码的行为批次"""
     try:
         behaviors = request.behaviors
         
         if not behaviors:
             raise HTTPException(status_code=400, detail="行为列表不能为空")
         
-        recorded_count = 0
+        # 带客户端ID时按批次和序号去重：已处理的批次直接返回原应答
+        client_id = request.client_id
+        batch_id = request.batch_id if client_id else None
+        if batch_id:
+            ack = await behavior_dedup.get_ack(client_id, batch_id)
+            if ack:
+                return {**ack, "duplicate": True}
+        
+        # 逐条校验
+        accepted = []
+        rejected_count = 0
         for behavior in behaviors:
-            try:
-                user_id = behavior.get('user_id', 'default')
-                behavior_type = behavior.get('behavior_type')
-                metadata = behavior.get('metadata', {})
-                
-                if behavior_type:
-                    uid = profile_service.get_user_id(user_id)
-                    profile_service.record_behavior(uid, behavior_type, metadata)
-                    recorded_count += 1
-            except Exception as e:
-                print(f"记录单个行为失败: {str(e)}")
+            user_id = behavior.get('user_id', 'default')
+            behavior_type = behavior.get('behavior_type')
+            metadata = behavior.get('metadata') or {}
+            seq = behavior.get('seq')
+            
+            valid_seq = seq is None or (isinstance(seq, int) and not isinstance(seq, bool) and seq >= 0)
+            valid_user = user_id is None or isinstance(user_id, str)
+            if not behavior_type or not isinstance(metadata, dict) or not valid_user or not valid_seq:
+                rejected_count += 1
                 continue
-        
-        print(f"✅ 批量记录了 {recorded_count}/{len(behaviors)} 条行为")
-        
-        return {
-            "success": True,
-            "message": f"成功记录 {recorded_count} 条行为",
-            "total": len(behaviors),
-            "recorded": recorded_count
-        }
+            accepted.append((user_id, behavior_type, metadata, seq))
+        
+        # 领取批次和序号，窗口内已接收过的行为（以及本批内重复的序号）跳过
+        claimed = set()
+        duplicate_count = 0
+        if client_id:
+            claimed = await behavior_dedup.claim(
+                client_id, [event[3] for event in accepted if event[3] is not None], batch_id
+            )
+            if claimed is None:
+                # 同一批次的另一个请求已处理完成或正在处理
+                ack = await behavior_dedup.get_ack(client_id, batch_id)
+                if ack:
+                    return {**ack, "duplicate": True}
+                raise HTTPException(status_code=409, detail="批次正在处理，请稍后重试")
+            
+            unconsumed = set(claimed)
+            new_events = []
+            for event in accepted:
+                if event[3] is None:
+                    new_events.append(event)
+                elif event[3] in unconsumed:
+                    unconsumed.remove(event[3])
+                    new_events.append(event)
+            duplicate_count = len(accepted) - len(new_events)
+            accepted = new_events
+        
+        # 按用户分组，每个用户只解析一次ID
+        events_by_raw_id = {}
+        for user_id, behavior_type, metadata, seq in accepted:
+            events_by_raw_id.setdefault(user_id, []).append((behavior_type, metadata))
+        
+        try:
+            events_by_uid = {}
+            if events_by_raw_id:
+                uids = await profile_service.get_user_ids_async(list(events_by_raw_id))
+                for raw_id, events in events_by_raw_id.items():
+                    events_by_uid.setdefault(uids[raw_id], []).extend(events)
+            
+            # 全部行为和批次应答在一个流水线中写入
+            pipe = async_redis_client.pipeline(transaction=False)
+            recorded_count = profile_service.queue_behaviors(pipe, events_by_uid)
+            result = {
+                "success": True,
+                "message": f"成功记录 {recorded_count} 条行为",
+                "total": len(behaviors),
+                "recorded": recorded_count,
+                "rejected": rejected_count,
+                "duplicates": duplicate_count
+            }
+            if batch_id:
+                behavior_dedup.save_ack(pipe, client_id, batch_id, result)
+            if len(pipe):
+                await pipe.execute()
+        except Exception:
+            # 归还领取的序号和批次，客户端重试时这些行为仍会被接收
+            if client_id:
+                await behavior_dedup.release(client_id, claimed, batch_id)
+            raise
+        
+        skipped = f"（跳过 {duplicate_count} 条重复）" if duplicate_count else ""
+        print(f"✅ 批量记录了 {recorded_count}/{len(behaviors)} 条行为{skipped}")
+        
+        return result
     except HTTPException:
         raise
     except Exception as e:
@@ -385,13 +462,12 @@ async def record_behaviors_batch(request: BehaviorBatchRequest):
 async def get_behavior_analysis(user_id: str = "default"):
     """获取用户行为分析"""
     try:
-        uid = profile_service.get_user_id(user_id)
+        uid = await profile_service.get_user_id_async(user_id)
         
-        # 获取用户行为数据
-        behavior_key = f"user:{uid}:behaviors"
-        behaviors_raw = redis_client.lrange(behavior_key, 0, -1)
+        # 读取写入时维护的行为汇总（覆盖全部历史，不再解析整个行为列表）
+        rollup = await profile_service.get_behavior_rollup_async(uid)
         
-        if not behaviors_raw:
+        if not rollup.total:
             return {
                 "success": True,
                 "user_id": user_id,
@@ -401,18 +477,8 @@ async def get_behavior_analysis(user_id: str = "default"):
                 }
             }
         
-        # 解析行为数据
-        import json
-        behaviors = []
-        for b in behaviors_raw:
-            try:
-                behavior = json.loads(b)
-                behaviors.append(behavior)
-            except:
-                continue
-        
         # 使用行为分析器生成分析报告
-        analysis = behavior_analyzer.generate_behavior_summary(behaviors)
+        analysis = behavior_analyzer.generate_behavior_summary(rollup)
         
         return {
             "success": True,
@@ -428,13 +494,12 @@ async def get_behavior_analysis(user_id: str = "default"):
 async def get_behavior_stats(user_id: str = "default"):
     """获取用户行为统计（简化版）"""
     try:
-        uid = profile_service.get_user_id(user_id)
+        uid = await profile_service.get_user_id_async(user_id)
         
-        # 获取用户行为数据
-        behavior_key = f"user:{uid}:behaviors"
-        behaviors_raw = redis_client.lrange(behavior_key, 0, -1)
+        # 读取行为汇总
+        rollup = await profile_service.get_behavior_rollup_async(uid)
         
-        if not behaviors_raw:
+        if not rollup.total:
             return {
                 "success": True,
                 "user_id": user_id,
@@ -445,25 +510,17 @@ async def get_behavior_stats(user_id: str = "default"):
             }
         
         # 统计行为类型
-        import json
         from collections import Counter
-        behavior_types = []
-        for b in behaviors_raw:
-            try:
-                behavior = json.loads(b)
-                behavior_types.append(behavior.get('type', 'unknown'))
-            except:
-                continue
-        
-        type_counter = Counter(behavior_types)
+        type_counter = Counter(rollup.type_counts_by_name)
         
         return {
             "success": True,
             "user_id": user_id,
             "stats": {
-                "total_behaviors": len(behavior_types),
+                "total_behaviors": rollup.total,
                 "behavior_types": dict(type_counter),
-                "most_common": type_counter.most_common(5)
+                "most_common": type_counter.most_common(5),
+                "state_transitions": rollup.transitions
             }
         }
     except Exception as e:
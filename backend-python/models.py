@@ -41,5 +41,7 @@ class BehaviorData(BaseModel):
 
 class BehaviorBatchRequest(BaseModel):
     """批量行为记录请求"""
-    behaviors: List[Dict[str, Any]] = Field(..., description="行为列表")
+    behaviors: List[Dict[str, Any]] = Field(..., description="行为列表（每条可带客户端序号 seq 用于去重）")
+    client_id: Optional[str] = Field(None, max_length=128, description="客户端ID（序号在同一客户端内唯一）")
+    batch_id: Optional[str] = Field(None, max_length=128, description="批次ID（重发同一批次时不变）")
 
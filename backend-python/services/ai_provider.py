@@ -4,7 +4,8 @@ AI 服务提供商适配器
 """
 
 import os
-from typing import List, Dict, Optional, AsyncGenerator
+import time
+from typing import List, Dict, Optional, Set, AsyncGenerator
 from openai import AsyncOpenAI
 import json
 import requests
@@ -12,6 +13,9 @@ import asyncio
 import aiohttp
 from dotenv import load_dotenv
 
+from services.provider_health import ProviderHealth
+from services.prompt_builder import PromptBuilder
+
 load_dotenv()
 
 # 系统提示词 - 定义宠物的性格
@@ -40,6 +44,42 @@ class AIProvider:
         self.providers = []
         self.max_tokens = 150
         self.temperature = 0.8
+        
+        # 按提供商的 token 预算裁剪提示词
+        self.prompt_builder = PromptBuilder()
+        
+        # 直接 API 调用使用的连接池配置（进程内复用，保持长连接）
+        self.http_pool_limit = int(os.getenv("AI_HTTP_POOL_LIMIT", 100))
+        self.http_limit_per_host = int(os.getenv("AI_HTTP_LIMIT_PER_HOST", 20))
+        self.http_keepalive = float(os.getenv("AI_HTTP_KEEPALIVE", 60))
+        self.http_timeout = aiohttp.ClientTimeout(
+            total=float(os.getenv("AI_HTTP_TIMEOUT", 30)),
+            connect=float(os.getenv("AI_HTTP_CONNECT_TIMEOUT", 5))
+        )
+        # 流式请求的持续时间取决于回复长度，不设总超时，只限制两次读取之间的间隔
+        self.http_stream_timeout = aiohttp.ClientTimeout(
+            total=None,
+            connect=self.http_timeout.connect,
+            sock_read=float(os.getenv("AI_STREAM_READ_TIMEOUT", 30))
+        )
+        # aiohttp 会话绑定事件循环，每个事件循环（Web / 后台线程）各持有一个
+        self._http_sessions: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+        
+        # 对冲请求配置（可选，降低单个服务偶发卡顿造成的长尾延迟）
+        self.hedge_enabled = os.getenv("AI_HEDGE_ENABLED", "false").lower() == "true"
+        self.hedge_default_delay = float(os.getenv("AI_HEDGE_DEFAULT_DELAY", 2))
+        self.hedge_min_delay = float(os.getenv("AI_HEDGE_MIN_DELAY", 0.5))
+        self.hedge_max_delay = float(os.getenv("AI_HEDGE_MAX_DELAY", 5))
+        self.hedge_stats = {
+            "requests": 0,      # 走对冲流程的请求数
+            "hedged": 0,        # 实际发出对冲请求的次数
+            "hedge_wins": 0,    # 对冲请求先返回的次数
+            "extra_tokens": 0   # 落败请求消耗的 token（被取消的按提示词估算）
+        }
+        
+        # 每个提供商的并发上限（可选，由后台批量任务设置；信号量绑定调用方的事件循环）
+        self.concurrency_limits: Dict[str, asyncio.Semaphore] = {}
+        
         self.initialize_providers()
     
     def initialize_providers(self):
@@ -80,6 +120,11 @@ class AIProvider:
         # 按优先级排序
         self.providers.sort(key=lambda p: p["priority"])
         
+        # 每个提供商一个熔断器和提示词预算
+        for provider in self.providers:
+            provider["health"] = ProviderHealth(provider["name"])
+            provider["prompt_token_budget"] = self.prompt_builder.budget_for(provider["name"])
+        
         if not self.providers:
             print("⚠️ 警告：没有配置任何 AI 服务！")
         else:
@@ -91,6 +136,40 @@ class AIProvider:
         if not self.providers:
             raise Exception("未配置任何 AI 服务，请检查环境变量")
         
+        messages = self._build_messages(message, conversation_history)
+        
+        candidates = self._ordered_providers()
+        last_error = None
+        
+        # 对冲模式：主服务超过 p95 延迟仍未返回时，同时请求下一个服务
+        if self.hedge_enabled and len(candidates) >= 2:
+            try:
+                return await self._send_hedged(candidates[0], candidates[1], messages)
+            except Exception as e:
+                last_error = e
+                candidates = candidates[2:]
+        
+        # 按健康状态和优先级尝试每个提供商（跳过熔断中的服务）
+        for provider in candidates:
+            # 排序后可能有并发请求占用了半开探测名额，调用前再次确认
+            if not provider["health"].is_available():
+                continue
+            
+            try:
+                reply, _ = await self._attempt(provider, messages)
+                return reply
+            except Exception as e:
+                last_error = e
+                # 继续尝试下一个
+                print(f"⏭️ 切换到下一个 AI 服务...")
+        
+        if last_error is not None:
+            raise self.normalize_error(last_error)
+        
+        raise Exception("所有 AI 服务都不可用")
+    
+    def _build_messages(self, message: str, conversation_history: List[Dict]) -> List[Dict]:
+        """组装发送给模型的消息列表"""
         # 检查 conversation_history 是否已包含 system prompt
         has_system_prompt = any(msg.get("role") == "system" for msg in conversation_history)
         
@@ -100,46 +179,171 @@ class AIProvider:
         if not has_system_prompt:
             messages.append({"role": "system", "content": SYSTEM_PROMPT})
         
-        # 添加对话历史和当前消息
+        # 添加对话历史和当前消息（按提供商预算裁剪见 _fit_prompt）
         messages.extend(conversation_history)
         messages.append({"role": "user", "content": message})
+        return messages
+    
+    def _fit_prompt(self, provider: Dict, messages: List[Dict]) -> List[Dict]:
+        """按提供商的 token 预算裁剪消息列表"""
+        budget = provider.get("prompt_token_budget") or self.prompt_builder.budget_for(provider["name"])
+        return self.prompt_builder.fit(messages, budget)
+    
+    def set_concurrency_limit(self, provider_name: str, limit: int):
+        """限制单个提供商的并发请求数（只能在同一个事件循环中使用）"""
+        self.concurrency_limits[provider_name] = asyncio.Semaphore(limit)
+    
+    async def _attempt(self, provider: Dict, messages: List[Dict], started: Optional[Set[str]] = None):
+        """调用单个提供商（有并发上限时先排队）；返回 (回复, token 用量)
         
-        # 限制历史消息数量（保留前面的 system prompts + 最近10条消息）
-        system_messages = [msg for msg in messages if msg.get("role") == "system"]
-        other_messages = [msg for msg in messages if msg.get("role") != "system"]
-        limited_messages = system_messages + other_messages[-11:]
+        started: 排队结束、请求真正发出时加入提供商名称（对冲时用于统计落败请求的开销）
+        """
+        limiter = self.concurrency_limits.get(provider["name"])
+        if limiter is None:
+            return await self._attempt_call(provider, messages, started)
+        async with limiter:
+            return await self._attempt_call(provider, messages, started)
+    
+    async def _attempt_call(self, provider: Dict, messages: List[Dict], started: Optional[Set[str]] = None):
+        """调用单个提供商，并记录熔断器和延迟统计；返回 (回复, token 用量)"""
+        health = provider["health"]
+        health.acquire()
+        if started is not None:
+            started.add(provider["name"])
+        started_at = time.monotonic()
+        try:
+            print(f"尝试使用 {provider['name']} ({provider['model']})...")
+            messages = self._fit_prompt(provider, messages)
+            
+            # 根据类型选择调用方式
+            if provider.get('type') == 'direct_api':
+                # 硅基流动 - 直接 API 调用
+                reply, usage = await self._call_direct_api(provider, messages)
+            else:
+                # OpenAI SDK 调用
+                reply, usage = await self._call_openai_sdk(provider, messages)
+        except asyncio.CancelledError:
+            health.record_cancelled()
+            raise
+        except Exception as e:
+            health.record_failure(time.monotonic() - started_at)
+            print(f"❌ {provider['name']} 调用失败: {str(e)}")
+            print(f"   错误类型: {type(e).__name__}")
+            raise
         
-        # 按优先级尝试每个提供商
-        for provider in self.providers:
-            try:
-                print(f"尝试使用 {provider['name']} ({provider['model']})...")
-                
-                # 根据类型选择调用方式
-                if provider.get('type') == 'direct_api':
-                    # 硅基流动 - 直接 API 调用
-                    reply = await self._call_direct_api(provider, limited_messages)
-                else:
-                    # OpenAI SDK 调用
-                    reply = await self._call_openai_sdk(provider, limited_messages)
-                
-                print(f"✅ {provider['name']} 调用成功")
-                return reply
-                
-            except Exception as e:
-                print(f"❌ {provider['name']} 调用失败: {str(e)}")
-                print(f"   错误类型: {type(e).__name__}")
-                
-                # 如果是最后一个提供商，抛出错误
-                if provider == self.providers[-1]:
-                    raise self.normalize_error(e)
-                
-                # 否则继续尝试下一个
-                print(f"⏭️ 切换到下一个 AI 服务...")
+        health.record_success(time.monotonic() - started_at)
+        print(f"✅ {provider['name']} 调用成功")
+        return reply, usage
+    
+    def _hedge_delay(self, provider: Dict) -> float:
+        """对冲等待时间：主服务近期 p95 延迟，限制在配置的上下限之间"""
+        p95 = provider["health"].latency_percentile(0.95)
+        if p95 is None:
+            return self.hedge_default_delay
+        return min(max(p95, self.hedge_min_delay), self.hedge_max_delay)
+    
+    async def _send_hedged(self, primary: Dict, backup: Dict, messages: List[Dict]) -> str:
+        """对冲请求：先请求主服务，超时未返回再请求备用服务，先成功者胜出"""
+        self.hedge_stats["requests"] += 1
+        started = set()
+        tasks = {asyncio.create_task(self._attempt(primary, messages, started)): primary}
         
-        raise Exception("所有 AI 服务都不可用")
+        def start_backup():
+            tasks[asyncio.create_task(self._attempt(backup, messages, started))] = backup
+        
+        hedged = False
+        done, _ = await asyncio.wait(set(tasks), timeout=self._hedge_delay(primary))
+        if not done and backup["health"].is_available():
+            print(f"⏱️ {primary['name']} 响应较慢，对冲请求 {backup['name']}")
+            self.hedge_stats["hedged"] += 1
+            hedged = True
+            start_backup()
+        
+        last_error = None
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(set(tasks), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    provider = tasks.pop(task)
+                    try:
+                        reply, usage = task.result()
+                    except Exception as e:
+                        last_error = e
+                        # 主服务在对冲前就失败了，直接故障转移到备用服务
+                        if provider is primary and not hedged and backup["health"].is_available():
+                            print(f"⏭️ 切换到下一个 AI 服务...")
+                            start_backup()
+                        continue
+                    
+                    if hedged and provider is backup:
+                        self.hedge_stats["hedge_wins"] += 1
+                    self.hedge_stats["extra_tokens"] += await self._settle_losers(tasks, started, usage)
+                    return reply
+        finally:
+            for task in tasks:
+                task.cancel()
+        
+        raise last_error
+    
+    async def _settle_losers(self, tasks: Dict[asyncio.Task, Dict], started: Set[str], winner_usage: Dict) -> int:
+        """取消仍在进行的落败请求，返回落败请求消耗的 token 数
+        
+        与胜者同时完成的按其实际用量计算；被取消的请求已发出提示词的，按胜者的提示词 token 数估算；
+        已经失败、或还在排队未发出的不计入。
+        """
+        losers = list(tasks)
+        for task in losers:
+            task.cancel()
+        results = await asyncio.gather(*losers, return_exceptions=True)
+        
+        extra_tokens = 0
+        for task, result in zip(losers, results):
+            provider = tasks.pop(task)
+            if isinstance(result, asyncio.CancelledError):
+                if provider["name"] in started:
+                    extra_tokens += winner_usage.get("prompt_tokens", 0)
+            elif not isinstance(result, BaseException):
+                _, usage = result
+                extra_tokens += usage.get("total_tokens", usage.get("prompt_tokens", 0))
+        return extra_tokens
+    
+    def _ordered_providers(self) -> List[Dict]:
+        """返回可用的提供商：未熔断的优先，EWMA 延迟过高的靠后，其余按配置优先级"""
+        available = [p for p in self.providers if p["health"].is_available()]
+        return sorted(available, key=lambda p: (p["health"].is_slow(), p["priority"]))
+    
+    def _get_http_session(self) -> aiohttp.ClientSession:
+        """获取当前事件循环的共享 HTTP 会话（不存在时创建）"""
+        loop = asyncio.get_running_loop()
+        session = self._http_sessions.get(loop)
+        
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.http_pool_limit,
+                limit_per_host=self.http_limit_per_host,
+                keepalive_timeout=self.http_keepalive,
+                ttl_dns_cache=300
+            )
+            session = aiohttp.ClientSession(connector=connector, timeout=self.http_timeout)
+            self._http_sessions[loop] = session
+        
+        return session
+    
+    async def open(self):
+        """预先创建 HTTP 连接池（应用启动时调用）"""
+        if any(p.get("type") == "direct_api" for p in self.providers):
+            self._get_http_session()
+            print(f"✅ AI HTTP 连接池已创建 (每主机最大连接数: {self.http_limit_per_host})")
     
-    async def _call_direct_api(self, provider: Dict, messages: List[Dict]) -> str:
-        """直接调用 API（用于硅基流动）"""
+    async def close(self):
+        """关闭当前事件循环的 HTTP 连接池（应用关闭时调用）"""
+        session = self._http_sessions.pop(asyncio.get_running_loop(), None)
+        if session and not session.closed:
+            await session.close()
+            print("✅ AI HTTP 连接池已关闭")
+    
+    async def _call_direct_api(self, provider: Dict, messages: List[Dict]):
+        """直接调用 API（用于硅基流动），返回 (回复, token 用量)"""
         url = f"{provider['base_url']}/chat/completions"
         
         headers = {
@@ -156,28 +360,29 @@ class AIProvider:
             "enable_thinking": False
         }
         
-        # 使用 aiohttp 进行异步请求
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload, headers=headers, timeout=30) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    raise Exception(f"API 返回错误 {response.status}: {error_text}")
+        # 使用共享连接池进行异步请求（复用已建立的 TCP/TLS 连接）
+        session = self._get_http_session()
+        async with session.post(url, json=payload, headers=headers) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                raise Exception(f"API 返回错误 {response.status}: {error_text}")
+            
+            data = await response.json()
+            
+            if 'choices' in data and len(data['choices']) > 0:
+                reply = data['choices'][0]['message']['content'].strip()
                 
-                data = await response.json()
+                # 打印 token 使用情况
+                usage = data.get('usage') or {}
+                if usage:
+                    print(f"   Token 使用: {usage}")
                 
-                if 'choices' in data and len(data['choices']) > 0:
-                    reply = data['choices'][0]['message']['content'].strip()
-                    
-                    # 打印 token 使用情况
-                    if 'usage' in data:
-                        print(f"   Token 使用: {data['usage']}")
-                    
-                    return reply
-                else:
-                    raise Exception("API 返回格式错误")
+                return reply, usage
+            else:
+                raise Exception("API 返回格式错误")
     
-    async def _call_openai_sdk(self, provider: Dict, messages: List[Dict]) -> str:
-        """使用 OpenAI SDK 调用（用于 OpenAI）"""
+    async def _call_openai_sdk(self, provider: Dict, messages: List[Dict]):
+        """使用 OpenAI SDK 调用（用于 OpenAI），返回 (回复, token 用量)"""
         completion = await provider["client"].chat.completions.create(
             model=provider["model"],
             messages=messages,
@@ -188,10 +393,16 @@ class AIProvider:
 
         reply = completion.choices[0].message.content.strip()
         
-        if hasattr(completion, 'usage'):
+        usage = {}
+        if getattr(completion, 'usage', None):
             print(f"   Token 使用: {completion.usage}")
+            usage = {
+                "prompt_tokens": completion.usage.prompt_tokens,
+                "completion_tokens": completion.usage.completion_tokens,
+                "total_tokens": completion.usage.total_tokens
+            }
         
-        return reply
+        return reply, usage
     
     
     async def send_message_stream(
@@ -199,42 +410,112 @@ class AIProvider:
         message: str, 
         conversation_history: List[Dict]
     ) -> AsyncGenerator[str, None]:
-        """流式发送消息"""
+        """流式发送消息，逐段产出回复文本（支持直接 API 和 OpenAI SDK 两种服务）
+        
+        在产出第一段内容之前失败会自动切换到下一个服务；之后失败则直接抛出。
+        """
         if not self.providers:
             raise Exception("未配置任何 AI 服务")
         
-        messages = [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            *conversation_history,
-            {"role": "user", "content": message}
-        ]
-        
-        limited_messages = [messages[0]] + messages[-11:]
-        
-        # 只使用第一个可用的提供商进行流式传输
-        provider = self.providers[0]
+        messages = self._build_messages(message, conversation_history)
         
-        try:
-            print(f"使用 {provider['name']} Stream API ({provider['model']})...")
-            
-            stream = await provider["client"].chat.completions.create(
-                model=provider["model"],
-                messages=limited_messages,
-                max_tokens=self.max_tokens,
-                temperature=self.temperature,
-                stream=True
-            )
+        last_error = None
+        for provider in self._ordered_providers():
+            health = provider["health"]
+            if not health.is_available():
+                continue
             
-            async for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    yield json.dumps({"chunk": content})
+            health.acquire()
+            started_at = time.monotonic()
+            streamed = False
+            try:
+                print(f"使用 {provider['name']} Stream API ({provider['model']})...")
+                
+                fitted = self._fit_prompt(provider, messages)
+                if provider.get('type') == 'direct_api':
+                    stream = self._stream_direct_api(provider, fitted)
+                else:
+                    stream = self._stream_openai_sdk(provider, fitted)
+                
+                async for content in stream:
+                    streamed = True
+                    yield content
+                
+            except (asyncio.CancelledError, GeneratorExit):
+                # 客户端断开，不计入服务失败
+                health.record_cancelled()
+                raise
+            except Exception as e:
+                health.record_failure(time.monotonic() - started_at)
+                print(f"❌ {provider['name']} Stream 调用失败: {str(e)}")
+                if streamed:
+                    raise self.normalize_error(e)
+                last_error = e
+                print(f"⏭️ 切换到下一个 AI 服务...")
+                continue
             
+            health.record_success(time.monotonic() - started_at)
             print(f"✅ {provider['name']} Stream 调用完成")
+            return
+        
+        if last_error is not None:
+            raise self.normalize_error(last_error)
+        
+        raise Exception("所有 AI 服务都不可用")
+    
+    async def _stream_direct_api(self, provider: Dict, messages: List[Dict]) -> AsyncGenerator[str, None]:
+        """直接 API 流式调用（SSE），逐段产出回复文本"""
+        url = f"{provider['base_url']}/chat/completions"
+        
+        headers = {
+            "Authorization": f"Bearer {provider['api_key']}",
+            "Content-Type": "application/json"
+        }
+        
+        payload = {
+            "model": provider['model'],
+            "messages": messages,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "stream": True,
+            "enable_thinking": False
+        }
+        
+        session = self._get_http_session()
+        async with session.post(url, json=payload, headers=headers, timeout=self.http_stream_timeout) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                raise Exception(f"API 返回错误 {response.status}: {error_text}")
             
-        except Exception as e:
-            print(f"❌ {provider['name']} Stream 调用失败: {str(e)}")
-            raise self.normalize_error(e)
+            async for line in response.content:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                
+                chunk = json.loads(data)
+                choices = chunk.get('choices') or []
+                content = choices[0].get('delta', {}).get('content') if choices else None
+                if content:
+                    yield content
+    
+    async def _stream_openai_sdk(self, provider: Dict, messages: List[Dict]) -> AsyncGenerator[str, None]:
+        """OpenAI SDK 流式调用，逐段产出回复文本"""
+        stream = await provider["client"].chat.completions.create(
+            model=provider["model"],
+            messages=messages,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            stop=["\n\n", "。。", "！！"],
+            stream=True
+        )
+        
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
     
     def normalize_error(self, error: Exception) -> Exception:
         """标准化错误信息"""
@@ -254,16 +535,30 @@ class AIProvider:
         if not self.providers:
             return {"available": False}
         
+        ordered = self._ordered_providers()
+        primary = ordered[0] if ordered else self.providers[0]
+        
+        hedging = dict(self.hedge_stats, enabled=self.hedge_enabled)
+        hedging["hedge_rate"] = round(
+            self.hedge_stats["hedged"] / self.hedge_stats["requests"], 3
+        ) if self.hedge_stats["requests"] else 0.0
+        
         return {
-            "available": True,
+            "available": bool(ordered),
             "providers": [
-                {"name": p["name"], "model": p["model"]}
+                {
+                    "name": p["name"],
+                    "model": p["model"],
+                    "prompt_token_budget": p.get("prompt_token_budget"),
+                    "health": p["health"].to_dict()
+                }
                 for p in self.providers
             ],
             "primary": {
-                "name": self.providers[0]["name"],
-                "model": self.providers[0]["model"]
-            }
+                "name": primary["name"],
+                "model": primary["model"]
+            },
+            "hedging": hedging
         }
 
 
@@ -1,13 +1,25 @@
 """
 后台异步任务处理
 处理会话总结和用户画像更新
+
+事件驱动：阻塞等待唤醒信号（BLPOP），有工作时立即处理，空闲时不轮询；
+唤醒后等待一个批处理窗口，合并突发的多个信号
 """
 
 import asyncio
+import math
+import os
 import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from typing import Optional, Dict
+from typing import Optional, Dict, Set
+from services import task_signals
+from services import profile_inference
+from services.redis_manager import RedisManager
 from services.session_manager import SessionManager
+from services.summary_executor import SummaryExecutor
+from services.task_lease import TaskLease, LeaseHeldError
 from services.user_profile_service import UserProfileService
 from services.llm_profile_analyzer import llm_analyzer
 
@@ -24,6 +36,27 @@ class BackgroundTaskManager:
         self.profile_service = profile_service
         self.running = False
         self.thread: Optional[threading.Thread] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.worker_task: Optional[asyncio.Task] = None
+        
+        # 唤醒后合并信号的等待时间；没有信号时最长等待时间（兜底检查，如被跳过的画像更新）
+        self.batch_window = float(os.getenv("BACKGROUND_BATCH_WINDOW", 1))
+        self.idle_timeout = float(os.getenv("BACKGROUND_IDLE_TIMEOUT", 180))
+        self.profile_batch_size = int(os.getenv("PROFILE_UPDATE_BATCH_SIZE", 10))
+        
+        # 画像规则推测的进程池（0 表示在后台线程中执行）
+        self.inference_workers = int(os.getenv("PROFILE_INFERENCE_WORKERS", 0))
+        self.inference_pool: Optional[ProcessPoolExecutor] = None
+        
+        # 多个工作进程共享任务时，每个会话总结 / 用户画像刷新同一时间只有一个持有者
+        self.lease = TaskLease(session_manager.redis)
+        
+        # 会话总结并发执行（全局和每个 AI 提供商各有并发上限）
+        self.summary_executor = SummaryExecutor(
+            session_manager.summary_queue,
+            self._summarize_session,
+            llm_analyzer.ai_provider
+        )
         
     def start(self):
         """启动后台任务"""
@@ -32,95 +65,193 @@ class BackgroundTaskManager:
             return
         
         self.running = True
+        self._start_inference_pool()
         self.thread = threading.Thread(target=self._run_async_loop, daemon=True)
         self.thread.start()
         print("✅ 后台任务已启动")
     
-    def stop(self):
-        """停止后台任务"""
+    def run(self):
+        """在当前线程运行后台任务直到停止（独立工作进程使用）"""
+        self.running = True
+        self._start_inference_pool()
+        print("✅ 后台任务已启动")
+        try:
+            self._run_async_loop()
+        finally:
+            self._stop_inference_pool()
+    
+    def request_stop(self):
+        """通知后台任务停止（可在信号处理函数或其他线程中调用）"""
         self.running = False
+        if self.loop and self.worker_task:
+            self.loop.call_soon_threadsafe(self.worker_task.cancel)
+    
+    def stop(self):
+        """停止后台任务（打断阻塞等待；未确认的总结任务超时后会被重新领取）"""
+        self.request_stop()
         if self.thread:
             self.thread.join(timeout=5)
+        self._stop_inference_pool()
         print("✅ 后台任务已停止")
     
+    def _start_inference_pool(self):
+        """在启动后台线程之前创建工作进程并加载词库"""
+        if self.inference_workers <= 0 or self.inference_pool is not None:
+            return
+        try:
+            pool = ProcessPoolExecutor(max_workers=self.inference_workers)
+            list(pool.map(profile_inference.warm_up, range(self.inference_workers)))
+            self.inference_pool = pool
+            print(f"✅ 画像推测进程池已启动: {self.inference_workers} 个进程")
+        except Exception as e:
+            print(f"⚠️  画像推测进程池启动失败，在后台线程中执行: {str(e)}")
+    
+    def _stop_inference_pool(self):
+        if self.inference_pool is not None:
+            self.inference_pool.shutdown(wait=True, cancel_futures=True)
+            self.inference_pool = None
+    
     def _run_async_loop(self):
         """运行异步事件循环"""
+        try:
+            self.session_manager.summary_queue.migrate_legacy_queue()
+        except Exception as e:
+            print(f"迁移旧版总结队列失败: {str(e)}")
+        
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
+        self.loop = loop
         
         try:
-            loop.run_until_complete(self._worker())
+            self.worker_task = loop.create_task(self._worker())
+            loop.run_until_complete(self.worker_task)
+        except asyncio.CancelledError:
+            pass
         except Exception as e:
             print(f"后台任务错误: {str(e)}")
         finally:
+            # 释放本线程事件循环上的 AI HTTP 连接池
+            loop.run_until_complete(llm_analyzer.ai_provider.close())
             loop.close()
+            self.loop = None
+            self.worker_task = None
     
     async def _worker(self):
-        """后台工作任务"""
-        cycle_count = 0
-        while self.running:
-            try:
-                # 每30秒执行一次
-                await asyncio.sleep(30)
-                cycle_count += 1
-                
-                # 处理会话总结
-                await self._process_session_summaries()
-                
-                # 每30s 更新一次用户画像
-                if cycle_count % 1 == 0:
-                    await self._process_profile_updates()
-                
-            except Exception as e:
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] 后台任务错误: {str(e)}")
+        """后台工作任务：等待唤醒信号后处理总结和画像更新"""
+        signals = RedisManager.create_blocking_async_client()
+        try:
+            # 启动时先处理积压的工作
+            await self._process_session_summaries()
+            await self._process_profile_updates()
+            
+            while self.running:
+                try:
+                    kinds = await self._wait_for_signals(signals)
+                    
+                    # 总结队列中可能有到期的重试或超时任务，每次唤醒都检查
+                    await self._process_session_summaries()
+                    
+                    if task_signals.PROFILE in kinds or not kinds:
+                        await self._process_profile_updates()
+                    
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"[{datetime.now().strftime('%H:%M:%S')}] 后台任务错误: {str(e)}")
+                    await asyncio.sleep(1)
+        finally:
+            await self.summary_executor.cancel()
+            await signals.aclose()
+    
+    async def _wait_for_signals(self, signals) -> Set[str]:
+        """阻塞等待唤醒信号，返回本批收到的信号类型（超时返回空集合）"""
+        # 最多等到总结队列中下一个任务到期（延迟重试、可见性超时）
+        timeout = self.idle_timeout
+        next_due = self.session_manager.summary_queue.next_due_in()
+        if next_due is not None:
+            timeout = min(timeout, next_due)
+        if timeout <= 0:
+            return {task_signals.SUMMARY}
+        
+        # 以及下一个被推迟的画像刷新到期
+        next_profile_due = self.profile_service.next_dirty_due_in()
+        if next_profile_due is not None:
+            timeout = min(timeout, next_profile_due)
+        if timeout <= 0:
+            return {task_signals.PROFILE}
+        
+        # BLPOP 超时为整数秒（0 表示永久阻塞）
+        result = await signals.blpop(task_signals.SIGNAL_KEY, timeout=max(math.ceil(timeout), 1))
+        if result is None:
+            return set()
+        
+        # 批处理窗口：合并突发信号，一次处理；只取走有限个，多个工作进程时其余信号唤醒其他进程
+        await asyncio.sleep(self.batch_window)
+        pending = await signals.lpop(task_signals.SIGNAL_KEY, task_signals.SIGNAL_POP_MAX - 1) or []
+        
+        return {
+            kind.decode() if isinstance(kind, bytes) else kind
+            for kind in [result[1], *pending]
+        }
     
     async def _process_session_summaries(self):
-        """处理待总结的会话（使用增量分析）"""
-        sessions = self.session_manager.get_sessions_to_summarize()
+        """并发处理待总结的会话，直到没有到期任务"""
+        await self.summary_executor.drain(lambda: self.running)
+    
+    async def _summarize_session(self, task: Dict):
+        """总结单个会话（持有租约期间）；抛出异常表示失败，由执行器交给队列重试"""
+        session_id = task.get('session_id')
+        resource = f"summary:{session_id}"
         
-        for task in sessions:
-            session_id = task.get('session_id')
-            
-            try:
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔄 开始总结会话: {session_id[:8]}...")
-                
-                # ✅ 改进：只获取新消息（增量）
-                new_context = self.session_manager.get_new_session_context(session_id)
-                
-                if len(new_context) < 3:  # 太少的对话不总结
-                    print(f"  ⏭️  新消息太少（{len(new_context)}条），跳过总结")
-                    self.session_manager.remove_from_summary_queue(session_id)
-                    continue
-                
-                # 获取上次总结的简要内容（用于提供上下文）
-                previous_summary_context = self.session_manager.get_last_summary_context(session_id)
-                
-                if previous_summary_context:
-                    print(f"  📚 使用历史上下文辅助分析")
-                
-                # ✅ 使用LLM总结（带历史上下文）
-                summary = await llm_analyzer.summarize_session(
-                    new_context, 
-                    previous_summary_context
-                )
-                
-                # 保存总结
-                self.session_manager.save_session_summary(session_id, summary)
-                
-                # 获取用户ID并更新画像
-                session_data = self.session_manager.get_session_data(session_id)
-                if session_data:
-                    user_id = session_data.get('user_id')
-                    # 将总结信息合并到用户画像
-                    self._merge_summary_to_profile(user_id, summary)
-                
-                # 从队列移除
-                self.session_manager.remove_from_summary_queue(session_id)
-                
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ 会话总结完成: {session_id[:8]}...")
-                
-            except Exception as e:
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ 会话总结失败 {session_id[:8]}: {str(e)}")
+        token = self.lease.acquire(resource)
+        if token is None:
+            raise LeaseHeldError(resource, self.lease.remaining(resource))
+        
+        try:
+            await self._summarize_session_locked(session_id, token)
+        finally:
+            self.lease.release(resource, token)
+    
+    async def _summarize_session_locked(self, session_id: str, fencing_token: int):
+        """总结单个会话（使用增量分析）"""
+        
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔄 开始总结会话: {session_id[:8]}...")
+        
+        # ✅ 改进：只获取新消息（增量）
+        new_context = self.session_manager.get_new_session_context(session_id)
+        
+        if len(new_context) < 3:  # 太少的对话不总结
+            print(f"  ⏭️  新消息太少（{len(new_context)}条），跳过总结")
+            return
+        
+        # 获取上次总结的简要内容（用于提供上下文）
+        previous_summary_context = self.session_manager.get_last_summary_context(session_id)
+        
+        if previous_summary_context:
+            print(f"  📚 使用历史上下文辅助分析")
+        
+        # ✅ 使用LLM总结（带历史上下文）
+        summary = await llm_analyzer.summarize_session(
+            new_context, 
+            previous_summary_context
+        )
+        
+        # LLM 调用失败时不保存空总结，交给队列重试
+        if summary.get("error"):
+            raise Exception(summary["error"])
+        
+        # 保存总结（带防护令牌，租约过期后的旧结果会被拒绝）
+        if not self.session_manager.save_session_summary(session_id, summary, fencing_token):
+            return
+        
+        # 获取用户ID并更新画像
+        session_data = self.session_manager.get_session_data(session_id)
+        if session_data:
+            user_id = session_data.get('user_id')
+            # 将总结信息合并到用户画像
+            self._merge_summary_to_profile(user_id, summary)
+        
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ 会话总结完成: {session_id[:8]}...")
     
     def _merge_summary_to_profile(self, user_id: str, summary: Dict):
         """将会话总结合并到用户画像"""
@@ -143,54 +274,79 @@ class BackgroundTaskManager:
             print(f"合并总结到画像失败: {str(e)}")
     
     async def _process_profile_updates(self):
-        """批量更新用户画像（后台任务）"""
+        """批量更新用户画像（后台任务）：从待刷新索引按最久未处理的顺序分批取出"""
+        updated_count = 0
         try:
-            # 获取所有用户（限制每次处理数量）
-            user_profile_keys = self.profile_service.redis.keys("user:*:profile")
-            
-            # 每次最多处理10个用户（提高处理效率）
-            users_to_process = user_profile_keys[:10]
-            updated_count = 0
-            
-            for profile_key in users_to_process:
-                try:
-                    # 提取用户ID
-                    key_str = profile_key.decode() if isinstance(profile_key, bytes) else profile_key
-                    user_id = key_str.replace("user:", "").replace(":profile", "")
-                    
-                    # 检查最后更新时间，避免频繁更新
-                    last_update_key = f"user:{user_id}:last_profile_update"
-                    last_update = self.profile_service.redis.get(last_update_key)
-                    
-                    if last_update:
-                        last_update_str = last_update.decode() if isinstance(last_update, bytes) else last_update
-                        last_time = datetime.fromisoformat(last_update_str)
-                        # 🔧 修复：使用 total_seconds() 而不是 seconds，3分钟内更新过才跳过（缩短限制时间）
-                        time_diff = (datetime.now() - last_time).total_seconds()
-                        if time_diff < 180:  # 3分钟
-                            print(f"  ⏭️  跳过用户 {user_id[:8]} (上次更新: {int(time_diff)}秒前)")
-                            continue
-                    
-                    # 更新画像
-                    await self.profile_service.update_enhanced_profile(user_id)
-                    updated_count += 1
-                    
-                    # 记录更新时间
-                    self.profile_service.redis.set(
-                        last_update_key, 
-                        datetime.now().isoformat(),
-                        ex=600  # 10分钟过期
-                    )
-                    
-                except Exception as e:
-                    print(f"更新用户 {user_id[:8]} 画像失败: {str(e)}")
-                    continue
+            while self.running:
+                users_to_process, deadline = self.profile_service.claim_dirty_users(self.profile_batch_size)
+                if not users_to_process:
+                    break
+                updated_count += await self._update_profile_batch(users_to_process)
+                # 推迟的用户分数已改变，确认时保留；工作进程在确认前退出时，可见性超时后重新领取
+                self.profile_service.ack_dirty_users(users_to_process, deadline)
             
             if updated_count > 0:
                 print(f"[{datetime.now().strftime('%H:%M:%S')}] 🎯 批量更新完成: {updated_count}个用户")
                     
         except Exception as e:
             print(f"批量更新画像失败: {str(e)}")
+    
+    async def _update_profile_batch(self, user_ids) -> int:
+        """更新一批用户的画像（持有各用户的租约期间），返回更新的用户数"""
+        # 其他工作进程正在刷新的用户，等它的租约到期后再处理
+        tokens = {}
+        for user_id in user_ids:
+            resource = f"profile:{user_id}"
+            token = self.lease.acquire(resource)
+            if token is None:
+                self.profile_service.defer_profile_update(
+                    user_id, time.time() + max(self.lease.remaining(resource), 1)
+                )
+            else:
+                tokens[user_id] = token
+        
+        try:
+            # 检查最后更新时间，避免频繁更新：3分钟内更新过的推迟到3分钟后
+            leased = list(tokens)
+            last_updates = self.profile_service.redis.mget(
+                [f"user:{user_id}:last_profile_update" for user_id in leased]
+            ) if leased else []
+            
+            to_update = []
+            for user_id, last_update in zip(leased, last_updates):
+                if last_update:
+                    last_update_str = last_update.decode() if isinstance(last_update, bytes) else last_update
+                    last_time = datetime.fromisoformat(last_update_str)
+                    time_diff = (datetime.now() - last_time).total_seconds()
+                    if time_diff < 180:  # 3分钟
+                        print(f"  ⏭️  推迟用户 {user_id[:8]} (上次更新: {int(time_diff)}秒前)")
+                        self.profile_service.defer_profile_update(user_id, last_time.timestamp() + 180)
+                        continue
+                to_update.append(user_id)
+            
+            if not to_update:
+                return 0
+            
+            # 整批读取、分析（进程池）、写回
+            outcome = await self.profile_service.update_profiles_batch(
+                to_update, self.inference_pool, fencing_tokens={user_id: tokens[user_id] for user_id in to_update}
+            )
+            
+            # 记录更新时间
+            now = datetime.now().isoformat()
+            pipe = self.profile_service.redis.pipeline(transaction=False)
+            for user_id in outcome["updated"]:
+                pipe.set(f"user:{user_id}:last_profile_update", now, ex=600)  # 10分钟过期
+            pipe.execute()
+            
+            # 失败的放回索引，稍后重试
+            for user_id in outcome["failed"]:
+                self.profile_service.defer_profile_update(user_id, time.time() + 60)
+            
+            return len(outcome["updated"])
+        finally:
+            for user_id, token in tokens.items():
+                self.lease.release(f"profile:{user_id}", token)
 
 
 # 全局任务管理器实例（将在main.py中初始化）
@@ -1,52 +1,173 @@
 """
 用户行为分析服务
 基于用户与桌面宠物的交互行为，分析用户性格、习惯和偏好
+
+行为列表只解码一次，转换为列式数据（类型计数、时间戳、聊天时长和消息数、状态计数），
+各项分析共用；时间戳批量解析为 NumPy 数组，时段、星期和时间跨度向量化计算。
+取值规则与写入时维护的行为汇总（behavior_rollup）一致：
+- 没有 type 的行为按 unknown 计；metadata 不是字典时按空字典处理；聊天时长和消息数只累加数值
+- 时段和星期取时间戳本身的日期时间；时间跨度按绝对时间计算，不带时区的时间戳按 UTC 计
+- 高峰时段和高峰星期次数相同时，较早的小时（星期）排在前面
 """
 
-import json
+import re
+import numpy as np
+from collections import Counter
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
-from collections import Counter, defaultdict
+from typing import Dict, List, Union
+
+from services.behavior_rollup import BehaviorRollup, is_number
+
+_EPOCH = datetime(1970, 1, 1)
+_ONE_US = timedelta(microseconds=1)
+_US_PER_SECOND = 1_000_000
+_US_PER_HOUR = 3600 * _US_PER_SECOND
+_US_PER_DAY = 86400 * _US_PER_SECOND
+
+# 常见时间戳格式（服务端 isoformat、客户端 toISOString）整批校验后用 NumPy 解析，
+# 其他格式逐个用 datetime.fromisoformat 解析
+_STAMP = r"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.\d{3}(?:\d{3})?)?Z?"
+_STAMP_BLOCK = re.compile(f"{_STAMP}(?:\n{_STAMP})*", re.ASCII)
+
+
+def _ordered(counter: Counter) -> Counter:
+    return Counter(dict(sorted(counter.items())))
+
+
+class BehaviorColumns:
+    """行为列表的列式表示（解码一次，供各项分析共用）"""
+
+    def __init__(self, behaviors: List[Dict]):
+        self.total = len(behaviors)
+
+        # 每列用一次推导式提取，不在循环中逐行分支
+        types = [behavior.get('type') for behavior in behaviors]
+        types = ['unknown' if t is None else t for t in types]
+        metadatas = [behavior.get('metadata') for behavior in behaviors]
+        metadatas = [m if isinstance(m, dict) else {} for m in metadatas]
+
+        # 类型计数（按首次出现顺序）
+        type_counts = Counter(types)
+        self.type_names = list(type_counts)
+        self.type_counts = np.fromiter(type_counts.values(), dtype=np.int64, count=len(type_counts))
+
+        self._decode_timestamps(self._extract_timestamps(behaviors, metadatas))
+
+        chat_metadatas = [m for t, m in zip(types, metadatas) if t == 'chat_session']
+        self.chat_count = len(chat_metadatas)
+        self.chat_duration_total = sum(v for v in (m.get('duration') for m in chat_metadatas) if is_number(v))
+        self.chat_message_total = sum(v for v in (m.get('message_count') for m in chat_metadatas) if is_number(v))
+
+        state_metadatas = [m for t, m in zip(types, metadatas) if t == 'state_change']
+        self.state_change_count = len(state_metadatas)
+        state_counts = Counter(filter(None, [m.get('to_state') for m in state_metadatas]))
+        self.state_names = list(state_counts)
+        self.state_counts = np.fromiter(state_counts.values(), dtype=np.int64, count=len(state_counts))
+
+    @staticmethod
+    def _extract_timestamps(behaviors: List[Dict], metadatas: List) -> List[str]:
+        """时间戳列（metadata.timestamp 优先），只保留字符串"""
+        stamps = [m.get('timestamp') or b.get('timestamp') for b, m in zip(behaviors, metadatas)]
+        return [ts for ts in stamps if ts and isinstance(ts, str)]
+
+    def _decode_timestamps(self, stamps: List[str]):
+        """时间戳列：本地时间 wall_us（用于小时和星期）和绝对时间 epoch_us（用于时间跨度），单位微秒"""
+        joined = "\n".join(stamps)
+        if (stamps and joined.count("\n") == len(stamps) - 1 and _STAMP_BLOCK.fullmatch(joined)
+                and not joined.startswith("0000") and "\n0000" not in joined):
+            # 日期和时间的取值范围由 NumPy 校验（越界时抛出 ValueError），0000 年 datetime 不支持
+            try:
+                # 带 Z 的是 UTC 时间，不带时区的按 UTC 计，去掉后缀即为本地时间和绝对时间
+                wall = np.array(joined.replace("Z", "").split("\n"), dtype="datetime64[us]").astype(np.int64)
+                self.wall_us = self.epoch_us = wall
+                return
+            except ValueError:
+                pass
+
+        datetimes = []
+        for ts_str in stamps:
+            try:
+                datetimes.append(datetime.fromisoformat(ts_str))
+            except ValueError:
+                continue
+        self.wall_us = np.array([(dt.replace(tzinfo=None) - _EPOCH) // _ONE_US for dt in datetimes], dtype=np.int64)
+        offsets = [dt.utcoffset() for dt in datetimes]
+        self.epoch_us = self.wall_us - np.array(
+            [0 if offset is None else offset // _ONE_US for offset in offsets], dtype=np.int64
+        )
+
+    def count(self, behavior_type: str) -> int:
+        """某类行为的数量"""
+        for name, count in zip(self.type_names, self.type_counts):
+            if name == behavior_type:
+                return int(count)
+        return 0
+
+    def distinct_types(self) -> int:
+        """不同行为类型的数量"""
+        return len(self.type_names)
+
+    @property
+    def timestamp_count(self) -> int:
+        return len(self.epoch_us)
+
+    def time_span_seconds(self) -> float:
+        """最早到最晚行为的时间跨度（秒），时间戳少于 2 个时为 0"""
+        if self.timestamp_count < 2:
+            return 0.0
+        return int(self.epoch_us.max() - self.epoch_us.min()) / _US_PER_SECOND
+
+    def hour_counter(self) -> Counter:
+        """各小时的行为数（按小时排列，most_common 次数相同时较早的小时优先）"""
+        return _ordered(Counter(((self.wall_us // _US_PER_HOUR) % 24).tolist()))
+
+    def weekday_counter(self) -> Counter:
+        """星期几的行为数（按星期排列，1970-01-01 是周四即 weekday 3）"""
+        return _ordered(Counter(((self.wall_us // _US_PER_DAY + 3) % 7).tolist()))
 
 
 class BehaviorAnalyzer:
-    """用户行为分析器"""
+    """用户行为分析器
+    
+    各分析方法既接受行为列表，也接受已解码的 BehaviorColumns 或写入时维护的 BehaviorRollup
+    """
     
     def __init__(self):
         pass
     
-    def analyze_interaction_patterns(self, behaviors: List[Dict]) -> Dict:
+    @staticmethod
+    def _columns(behaviors: Union[List[Dict], BehaviorColumns, BehaviorRollup]) -> BehaviorColumns:
+        if isinstance(behaviors, (BehaviorColumns, BehaviorRollup)):
+            return behaviors
+        return BehaviorColumns(behaviors)
+    
+    def analyze_interaction_patterns(self, behaviors: Union[List[Dict], BehaviorColumns, BehaviorRollup]) -> Dict:
         """分析用户交互模式"""
-        if not behaviors:
+        columns = self._columns(behaviors)
+        if not columns.total:
             return {}
         
-        # 按类型分组
-        behavior_types = defaultdict(list)
-        for behavior in behaviors:
-            behavior_type = behavior.get('type', 'unknown')
-            behavior_types[behavior_type].append(behavior)
-        
         # 统计各类行为
-        click_behaviors = behavior_types.get('pet_click', [])
-        drag_behaviors = behavior_types.get('pet_drag', [])
-        chat_behaviors = behavior_types.get('chat_session', [])
-        state_change_behaviors = behavior_types.get('state_change', [])
+        click_count = columns.count('pet_click')
+        drag_count = columns.count('pet_drag')
+        chat_count = columns.count('chat_session')
+        state_change_count = columns.count('state_change')
         
         # 计算交互频率
-        total_interactions = len(behaviors)
-        click_ratio = len(click_behaviors) / max(total_interactions, 1)
-        drag_ratio = len(drag_behaviors) / max(total_interactions, 1)
-        chat_ratio = len(chat_behaviors) / max(total_interactions, 1)
+        total_interactions = columns.total
+        click_ratio = click_count / max(total_interactions, 1)
+        drag_ratio = drag_count / max(total_interactions, 1)
+        chat_ratio = chat_count / max(total_interactions, 1)
         
         # 分析交互强度
-        interaction_level = self._calculate_interaction_level(total_interactions, behaviors)
+        interaction_level = self._calculate_interaction_level(total_interactions, columns)
         
         return {
             "total_interactions": total_interactions,
-            "click_count": len(click_behaviors),
-            "drag_count": len(drag_behaviors),
-            "chat_count": len(chat_behaviors),
-            "state_change_count": len(state_change_behaviors),
+            "click_count": click_count,
+            "drag_count": drag_count,
+            "chat_count": chat_count,
+            "state_change_count": state_change_count,
             "click_ratio": round(click_ratio, 2),
             "drag_ratio": round(drag_ratio, 2),
             "chat_ratio": round(chat_ratio, 2),
@@ -54,26 +175,16 @@ class BehaviorAnalyzer:
             "interaction_style": self._infer_interaction_style(click_ratio, drag_ratio, chat_ratio)
         }
     
-    def _calculate_interaction_level(self, total_count: int, behaviors: List[Dict]) -> str:
+    def _calculate_interaction_level(self, total_count: int, columns: BehaviorColumns) -> str:
         """计算交互强度等级"""
         # 基于时间跨度计算平均频率
-        if not behaviors:
+        if not columns.total:
             return "无"
         
-        timestamps = []
-        for behavior in behaviors:
-            try:
-                metadata = behavior.get('metadata', {})
-                ts_str = metadata.get('timestamp') or behavior.get('timestamp')
-                if ts_str:
-                    timestamps.append(datetime.fromisoformat(ts_str))
-            except:
-                continue
-        
-        if len(timestamps) < 2:
+        if columns.timestamp_count < 2:
             return "低" if total_count < 10 else "中"
         
-        time_span_hours = (max(timestamps) - min(timestamps)).total_seconds() / 3600
+        time_span_hours = columns.time_span_seconds() / 3600
         if time_span_hours == 0:
             time_span_hours = 1
         
@@ -101,55 +212,39 @@ class BehaviorAnalyzer:
         else:
             return "观察型"
     
-    def infer_personality_from_behavior(self, behaviors: List[Dict]) -> Dict:
+    def infer_personality_from_behavior(self, behaviors: Union[List[Dict], BehaviorColumns, BehaviorRollup]) -> Dict:
         """从行为推断性格特征"""
-        if not behaviors:
+        columns = self._columns(behaviors)
+        if not columns.total:
             return {}
         
-        # 按类型分组
-        behavior_types = defaultdict(list)
-        for behavior in behaviors:
-            behavior_type = behavior.get('type', 'unknown')
-            behavior_types[behavior_type].append(behavior)
-        
-        click_behaviors = behavior_types.get('pet_click', [])
-        drag_behaviors = behavior_types.get('pet_drag', [])
-        chat_behaviors = behavior_types.get('chat_session', [])
-        
         # 计算总时长
-        time_span_days = self._calculate_time_span_days(behaviors)
+        time_span_days = self._calculate_time_span_days(columns)
         
         # 推断外向性（基于互动频率）
-        interactions_per_day = len(behaviors) / max(time_span_days, 1)
+        interactions_per_day = columns.total / max(time_span_days, 1)
         extraversion = self._map_to_level(interactions_per_day, [2, 5, 10])
         
         # 推断控制欲（基于拖拽频率）
-        drag_frequency = len(drag_behaviors) / max(len(behaviors), 1)
+        drag_frequency = columns.count('pet_drag') / max(columns.total, 1)
         control_desire = self._map_to_level(drag_frequency, [0.1, 0.2, 0.4])
         
         # 推断社交需求（基于聊天行为）
-        chat_frequency = len(chat_behaviors) / max(time_span_days, 1)
+        chat_frequency = columns.chat_count / max(time_span_days, 1)
         social_need = self._map_to_level(chat_frequency, [0.5, 1, 2])
         
         # 分析聊天时长
         avg_chat_duration = 0
         total_chat_messages = 0
-        if chat_behaviors:
-            total_duration = sum(
-                behavior.get('metadata', {}).get('duration', 0) 
-                for behavior in chat_behaviors
-            )
-            avg_chat_duration = total_duration / len(chat_behaviors) / 1000  # 转换为秒
-            total_chat_messages = sum(
-                behavior.get('metadata', {}).get('message_count', 0)
-                for behavior in chat_behaviors
-            )
+        if columns.chat_count:
+            avg_chat_duration = columns.chat_duration_total / columns.chat_count / 1000  # 转换为秒
+            total_chat_messages = columns.chat_message_total
         
         # 推断耐心程度（基于聊天时长）
         patience = self._map_to_level(avg_chat_duration, [60, 180, 600])
         
         # 推断参与度（基于总体行为多样性）
-        behavior_diversity = len(behavior_types)
+        behavior_diversity = columns.distinct_types()
         engagement = self._map_to_level(behavior_diversity, [2, 4, 6])
         
         return {
@@ -158,26 +253,16 @@ class BehaviorAnalyzer:
             "社交需求": social_need,
             "耐心程度": patience,
             "参与度": engagement,
-            "使用习惯": self._infer_usage_habit(len(behaviors), time_span_days),
+            "使用习惯": self._infer_usage_habit(columns.total, time_span_days),
             "聊天偏好": self._infer_chat_preference(avg_chat_duration, total_chat_messages)
         }
     
-    def _calculate_time_span_days(self, behaviors: List[Dict]) -> float:
+    def _calculate_time_span_days(self, columns: BehaviorColumns) -> float:
         """计算行为时间跨度（天）"""
-        timestamps = []
-        for behavior in behaviors:
-            try:
-                metadata = behavior.get('metadata', {})
-                ts_str = metadata.get('timestamp') or behavior.get('timestamp')
-                if ts_str:
-                    timestamps.append(datetime.fromisoformat(ts_str))
-            except:
-                continue
-        
-        if len(timestamps) < 2:
+        if columns.timestamp_count < 2:
             return 1.0
         
-        time_span = (max(timestamps) - min(timestamps)).total_seconds() / 86400
+        time_span = columns.time_span_seconds() / 86400
         return max(time_span, 1.0)
     
     def _map_to_level(self, value: float, thresholds: List[float]) -> str:
@@ -219,46 +304,31 @@ class BehaviorAnalyzer:
         else:
             return "很少聊天"
     
-    def analyze_active_time_patterns(self, behaviors: List[Dict]) -> Dict:
+    def analyze_active_time_patterns(self, behaviors: Union[List[Dict], BehaviorColumns, BehaviorRollup]) -> Dict:
         """分析活跃时段模式"""
-        if not behaviors:
+        columns = self._columns(behaviors)
+        if not columns.total or not columns.timestamp_count:
             return {}
         
-        # 提取时间信息
-        hours = []
-        days_of_week = []
-        
-        for behavior in behaviors:
-            try:
-                metadata = behavior.get('metadata', {})
-                ts_str = metadata.get('timestamp') or behavior.get('timestamp')
-                if ts_str:
-                    dt = datetime.fromisoformat(ts_str)
-                    hours.append(dt.hour)
-                    days_of_week.append(dt.weekday())
-            except:
-                continue
-        
-        if not hours:
-            return {}
-        
-        # 统计时段分布
-        hour_counter = Counter(hours)
-        day_counter = Counter(days_of_week)
+        # 统计时段分布（小时和星期由时间戳列向量化计算，或直接取自汇总）
+        hour_counter = columns.hour_counter()
+        day_counter = columns.weekday_counter()
         
         # 找出高峰时段
         peak_hours = [hour for hour, count in hour_counter.most_common(3)]
         peak_days = [self._get_day_name(day) for day, count in day_counter.most_common(3)]
         
         # 判断活跃时段类型
-        time_pattern = self._infer_time_pattern(hours)
+        hour_histogram = np.zeros(24, dtype=np.int64)
+        hour_histogram[list(hour_counter)] = list(hour_counter.values())
+        time_pattern = self._infer_time_pattern(hour_histogram)
         
         return {
             "peak_hours": peak_hours,
             "peak_days": peak_days,
             "time_pattern": time_pattern,
-            "total_active_hours": len(set(hours)),
-            "most_active_hour": hour_counter.most_common(1)[0][0] if hour_counter else None,
+            "total_active_hours": len(hour_counter),
+            "most_active_hour": hour_counter.most_common(1)[0][0],
             "hour_distribution": dict(hour_counter)
         }
     
@@ -267,17 +337,16 @@ class BehaviorAnalyzer:
         days = ["周一", "周二", "周三", "周四", "周五", "周六", "周日"]
         return days[day_index] if 0 <= day_index < 7 else "未知"
     
-    def _infer_time_pattern(self, hours: List[int]) -> str:
-        """推断时间使用模式"""
-        if not hours:
+    def _infer_time_pattern(self, hour_histogram: np.ndarray) -> str:
+        """推断时间使用模式（hour_histogram 为 24 个小时的行为数）"""
+        total = int(hour_histogram.sum())
+        if not total:
             return "未知"
         
-        morning_count = sum(1 for h in hours if 6 <= h < 12)
-        afternoon_count = sum(1 for h in hours if 12 <= h < 18)
-        evening_count = sum(1 for h in hours if 18 <= h < 24)
-        night_count = sum(1 for h in hours if 0 <= h < 6)
-        
-        total = len(hours)
+        morning_count = int(hour_histogram[6:12].sum())
+        afternoon_count = int(hour_histogram[12:18].sum())
+        evening_count = int(hour_histogram[18:24].sum())
+        night_count = int(hour_histogram[0:6].sum())
         
         if evening_count / total > 0.4:
             return "夜猫子型"
@@ -290,64 +359,44 @@ class BehaviorAnalyzer:
         else:
             return "全天分散型"
     
-    def analyze_state_preferences(self, behaviors: List[Dict]) -> Dict:
+    def analyze_state_preferences(self, behaviors: Union[List[Dict], BehaviorColumns, BehaviorRollup]) -> Dict:
         """分析状态偏好"""
-        state_changes = [
-            b for b in behaviors 
-            if b.get('type') == 'state_change'
-        ]
-        
-        if not state_changes:
+        columns = self._columns(behaviors)
+        if not columns.state_change_count:
             return {}
         
-        # 统计各状态切换
-        state_to_counter = Counter()
-        state_from_counter = Counter()
-        
-        for behavior in state_changes:
-            metadata = behavior.get('metadata', {})
-            to_state = metadata.get('to_state')
-            from_state = metadata.get('from_state')
-            
-            if to_state:
-                state_to_counter[to_state] += 1
-            if from_state:
-                state_from_counter[from_state] += 1
-        
-        # 找出最喜欢的状态
-        favorite_state = state_to_counter.most_common(1)[0][0] if state_to_counter else None
+        # 统计各状态切换（按首次出现顺序），找出最喜欢的状态
+        state_preferences = {
+            name: int(count) for name, count in zip(columns.state_names, columns.state_counts)
+        }
+        favorite_state = columns.state_names[int(np.argmax(columns.state_counts))] if state_preferences else None
         
         return {
-            "total_state_changes": len(state_changes),
+            "total_state_changes": columns.state_change_count,
             "favorite_state": favorite_state,
-            "state_preferences": dict(state_to_counter),
-            "state_change_frequency": len(state_changes) / max(len(behaviors), 1)
+            "state_preferences": state_preferences,
+            "state_change_frequency": columns.state_change_count / max(columns.total, 1)
         }
     
-    def calculate_engagement_score(self, behaviors: List[Dict]) -> Dict:
+    def calculate_engagement_score(self, behaviors: Union[List[Dict], BehaviorColumns, BehaviorRollup]) -> Dict:
         """计算参与度评分"""
-        if not behaviors:
+        columns = self._columns(behaviors)
+        if not columns.total:
             return {"score": 0, "level": "无"}
         
         # 多维度评分
-        interaction_score = min(len(behaviors) / 100, 1.0) * 30  # 交互次数（30分）
+        interaction_score = min(columns.total / 100, 1.0) * 30  # 交互次数（30分）
         
         # 行为多样性（20分）
-        behavior_types = set(b.get('type') for b in behaviors)
-        diversity_score = min(len(behavior_types) / 8, 1.0) * 20
+        diversity_score = min(columns.distinct_types() / 8, 1.0) * 20
         
         # 时间跨度（20分）
-        time_span_days = self._calculate_time_span_days(behaviors)
+        time_span_days = self._calculate_time_span_days(columns)
         time_score = min(time_span_days / 30, 1.0) * 20
         
         # 聊天深度（30分）
-        chat_behaviors = [b for b in behaviors if b.get('type') == 'chat_session']
-        if chat_behaviors:
-            total_messages = sum(
-                b.get('metadata', {}).get('message_count', 0)
-                for b in chat_behaviors
-            )
-            chat_score = min(total_messages / 50, 1.0) * 30
+        if columns.chat_count:
+            chat_score = min(columns.chat_message_total / 50, 1.0) * 30
         else:
             chat_score = 0
         
@@ -376,22 +425,23 @@ class BehaviorAnalyzer:
             }
         }
     
-    def generate_behavior_summary(self, behaviors: List[Dict]) -> Dict:
+    def generate_behavior_summary(self, behaviors: Union[List[Dict], BehaviorColumns, BehaviorRollup]) -> Dict:
         """生成完整的行为分析摘要"""
-        if not behaviors:
+        columns = self._columns(behaviors)
+        if not columns.total:
             return {
                 "total_behaviors": 0,
                 "summary": "暂无行为数据"
             }
         
-        interaction_patterns = self.analyze_interaction_patterns(behaviors)
-        personality = self.infer_personality_from_behavior(behaviors)
-        time_patterns = self.analyze_active_time_patterns(behaviors)
-        state_preferences = self.analyze_state_preferences(behaviors)
-        engagement = self.calculate_engagement_score(behaviors)
+        interaction_patterns = self.analyze_interaction_patterns(columns)
+        personality = self.infer_personality_from_behavior(columns)
+        time_patterns = self.analyze_active_time_patterns(columns)
+        state_preferences = self.analyze_state_preferences(columns)
+        engagement = self.calculate_engagement_score(columns)
         
         return {
-            "total_behaviors": len(behaviors),
+            "total_behaviors": columns.total,
             "interaction_patterns": interaction_patterns,
             "personality_traits": personality,
             "time_patterns": time_patterns,
@@ -403,4 +453,3 @@ class BehaviorAnalyzer:
 
 # 全局分析器实例
 behavior_analyzer = BehaviorAnalyzer()
-
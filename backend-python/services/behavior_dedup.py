@@ -0,0 +1,107 @@
+"""
+行为批次去重
+客户端发送失败时会重发整批行为；如果第一次请求其实已经写入（例如响应超时），重发会重复计数。
+批量接口支持客户端ID（client_id）、批次ID（batch_id）和每条行为的序号（seq）：
+- 每个客户端在 Redis 中有一个去重窗口：ZSET 序号 -> 接收时间，超出窗口的序号被清理
+- 写入前原子地领取本批序号，已接收过的行为直接跳过；写入失败时归还领取的序号，重试不会丢数据
+- 带批次ID时同时领取批次（应答键写入空的处理中标记），同一批次的并发请求只有一个会处理
+- 处理完成的批次保存应答，同一批次重发时直接返回该应答
+"""
+
+import json
+import os
+import time
+import redis.asyncio as aioredis
+from typing import Dict, Iterable, List, Optional, Set
+
+# 批次处理中标记的过期时间（秒）：处理进程中途退出时，客户端重试可在过期后重新处理
+PROCESSING_TTL = 60
+
+# 领取批次和序号：批次已被领取（处理中或已有应答）时返回 false；
+# 否则清理超出窗口的序号，返回本次新领取的序号（已接收过的不返回）
+# KEYS: 已接收序号, 批次应答（没有批次ID时省略）  ARGV: 当前时间, 窗口秒数, 处理中标记过期秒数, 序号...
+CLAIM_SCRIPT = """
+if KEYS[2] and not redis.call('SET', KEYS[2], '', 'NX', 'EX', ARGV[3]) then
+    return false
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', tonumber(ARGV[1]) - tonumber(ARGV[2]))
+local claimed = {}
+for i = 4, #ARGV do
+    if redis.call('ZADD', KEYS[1], 'NX', ARGV[1], ARGV[i]) == 1 then
+        claimed[#claimed + 1] = ARGV[i]
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return claimed
+"""
+
+# 归还序号和批次（批次只在仍为处理中标记时删除）
+# KEYS: 已接收序号, 批次应答（没有批次ID时省略）  ARGV: 序号...
+RELEASE_SCRIPT = """
+for i = 1, #ARGV do
+    redis.call('ZREM', KEYS[1], ARGV[i])
+end
+if KEYS[2] and redis.call('GET', KEYS[2]) == '' then
+    redis.call('DEL', KEYS[2])
+end
+return 0
+"""
+
+
+def _decode(value) -> str:
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class BehaviorDedup:
+    """按客户端序号去重的行为接收窗口"""
+
+    def __init__(self, async_redis: aioredis.Redis):
+        self.redis = async_redis
+        self.window = int(os.getenv("BEHAVIOR_DEDUP_WINDOW", 3600))
+        self._claim = async_redis.register_script(CLAIM_SCRIPT)
+        self._release = async_redis.register_script(RELEASE_SCRIPT)
+
+    @staticmethod
+    def _sequences_key(client_id: str) -> str:
+        return f"behavior:dedup:{client_id}:seqs"
+
+    @staticmethod
+    def _ack_key(client_id: str, batch_id: str) -> str:
+        return f"behavior:dedup:{client_id}:batch:{batch_id}"
+
+    def _keys(self, client_id: str, batch_id: Optional[str]) -> List[str]:
+        keys = [self._sequences_key(client_id)]
+        if batch_id:
+            keys.append(self._ack_key(client_id, batch_id))
+        return keys
+
+    async def get_ack(self, client_id: str, batch_id: str) -> Optional[Dict]:
+        """已处理批次的应答（未处理、处理中或已过期时返回 None）"""
+        data = await self.redis.get(self._ack_key(client_id, batch_id))
+        return json.loads(data) if data else None
+
+    def save_ack(self, pipe, client_id: str, batch_id: str, ack: Dict):
+        """把保存批次应答的命令加入调用方的流水线（替换领取批次时写入的处理中标记）"""
+        pipe.set(self._ack_key(client_id, batch_id), json.dumps(ack, ensure_ascii=False), ex=self.window)
+
+    async def claim(self, client_id: str, sequences: Iterable[int], batch_id: Optional[str] = None) -> Optional[Set[int]]:
+        """领取批次和序号，返回窗口内首次出现的序号（同一序号只返回一次）
+        
+        带批次ID且该批次已被领取（其他请求正在处理或已处理完成）时返回 None
+        """
+        sequences = list(dict.fromkeys(sequences))
+        if not sequences and not batch_id:
+            return set()
+        claimed = await self._claim(
+            keys=self._keys(client_id, batch_id),
+            args=[time.time(), self.window, PROCESSING_TTL, *sequences]
+        )
+        if claimed is None:
+            return None
+        return {int(_decode(seq)) for seq in claimed}
+
+    async def release(self, client_id: str, sequences: Iterable[int], batch_id: Optional[str] = None):
+        """归还领取的序号和批次（写入失败时调用，客户端重试时可以再次领取）"""
+        sequences = list(sequences)
+        if sequences or batch_id:
+            await self._release(keys=self._keys(client_id, batch_id), args=sequences)
@@ -0,0 +1,206 @@
+"""
+行为汇总（写入时增量维护）
+每条行为写入时，在同一个流水线中更新该用户的汇总计数，分析接口直接读取汇总，
+不再读取并解析整个行为列表；汇总不受行为列表截断（最近 200 条）的影响，覆盖全部历史：
+- user:{id}:behavior_rollup  HASH 行为总数、各类型、小时和星期分布、状态切换、聊天时长和消息数
+- user:{id}:behavior_span    ZSET 最早（first）和最晚（last）行为时间，用 ZADD LT/GT 维护
+"""
+
+import math
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+_EPOCH = datetime(1970, 1, 1)
+_ONE_US = timedelta(microseconds=1)
+
+# 汇总为空时从现有行为列表补建（汇总功能上线前记录的行为）；汇总已存在时不做任何修改
+# KEYS: 汇总哈希, 时间范围  ARGV: 最早时间, 最晚时间, 字段1, 值1, ...
+BACKFILL_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+if ARGV[1] ~= '' then
+    redis.call('ZADD', KEYS[2], 'LT', ARGV[1], 'first')
+    redis.call('ZADD', KEYS[2], 'GT', ARGV[2], 'last')
+end
+return 1
+"""
+
+
+def rollup_key(user_id: str) -> str:
+    return f"user:{user_id}:behavior_rollup"
+
+
+def span_key(user_id: str) -> str:
+    return f"user:{user_id}:behavior_span"
+
+
+def _decode(value) -> str:
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def is_number(value) -> bool:
+    """有限的数值（布尔值除外）"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def _parse_timestamp(behavior: Dict, metadata) -> Optional[datetime]:
+    """行为时间（metadata.timestamp 优先），与 BehaviorAnalyzer 的取值规则一致"""
+    try:
+        ts_str = metadata.get('timestamp') or behavior.get('timestamp')
+        if ts_str and isinstance(ts_str, str):
+            return datetime.fromisoformat(ts_str)
+    except Exception:
+        pass
+    return None
+
+
+def aggregate(behaviors: Iterable[Dict]) -> Tuple[Counter, Dict[str, float], Optional[int], Optional[int]]:
+    """计算一批行为的汇总增量
+
+    返回 (计数增量, 求和增量, 最早时间, 最晚时间)，时间为微秒时间戳（不带时区的按 UTC 计）
+    """
+    counters: Counter = Counter()
+    sums: Dict[str, float] = {}
+    first = last = None
+
+    for behavior in behaviors:
+        behavior_type = behavior.get('type')
+        metadata = behavior.get('metadata')
+        if not isinstance(metadata, dict):
+            metadata = {}
+
+        counters["total"] += 1
+        counters[f"type:{'unknown' if behavior_type is None else behavior_type}"] += 1
+
+        dt = _parse_timestamp(behavior, metadata)
+        if dt is not None:
+            counters["timestamps"] += 1
+            counters[f"hour:{dt.hour}"] += 1
+            counters[f"weekday:{dt.weekday()}"] += 1
+            epoch_us = (dt.replace(tzinfo=None) - _EPOCH) // _ONE_US
+            offset = dt.utcoffset()
+            if offset is not None:
+                epoch_us -= offset // _ONE_US
+            first = epoch_us if first is None else min(first, epoch_us)
+            last = epoch_us if last is None else max(last, epoch_us)
+
+        if behavior_type == 'chat_session':
+            counters["chat_sessions"] += 1
+            for field, name in (("chat_duration", "duration"), ("chat_messages", "message_count")):
+                value = metadata.get(name)
+                if is_number(value):
+                    sums[field] = sums.get(field, 0) + value
+        elif behavior_type == 'state_change':
+            counters["state_changes"] += 1
+            to_state = metadata.get('to_state')
+            from_state = metadata.get('from_state')
+            if to_state:
+                counters[f"state:{to_state}"] += 1
+                if from_state:
+                    counters[f"transition:{from_state}>{to_state}"] += 1
+
+    return counters, sums, first, last
+
+
+def record(pipe, user_id: str, behaviors: List[Dict]):
+    """把一批行为的汇总增量加入调用方的流水线（同步/异步流水线均可）"""
+    counters, sums, first, last = aggregate(behaviors)
+    key = rollup_key(user_id)
+    for field, count in counters.items():
+        pipe.hincrby(key, field, count)
+    for field, value in sums.items():
+        pipe.hincrbyfloat(key, field, value)
+    if first is not None:
+        pipe.zadd(span_key(user_id), {"first": first}, lt=True)
+        pipe.zadd(span_key(user_id), {"last": last}, gt=True)
+
+
+def increment_args(behaviors: List[Dict]) -> List:
+    """在脚本中累加汇总的参数：最早时间, 最晚时间, 计数字段数, 字段1, 值1, ..., 求和字段数, 字段1, 值1, ..."""
+    counters, sums, first, last = aggregate(behaviors)
+    args = ["" if first is None else first, "" if last is None else last, len(counters)]
+    for field, count in counters.items():
+        args.extend([field, count])
+    args.append(len(sums))
+    for field, value in sums.items():
+        args.extend([field, value])
+    return args
+
+
+def backfill_args(behaviors: List[Dict]) -> List:
+    """BACKFILL_SCRIPT 的参数"""
+    counters, sums, first, last = aggregate(behaviors)
+    args = ["" if first is None else first, "" if last is None else last]
+    for field, value in list(counters.items()) + list(sums.items()):
+        args.extend([field, value])
+    return args
+
+
+def _number(value: str):
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+class BehaviorRollup:
+    """汇总数据的只读视图，提供与 BehaviorColumns 相同的分析接口"""
+
+    def __init__(self, fields: Dict, span: List = None):
+        fields = {_decode(k): _decode(v) for k, v in (fields or {}).items()}
+        span = {_decode(name): int(score) for name, score in (span or [])}
+
+        self.total = int(fields.get("total", 0))
+        self.timestamp_count = int(fields.get("timestamps", 0))
+        self.first_us = span.get("first")
+        self.last_us = span.get("last")
+
+        self.type_counts_by_name: Dict[str, int] = {}
+        self._hours: Dict[int, int] = {}
+        self._weekdays: Dict[int, int] = {}
+        states: Dict[str, int] = {}
+        self.transitions: Dict[str, int] = {}
+        for field, value in fields.items():
+            prefix, _, name = field.partition(":")
+            if prefix == "type":
+                self.type_counts_by_name[name] = int(value)
+            elif prefix == "hour":
+                self._hours[int(name)] = int(value)
+            elif prefix == "weekday":
+                self._weekdays[int(name)] = int(value)
+            elif prefix == "state":
+                states[name] = int(value)
+            elif prefix == "transition":
+                self.transitions[name] = int(value)
+
+        self.type_names = list(self.type_counts_by_name)
+        self.chat_count = int(fields.get("chat_sessions", 0))
+        self.chat_duration_total = _number(fields.get("chat_duration", 0))
+        self.chat_message_total = _number(fields.get("chat_messages", 0))
+
+        self.state_change_count = int(fields.get("state_changes", 0))
+        self.state_names = list(states)
+        self.state_counts = np.fromiter(states.values(), dtype=np.int64, count=len(states))
+
+    def count(self, behavior_type: str) -> int:
+        return self.type_counts_by_name.get(behavior_type, 0)
+
+    def distinct_types(self) -> int:
+        return len(self.type_names)
+
+    def time_span_seconds(self) -> float:
+        if self.timestamp_count < 2 or self.first_us is None:
+            return 0.0
+        return (self.last_us - self.first_us) / 1_000_000
+
+    def hour_counter(self) -> Counter:
+        """各小时的行为数（按小时排列，与 BehaviorColumns 相同：most_common 次数相同时较早的小时优先）"""
+        return Counter(dict(sorted(self._hours.items())))
+
+    def weekday_counter(self) -> Counter:
+        return Counter(dict(sorted(self._weekdays.items())))
@@ -0,0 +1,134 @@
+"""
+行为批次的紧凑传输编码
+批量接口按 Content-Type 选择解码方式（任意格式都可以再用 Content-Encoding: gzip 压缩）：
+- application/json：原格式 {"client_id", "batch_id", "behaviors": [...]}
+- application/x-ndjson：第一行是批次头，之后每行一条行为
+- application/msgpack：{"h": 批次头, "e": [行为, ...]}
+
+批次头携带所有行为共用的字段，行为只保留短键，时间戳按与上一条的差值编码：
+    批次头: {"c": client_id, "b": batch_id, "u": user_id, "s": session_id, "ts": 起始时间（epoch 毫秒）}
+    行为:   {"t": 行为类型, "q": 序号, "d": 与上一条的时间差（毫秒）, "m": metadata, "u"/"s": 覆盖批次头}
+解码结果与 JSON 格式相同：metadata 中补回 session_id 和 ISO 时间戳（与客户端 toISOString 格式一致）
+"""
+
+import json
+import os
+import zlib
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import msgpack
+
+JSON_TYPES = ("application/json",)
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson")
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+# 解压后的请求体上限（防止压缩炸弹）
+MAX_BATCH_BYTES = int(os.getenv("BEHAVIOR_BATCH_MAX_BYTES", 4 * 1024 * 1024))
+
+
+class UnsupportedEncodingError(Exception):
+    """不支持的 Content-Type 或 Content-Encoding"""
+
+
+class WireFormatError(ValueError):
+    """请求体无法按声明的格式解码"""
+
+
+def _media_type(content_type: Optional[str]) -> str:
+    return (content_type or "application/json").split(";")[0].strip().lower()
+
+
+def _decompress(body: bytes) -> bytes:
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        data = decompressor.decompress(body, MAX_BATCH_BYTES + 1)
+    except zlib.error as e:
+        raise WireFormatError(f"gzip 解压失败: {e}")
+    if len(data) > MAX_BATCH_BYTES or decompressor.unconsumed_tail:
+        raise WireFormatError("请求体过大")
+    if not decompressor.eof:
+        # 截断的 gzip 流不会报错，只返回已解压的部分（NDJSON 会静默丢失后面的行为）
+        raise WireFormatError("gzip 数据不完整")
+    return data
+
+
+def _iso_from_ms(ms: int) -> str:
+    """epoch 毫秒 -> 2025-10-12T14:00:00.000Z"""
+    dt = datetime.fromtimestamp(ms // 1000, tz=timezone.utc)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S") + f".{ms % 1000:03d}Z"
+
+
+def _expand(header: Dict, events: List) -> Dict:
+    """把批次头和紧凑行为展开为 JSON 格式的批次"""
+    if not isinstance(header, dict) or not isinstance(events, list):
+        raise WireFormatError("批次头或行为列表格式错误")
+
+    cursor = header.get("ts")
+    behaviors = []
+    for event in events:
+        if not isinstance(event, dict):
+            behaviors.append({})  # 按无效行为计数
+            continue
+
+        metadata = dict(event["m"]) if isinstance(event.get("m"), dict) else {}
+        session_id = event.get("s", header.get("s"))
+        if session_id is not None:
+            metadata["session_id"] = session_id
+
+        delta = event.get("d", 0)
+        if isinstance(cursor, int) and isinstance(delta, int):
+            cursor += delta
+            try:
+                metadata["timestamp"] = _iso_from_ms(cursor)
+            except (OverflowError, OSError, ValueError):
+                raise WireFormatError("时间戳超出范围")
+
+        behavior = {
+            "user_id": event.get("u", header.get("u", "default")),
+            "behavior_type": event.get("t"),
+            "metadata": metadata
+        }
+        if "q" in event:
+            behavior["seq"] = event["q"]
+        behaviors.append(behavior)
+
+    return {"client_id": header.get("c"), "batch_id": header.get("b"), "behaviors": behaviors}
+
+
+def decode_batch(body: bytes, content_type: Optional[str], content_encoding: Optional[str] = None) -> Dict:
+    """按 Content-Type / Content-Encoding 解码批量行为请求，返回 JSON 格式的批次"""
+    media_type = _media_type(content_type)
+    encoding = (content_encoding or "identity").strip().lower()
+
+    if encoding == "gzip":
+        body = _decompress(body)
+    elif encoding != "identity":
+        raise UnsupportedEncodingError(f"不支持的 Content-Encoding: {encoding}")
+    elif len(body) > MAX_BATCH_BYTES:
+        raise WireFormatError("请求体过大")
+
+    try:
+        if media_type in JSON_TYPES:
+            batch = json.loads(body)
+            if not isinstance(batch, dict):
+                raise WireFormatError("请求体必须是 JSON 对象")
+            return batch
+
+        if media_type in NDJSON_TYPES:
+            lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+            if not lines:
+                raise WireFormatError("缺少批次头")
+            return _expand(lines[0], lines[1:])
+
+        if media_type in MSGPACK_TYPES:
+            batch = msgpack.unpackb(body, raw=False)
+            if not isinstance(batch, dict):
+                raise WireFormatError("请求体必须是 msgpack 映射")
+            return _expand(batch.get("h"), batch.get("e"))
+    except WireFormatError:
+        raise
+    except (ValueError, TypeError, msgpack.UnpackException) as e:
+        raise WireFormatError(f"请求体解码失败: {e}")
+
+    raise UnsupportedEncodingError(f"不支持的 Content-Type: {media_type}")
@@ -18,10 +18,18 @@ class ChatService:
         message: str, 
         conversation_history: List[Dict]
     ) -> AsyncGenerator[str, None]:
-        """流式发送消息"""
+        """流式发送消息（逐段产出回复文本）"""
         async for chunk in ai_provider.send_message_stream(message, conversation_history):
             yield chunk
     
+    async def open(self):
+        """启动时初始化 AI 服务连接池"""
+        await ai_provider.open()
+    
+    async def close(self):
+        """关闭时释放 AI 服务连接池"""
+        await ai_provider.close()
+    
     def get_provider_info(self) -> Dict:
         """获取服务信息"""
         return ai_provider.get_provider_info()
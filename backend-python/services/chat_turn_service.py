@@ -0,0 +1,156 @@
+"""
+聊天回合服务
+将一次对话回合的 Redis 读写合并为流水线：
+- 回合上下文加载：LLM 调用前的读取合并为流水线（宠物人设走进程内缓存）
+- 回合提交：会话上下文追加在响应前由服务端脚本原子写入，
+  其余簿记写入（长期历史、行为、计数、亲密度）交给回合提交队列异步批量写入
+"""
+
+import redis.asyncio as aioredis
+import os
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from services import record_codec
+from services.session_manager import SessionManager
+from services.user_profile_service import UserProfileService
+from services.persona_cache import PersonaCache
+from services.turn_commit_queue import TurnCommitQueue
+
+
+def _decode(value) -> Optional[str]:
+    if value is None:
+        return None
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class ChatTurnService:
+    """聊天回合服务 - 响应路径上每回合两次读往返 + 一次写往返"""
+
+    def __init__(
+        self,
+        async_redis: aioredis.Redis,
+        session_manager: SessionManager,
+        profile_service: UserProfileService,
+        persona_cache: PersonaCache,
+        commit_queue: TurnCommitQueue
+    ):
+        self.redis = async_redis
+        self.session_manager = session_manager
+        self.profile_service = profile_service
+        self.persona_cache = persona_cache
+        self.commit_queue = commit_queue
+        # 最多读取的上下文条数；实际发送多少由提示词的 token 预算决定
+        self.context_fetch_limit = int(os.getenv("CHAT_CONTEXT_FETCH_LIMIT", 50))
+
+    # ==================== 回合上下文加载 ====================
+
+    async def load_turn_context(self, raw_user_id: str) -> Dict:
+        """加载本回合所需的全部上下文（画像、会话、历史、宠物配置）"""
+        user_id = await self.profile_service.get_user_id_async(raw_user_id or "default")
+
+        # 宠物人设来自进程内缓存，不占用 Redis 往返
+        persona = await self.persona_cache.get_persona()
+
+        # 第一次往返：画像、活跃会话
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hgetall(f"user:{user_id}:profile")
+        pipe.get(f"user:{user_id}:active_session")
+        profile_raw, session_id = await pipe.execute()
+
+        profile = UserProfileService.parse_profile(profile_raw)
+        if not profile:
+            await self.profile_service.init_user(user_id)
+            profile = await self.profile_service.get_user_profile_async(user_id)
+
+        # 第二次往返：会话活跃时间、最近上下文和上次总结（依赖会话ID）
+        session_id = _decode(session_id)
+        history: List[Dict] = []
+        summary_prompt = None
+        if session_id:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.hget(f"session:{session_id}", "last_active")
+            pipe.lrange(f"session:{session_id}:context", -self.context_fetch_limit, -1)
+            pipe.hgetall(f"session:{session_id}:summary")
+            last_active, messages, summary = await pipe.execute()
+
+            if SessionManager.is_session_expired(_decode(last_active)):
+                await self.session_manager.end_session_async(session_id)
+                session_id = await self.session_manager.create_session_async(user_id)
+            else:
+                history = record_codec.decode_many(messages)
+                summary_prompt = SessionManager.format_summary_context(
+                    SessionManager._parse_summary(summary)
+                )
+        else:
+            session_id = await self.session_manager.create_session_async(user_id)
+
+        return {
+            "user_id": user_id,
+            "session_id": session_id,
+            "profile": profile or {},
+            "history": [
+                {"role": msg["role"], "content": msg["content"]}
+                for msg in history
+            ],
+            "pet_system_prompt": persona["system_prompt"],
+            "pet_name": persona["name"],
+            "context_prompt": self.profile_service.build_chat_context_prompt(profile),
+            "summary_prompt": summary_prompt
+        }
+
+    def build_enhanced_history(self, turn: Dict) -> List[Dict]:
+        """构建增强的对话历史（宠物设定 + 用户画像 + 会话总结 + 会话上下文）
+
+        发送前由 AIProvider 按提供商的 token 预算裁剪，人设始终保留。
+        """
+        enhanced_history = [{
+            "role": "system",
+            "content": f"{turn['pet_system_prompt']}\n\n你的名字是：{turn['pet_name']}"
+        }]
+
+        if turn["context_prompt"]:
+            enhanced_history.append({
+                "role": "system",
+                "content": f"【用户画像参考】\n{turn['context_prompt']}"
+            })
+
+        if turn.get("summary_prompt"):
+            enhanced_history.append({
+                "role": "system",
+                "content": f"【之前的对话总结】\n{turn['summary_prompt']}"
+            })
+
+        enhanced_history.extend(turn["history"])
+        return enhanced_history
+
+    # ==================== 回合提交 ====================
+
+    async def commit_turn(self, turn: Dict, user_message: str, reply: str) -> Dict:
+        """写入会话上下文（响应前完成），其余簿记写入交给回合提交队列"""
+        session_id = turn["session_id"]
+
+        now = datetime.now().isoformat()
+        messages = [
+            {"role": "user", "content": user_message, "timestamp": now},
+            {"role": "assistant", "content": reply, "timestamp": now}
+        ]
+
+        # 会话短期上下文：下一回合要读取，必须在响应前落盘（服务端脚本，一次往返）
+        appended = await self.session_manager.append_messages_async(
+            session_id, messages, user_id=turn["user_id"]
+        )
+        message_count = appended["message_count"]
+
+        # 长期历史、行为、计数、亲密度不影响回复，异步批量写入
+        await self.commit_queue.enqueue(turn, user_message, reply, now)
+
+        # 本回合跨过10条的整数倍时触发会话总结（由脚本原子判断）
+        summary_queued = appended["summary_due"]
+        if summary_queued:
+            await self.session_manager.mark_session_for_summary_async(session_id)
+
+        return {
+            "message_count": message_count,
+            "summary_queued": summary_queued
+        }
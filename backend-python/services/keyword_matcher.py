@@ -0,0 +1,90 @@
+"""
+多关键词匹配（Aho-Corasick 自动机）
+所有词库的关键词编译成一个自动机，对文本只扫描一遍即可统计每个关键词的出现次数，
+不再对每个关键词各做一次 `in` / `count` 全文扫描
+"""
+
+import re
+from typing import Dict, Iterable, List
+
+
+class KeywordMatcher:
+    """编译后的多关键词匹配器（构建后只读，可在多线程中共享）"""
+
+    def __init__(self, keywords: Iterable[str]):
+        self.keywords: List[str] = sorted({k for k in keywords if k})
+
+        # 状态转移表、失败指针、每个状态结束的关键词（含经失败指针可达的）
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[int]] = [[]]
+
+        for index, keyword in enumerate(self.keywords):
+            state = 0
+            for char in keyword:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                state = next_state
+            self._output[state].append(index)
+
+        # 自动机在根状态时，用正则（C 实现）跳到下一个可能开始匹配的字符
+        first_chars = "".join(sorted(self._goto[0]))
+        self._first_char = re.compile(f"[{re.escape(first_chars)}]") if first_chars else None
+
+        # 按层次构建失败指针
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def count(self, text: str, counts: Dict[str, int] = None) -> Dict[str, int]:
+        """统计文本中各关键词的出现次数（累加到 counts，只包含出现过的关键词）
+
+        计数规则与 `str.count` 一致：同一关键词的重叠出现只计一次（从左到右不重叠）
+        """
+        if counts is None:
+            counts = {}
+        keywords = self.keywords
+        goto, fail, output = self._goto, self._fail, self._output
+        last_end: Dict[int, int] = {}  # 关键词 -> 上一次计数的结束位置
+
+        if self._first_char is None:
+            return counts
+        search = self._first_char.search
+
+        state = 0
+        position = 0
+        length = len(text)
+        while position < length:
+            if not state:
+                match = search(text, position)
+                if match is None:
+                    break
+                position = match.start()
+            char = text[position]
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            position += 1
+            for index in output[state]:
+                if position - len(keywords[index]) >= last_end.get(index, 0):
+                    last_end[index] = position
+                    counts[keywords[index]] = counts.get(keywords[index], 0) + 1
+        return counts
+
+    def count_all(self, texts: Iterable[str]) -> Dict[str, int]:
+        """统计多段文本的关键词次数之和"""
+        counts: Dict[str, int] = {}
+        for text in texts:
+            self.count(text, counts)
+        return counts
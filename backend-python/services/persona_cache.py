@@ -0,0 +1,122 @@
+"""
+宠物人设缓存
+宠物名称和 System Prompt 只在管理后台修改时变化，因此缓存在进程内：
+- 管理后台更新配置后发布 pet:config:updates 消息，订阅任务收到后使缓存失效
+- 订阅断开期间可能错过消息，超过最大缓存时间后按 pet:config:last_updated 版本校验
+"""
+
+import asyncio
+import os
+import time
+import redis.asyncio as aioredis
+from typing import Dict, Optional
+
+
+# 默认宠物配置（管理后台未设置时使用）
+DEFAULT_PET_SYSTEM_PROMPT = "你是一个可爱的桌面宠物，名叫小猫咪。你性格活泼开朗，喜欢和用户互动聊天。回复要简短、可爱、有趣，适当使用表情符号。"
+DEFAULT_PET_NAME = "小猫咪"
+
+# 管理后台发布配置变更的频道
+PET_CONFIG_CHANNEL = "pet:config:updates"
+
+
+def _decode(value) -> Optional[str]:
+    if value is None:
+        return None
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class PersonaCache:
+    """宠物人设进程内缓存"""
+
+    def __init__(self, async_redis: aioredis.Redis):
+        self.redis = async_redis
+        self.max_age = float(os.getenv("PERSONA_CACHE_MAX_AGE", 300))
+
+        self._persona: Optional[Dict] = None
+        self._version: Optional[str] = None
+        self._loaded_at = 0.0
+        self._stale = True
+        self._generation = 0  # 每次失效加一，加载期间发生的失效不会被覆盖
+        self._listener: Optional[asyncio.Task] = None
+
+    async def get_persona(self) -> Dict:
+        """获取宠物人设（缓存有效时不访问 Redis）"""
+        if self._stale or self._persona is None:
+            await self.refresh()
+        elif time.monotonic() - self._loaded_at > self.max_age:
+            # 兜底校验：只读版本号，版本未变则继续使用缓存
+            version = _decode(await self.redis.get("pet:config:last_updated"))
+            if version != self._version:
+                await self.refresh()
+            else:
+                self._loaded_at = time.monotonic()
+
+        return self._persona
+
+    async def refresh(self):
+        """从 Redis 重新加载宠物人设"""
+        generation = self._generation
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get("pet:config:system_prompt")
+        pipe.get("pet:config:name")
+        pipe.get("pet:config:last_updated")
+        system_prompt, name, version = await pipe.execute()
+
+        self._persona = {
+            "system_prompt": _decode(system_prompt) or DEFAULT_PET_SYSTEM_PROMPT,
+            "name": _decode(name) or DEFAULT_PET_NAME
+        }
+        self._version = _decode(version)
+        self._loaded_at = time.monotonic()
+        # 读取期间收到变更通知时，读到的可能是旧配置，保持失效状态
+        self._stale = generation != self._generation
+
+    def invalidate(self):
+        """使缓存失效，下次读取时重新加载"""
+        self._generation += 1
+        self._stale = True
+
+    # ==================== 配置变更订阅 ====================
+
+    async def start(self):
+        """启动配置变更订阅任务"""
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        """停止配置变更订阅任务"""
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+
+    async def _listen(self):
+        """订阅配置变更消息，断线后自动重连"""
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(PET_CONFIG_CHANNEL)
+                # 订阅建立前可能错过了更新
+                self.invalidate()
+                print(f"✅ 已订阅宠物配置变更: {PET_CONFIG_CHANNEL}")
+
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message:
+                        self.invalidate()
+                        print(f"🔄 宠物配置已更新，人设缓存失效")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️  宠物配置订阅断开，5秒后重连: {str(e)}")
+                self.invalidate()
+                await asyncio.sleep(5)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
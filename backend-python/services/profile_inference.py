@@ -0,0 +1,135 @@
+"""
+批量画像推测
+规则推测是纯 Python 的 CPU 计算，批量刷新画像时可以分发到进程池，
+不再和 Web 请求争用同一个解释器：
+- 整批用户的输入由一个流水线读取（见 UserProfileService.update_profiles_batch）
+- 每个用户的分析只依赖传入的原始数据，不访问 Redis，可以在任意进程中执行
+- 结果由调用方在一个流水线中写回
+"""
+
+import json
+import os
+from typing import Dict, List, Optional
+
+from services import record_codec
+from services.user_inference_service import UserInferenceService
+
+# 工作进程内的推测服务（每个进程加载一次词库）
+_inference_service: Optional[UserInferenceService] = None
+
+
+def _get_inference_service() -> UserInferenceService:
+    global _inference_service
+    if _inference_service is None:
+        _inference_service = UserInferenceService()
+    else:
+        _inference_service.reload_if_changed()
+    return _inference_service
+
+
+def warm_up(_=None) -> int:
+    """预先启动工作进程并加载词库"""
+    _get_inference_service()
+    return os.getpid()
+
+
+def _decode(value) -> str:
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def _parse_list(raw_items: List) -> List[Dict]:
+    items = []
+    for raw in raw_items:
+        try:
+            items.append(record_codec.decode(raw))
+        except Exception:
+            continue
+    return items
+
+
+def _confidence_field(value, confidence: float) -> str:
+    return json.dumps({"value": value, "confidence": confidence}, ensure_ascii=False)
+
+
+def analyze_user(payload: Dict, inference_service: Optional[UserInferenceService] = None) -> Dict:
+    """分析单个用户（可在进程池中执行）
+
+    payload 字段：
+        user_id, dictionary_version
+        rebuild, stored_counts: 关键词计数是否重建、已累计的计数
+        new_messages: 检查点之后的新消息（原始 JSON）
+        recent_messages: 最近的聊天消息（原始 JSON），用于沟通风格和情感分析
+        current_occupation, current_interests: 画像中的当前值
+
+    返回需要写回的数据：new_counts（新增关键词计数）、fields（画像字段）、
+    interests（合并后的兴趣标签，无变化时为 None）
+    """
+    service = inference_service or _get_inference_service()
+    result = {
+        "user_id": payload["user_id"],
+        "dictionary_version": service.dictionary_version,
+        "new_counts": {},
+        "fields": {},
+        "interests": None,
+        "message_count": len(payload["recent_messages"])
+    }
+
+    # 消息太少时不做规则推测
+    messages = _parse_list(payload["recent_messages"])
+    if len(messages) < 2 or service.dictionary_version != payload["dictionary_version"]:
+        return result
+
+    # 推测基础属性（关键词计数按新消息增量累加）
+    new_counts = service.count_keywords(
+        msg["content"] for msg in _parse_list(payload["new_messages"]) if msg.get("role") == "user"
+    )
+    counts = {} if payload["rebuild"] else {
+        _decode(k): int(v) for k, v in payload["stored_counts"].items() if not _decode(k).startswith("_")
+    }
+    for keyword, count in new_counts.items():
+        counts[keyword] = counts.get(keyword, 0) + count
+    result["new_counts"] = new_counts
+    inference_result = service.infer_from_counts(counts)
+    fields = result["fields"]
+
+    # 职业：新数据或更高置信度才更新
+    if inference_result.get("occupation"):
+        occupation, confidence = inference_result["occupation"]
+        if confidence > 0.5 and (not payload["current_occupation"] or confidence > 0.6):
+            fields["occupation_data"] = _confidence_field(occupation, confidence)
+
+    # 年龄段
+    if inference_result.get("age_range"):
+        age_range, confidence = inference_result["age_range"]
+        if confidence > 0.4:
+            fields["age_data"] = _confidence_field(age_range, confidence)
+
+    # 性别
+    if inference_result.get("gender"):
+        gender, confidence = inference_result["gender"]
+        if confidence > 0.5:
+            fields["gender_data"] = _confidence_field(gender, confidence)
+
+    # 兴趣标签（累积）
+    interests_to_add = [interest for interest, weight in inference_result.get("interests") or []]
+    if interests_to_add:
+        current_interests = []
+        if payload["current_interests"]:
+            try:
+                current_interests = json.loads(_decode(payload["current_interests"]))
+            except Exception:
+                pass
+        result["interests"] = list(set(current_interests + interests_to_add))
+
+    # 最近消息的关键词只统计一遍，沟通风格和情感分析共用
+    window_counts = service.count_keywords(msg["content"] for msg in messages if msg.get("role") == "user")
+
+    comm_style = service.analyze_communication_style(messages, window_counts)
+    if comm_style:
+        fields["communication_style"] = json.dumps(comm_style, ensure_ascii=False)
+
+    emotional = service.analyze_emotional_patterns(messages, window_counts)
+    if emotional:
+        fields["emotional_pattern"] = json.dumps(emotional, ensure_ascii=False)
+
+    return result
@@ -0,0 +1,102 @@
+"""
+提示词组装
+按 token 预算（而不是固定消息条数）打包发送给模型的消息：
+- 宠物人设（第一条 system）和当前用户消息始终保留
+- 其余 system 消息（用户画像、上次会话总结）放得下才加入
+- 剩余预算从最近的对话往前填充
+token 数用本地估算器计算，可替换为 tiktoken 等更精确的实现
+"""
+
+import os
+import re
+from typing import Callable, Dict, List
+
+# 中日韩文字、全角标点大致一个字符一个 token
+_CJK_PATTERN = re.compile(
+    "[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]"
+)
+
+MESSAGE_OVERHEAD_TOKENS = 4  # 每条消息的角色和分隔符
+REPLY_PRIMING_TOKENS = 3     # 助手回复的起始标记
+
+
+def estimate_tokens(text: str) -> int:
+    """启发式 token 估算：CJK 字符按 1 个计，其余按 4 个字符 1 个计"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    other = len(text) - cjk
+    return cjk + (other + 3) // 4
+
+
+def get_token_estimator(name: str = None) -> Callable[[str], int]:
+    """按名称获取 token 估算器（AI_TOKEN_ESTIMATOR=heuristic|tiktoken）"""
+    name = (name or os.getenv("AI_TOKEN_ESTIMATOR", "heuristic")).lower()
+
+    if name == "tiktoken":
+        try:
+            import tiktoken
+            encoding = tiktoken.get_encoding(os.getenv("AI_TIKTOKEN_ENCODING", "cl100k_base"))
+            return lambda text: len(encoding.encode(text or ""))
+        except Exception as e:
+            print(f"⚠️  tiktoken 不可用，使用启发式 token 估算: {str(e)}")
+
+    return estimate_tokens
+
+
+class PromptBuilder:
+    """按 token 预算裁剪消息列表"""
+
+    def __init__(self, estimator: Callable[[str], int] = None):
+        self.estimator = estimator or get_token_estimator()
+        self.default_budget = int(os.getenv("AI_PROMPT_TOKEN_BUDGET", 3000))
+
+    def budget_for(self, provider_name: str) -> int:
+        """提供商的提示词预算（<PROVIDER>_PROMPT_TOKEN_BUDGET，未设置时使用全局预算）"""
+        return int(os.getenv(f"{provider_name.upper()}_PROMPT_TOKEN_BUDGET", self.default_budget))
+
+    def message_tokens(self, message: Dict) -> int:
+        return self.estimator(message.get("content", "")) + MESSAGE_OVERHEAD_TOKENS
+
+    def count(self, messages: List[Dict]) -> int:
+        """消息列表的估算 token 数"""
+        return sum(self.message_tokens(msg) for msg in messages) + REPLY_PRIMING_TOKENS
+
+    def fit(self, messages: List[Dict], budget: int) -> List[Dict]:
+        """把消息列表裁剪到预算内
+
+        messages 由 system 消息、历史对话和最后一条当前用户消息组成。
+        人设和当前消息即使超出预算也会保留。
+        """
+        system_messages = [msg for msg in messages if msg.get("role") == "system"]
+        turns = [msg for msg in messages if msg.get("role") != "system"]
+        if not turns:
+            return system_messages
+
+        current, history = turns[-1], turns[:-1]
+        kept_system = system_messages[:1]
+        used = REPLY_PRIMING_TOKENS + self.message_tokens(current)
+        used += sum(self.message_tokens(msg) for msg in kept_system)
+
+        # 画像、总结等补充信息放得下才加入
+        for msg in system_messages[1:]:
+            tokens = self.message_tokens(msg)
+            if used + tokens <= budget:
+                kept_system.append(msg)
+                used += tokens
+
+        # 从最近的对话往前填充，遇到放不下的就停止，保证上下文连续
+        kept_history = []
+        for msg in reversed(history):
+            tokens = self.message_tokens(msg)
+            if used + tokens > budget:
+                break
+            kept_history.append(msg)
+            used += tokens
+        kept_history.reverse()
+
+        # 不以孤立的助手回复开头
+        if kept_history and kept_history[0].get("role") == "assistant":
+            kept_history.pop(0)
+
+        return kept_system + kept_history + [current]
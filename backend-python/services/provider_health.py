@@ -0,0 +1,120 @@
+"""
+AI 服务提供商健康状态
+每个提供商一个熔断器（closed / open / half_open），并用 EWMA 跟踪调用延迟，
+用于在提供商故障或变慢时绕开它，而不必每次请求都等待超时
+"""
+
+import os
+import time
+from collections import deque
+from typing import Dict, Optional
+
+
+class ProviderHealth:
+    """单个提供商的熔断器和延迟统计"""
+
+    CLOSED = "closed"        # 正常，允许请求
+    OPEN = "open"            # 熔断中，直接跳过
+    HALF_OPEN = "half_open"  # 冷却结束，放行一个探测请求
+
+    def __init__(self, name: str):
+        self.name = name
+        self.failure_threshold = int(os.getenv("AI_BREAKER_FAILURE_THRESHOLD", 3))
+        self.cooldown = float(os.getenv("AI_BREAKER_COOLDOWN", 30))
+        self.ewma_alpha = float(os.getenv("AI_LATENCY_EWMA_ALPHA", 0.3))
+        self.slow_threshold = float(os.getenv("AI_SLOW_THRESHOLD", 8))
+
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.probe_in_flight = False
+
+        self.ewma_latency: Optional[float] = None
+        self.recent_latencies = deque(maxlen=100)  # 最近成功调用的延迟，用于分位数
+        self.total_requests = 0
+        self.total_failures = 0
+
+    # ==================== 熔断状态 ====================
+
+    def is_available(self) -> bool:
+        """当前是否可以向该提供商发送请求（不改变状态）"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at >= self.cooldown
+        return not self.probe_in_flight
+
+    def acquire(self):
+        """开始一次请求；冷却结束的熔断器进入半开状态，只放行这一个探测请求"""
+        if self.state == self.OPEN:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            self.probe_in_flight = True
+        self.total_requests += 1
+
+    def record_success(self, latency: float):
+        """记录一次成功调用"""
+        self._update_latency(latency)
+        self.recent_latencies.append(latency)
+        self.consecutive_failures = 0
+        self.probe_in_flight = False
+        if self.state != self.CLOSED:
+            print(f"🟢 {self.name} 熔断器恢复")
+        self.state = self.CLOSED
+        self.opened_at = None
+
+    def record_cancelled(self):
+        """请求被取消（如对冲请求落败），不计入成败，只释放探测名额"""
+        self.probe_in_flight = False
+
+    def record_failure(self, latency: Optional[float] = None):
+        """记录一次失败调用（超时的耗时同样计入延迟）"""
+        if latency is not None:
+            self._update_latency(latency)
+        self.consecutive_failures += 1
+        self.total_failures += 1
+        self.probe_in_flight = False
+
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                print(f"🔴 {self.name} 熔断器打开，{int(self.cooldown)}秒内跳过该服务")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    # ==================== 延迟统计 ====================
+
+    def _update_latency(self, latency: float):
+        if self.ewma_latency is None:
+            self.ewma_latency = latency
+        else:
+            self.ewma_latency = self.ewma_alpha * latency + (1 - self.ewma_alpha) * self.ewma_latency
+
+    def latency_percentile(self, percentile: float, min_samples: int = 10) -> Optional[float]:
+        """最近调用延迟的分位数（样本不足时返回 None）"""
+        if len(self.recent_latencies) < min_samples:
+            return None
+        ordered = sorted(self.recent_latencies)
+        index = min(int(len(ordered) * percentile), len(ordered) - 1)
+        return ordered[index]
+
+    def is_slow(self) -> bool:
+        """EWMA 延迟是否超过慢服务阈值"""
+        return self.ewma_latency is not None and self.ewma_latency > self.slow_threshold
+
+    def to_dict(self) -> Dict:
+        """健康状态（用于 /health 展示）"""
+        p95 = self.latency_percentile(0.95)
+        cooldown_remaining = 0.0
+        if self.state == self.OPEN:
+            cooldown_remaining = max(self.cooldown - (time.monotonic() - self.opened_at), 0.0)
+
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "cooldown_remaining": round(cooldown_remaining, 1),
+            "ewma_latency": round(self.ewma_latency, 3) if self.ewma_latency is not None else None,
+            "p95_latency": round(p95, 3) if p95 is not None else None,
+            "slow": self.is_slow(),
+            "total_requests": self.total_requests,
+            "total_failures": self.total_failures
+        }
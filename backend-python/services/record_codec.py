@@ -0,0 +1,100 @@
+"""
+列表记录的存储编码
+聊天历史（user:{id}:chat_history）、会话上下文（session:{id}:context）和行为记录（user:{id}:behaviors）
+的每个条目由本模块编码和解码：
+- msgpack（默认）：短键（role -> r, content -> c, timestamp -> ts, type -> t, metadata -> m），
+  不带时区的 ISO 时间戳存为 epoch 毫秒（按时间戳本身的日期时间换算，不做时区转换），文本按 UTF-8 原样存储
+- json：原格式，用于回滚到只能读取 JSON 的旧版本
+
+读取时按首字节识别格式，旧的 JSON 条目和新的 msgpack 条目可以在同一个列表中共存
+"""
+
+import json
+import os
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Dict, Iterable, List
+
+import msgpack
+
+RECORD_CODEC = os.getenv("RECORD_CODEC", "msgpack").strip().lower()
+
+_SHORT_KEYS = {"role": "r", "content": "c", "timestamp": "ts", "type": "t", "metadata": "m"}
+_LONG_KEYS = {short: key for key, short in _SHORT_KEYS.items()}
+
+_EPOCH = datetime(1970, 1, 1)
+_ONE_MS = timedelta(milliseconds=1)
+
+
+def _timestamp_to_ms(value):
+    """不带时区的 ISO 时间戳 -> epoch 毫秒，其他值原样返回"""
+    if not isinstance(value, str):
+        return value
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError:
+        return value
+    if dt.tzinfo is not None:
+        return value
+    return (dt - _EPOCH) // _ONE_MS
+
+
+@lru_cache(maxsize=4096)
+def _format_second(seconds: int) -> str:
+    # 同一回合、同一批次的条目时间戳相同，按秒缓存格式化结果
+    return (_EPOCH + timedelta(seconds=seconds)).isoformat()
+
+
+def _ms_to_timestamp(ms: int) -> str:
+    seconds, millis = divmod(ms, 1000)
+    return f"{_format_second(seconds)}.{millis:03d}"
+
+
+def _encode_msgpack(record: Dict) -> bytes:
+    if not all(key in _SHORT_KEYS for key in record):
+        return _encode_json(record)  # 键不在短键表中的记录保持 JSON 格式
+
+    packed = {}
+    for key, value in record.items():
+        if key == "timestamp":
+            value = _timestamp_to_ms(value)
+        packed[_SHORT_KEYS[key]] = value
+    try:
+        return msgpack.packb(packed, use_bin_type=True)
+    except (TypeError, ValueError, OverflowError):
+        return _encode_json(record)
+
+
+def _encode_json(record: Dict) -> bytes:
+    return json.dumps(record).encode("utf-8")
+
+
+def encode(record: Dict) -> bytes:
+    """编码一条记录（按 RECORD_CODEC 选择格式）"""
+    if RECORD_CODEC == "json":
+        return _encode_json(record)
+    return _encode_msgpack(record)
+
+
+def encode_many(records: Iterable[Dict]) -> List[bytes]:
+    return [encode(record) for record in records]
+
+
+def decode(raw) -> Dict:
+    """解码一条记录（JSON 或 msgpack），格式错误时抛出异常"""
+    if isinstance(raw, str) or raw[:1] == b"{":
+        return json.loads(raw)
+
+    packed = msgpack.unpackb(raw, raw=False, strict_map_key=False)
+    if not isinstance(packed, dict):
+        raise ValueError("记录必须是映射")
+    record = {_LONG_KEYS.get(key, key): value for key, value in packed.items()}
+    timestamp = record.get("timestamp")
+    if isinstance(timestamp, int) and not isinstance(timestamp, bool):
+        record["timestamp"] = _ms_to_timestamp(timestamp)
+    return record
+
+
+def decode_many(raw_items: Iterable) -> List[Dict]:
+    """解码一组记录，任一条目格式错误时抛出异常"""
+    return [decode(raw) for raw in raw_items]
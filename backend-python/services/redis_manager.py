@@ -3,6 +3,7 @@ Redis 连接管理器
 """
 
 import redis
+import redis.asyncio as aioredis
 import os
 from typing import Optional
 
@@ -11,30 +12,35 @@ class RedisManager:
     """Redis 连接管理器"""
     
     _instance: Optional[redis.Redis] = None
+    _async_instance: Optional[aioredis.Redis] = None
+    _fake_server = None  # FakeRedis 内存模式下同步/异步客户端共享的数据
+    
+    @staticmethod
+    def _connection_params() -> dict:
+        """从环境变量读取连接参数"""
+        connection_params = {
+            "host": os.getenv("REDIS_HOST", "localhost"),
+            "port": int(os.getenv("REDIS_PORT", 6379)),
+            "db": int(os.getenv("REDIS_DB", 0)),
+            "decode_responses": False,  # 手动处理解码
+            "socket_connect_timeout": 5,
+            "socket_timeout": 5,
+            "retry_on_timeout": True
+        }
+        
+        redis_password = os.getenv("REDIS_PASSWORD", None)
+        if redis_password:
+            connection_params["password"] = redis_password
+        
+        return connection_params
     
     @classmethod
     def get_client(cls) -> redis.Redis:
         """获取 Redis 客户端（单例模式）"""
         if cls._instance is None:
-            # 从环境变量读取配置
-            redis_host = os.getenv("REDIS_HOST", "localhost")
-            redis_port = int(os.getenv("REDIS_PORT", 6379))
-            redis_db = int(os.getenv("REDIS_DB", 0))
-            redis_password = os.getenv("REDIS_PASSWORD", None)
-            
-            # 连接参数
-            connection_params = {
-                "host": redis_host,
-                "port": redis_port,
-                "db": redis_db,
-                "decode_responses": False,  # 手动处理解码
-                "socket_connect_timeout": 5,
-                "socket_timeout": 5,
-                "retry_on_timeout": True
-            }
-            
-            if redis_password:
-                connection_params["password"] = redis_password
+            connection_params = cls._connection_params()
+            redis_host = connection_params["host"]
+            redis_port = connection_params["port"]
             
             try:
                 cls._instance = redis.Redis(**connection_params)
@@ -47,7 +53,8 @@ class RedisManager:
                 # 使用 fakeredis 作为备选方案
                 try:
                     import fakeredis
-                    cls._instance = fakeredis.FakeRedis(decode_responses=False)
+                    cls._fake_server = fakeredis.FakeServer()
+                    cls._instance = fakeredis.FakeRedis(server=cls._fake_server, decode_responses=False)
                     print("✅ 使用 FakeRedis 内存模式")
                 except ImportError:
                     print("⚠️  请安装 fakeredis: pip install fakeredis")
@@ -56,6 +63,55 @@ class RedisManager:
         
         return cls._instance
     
+    @classmethod
+    def get_async_client(cls) -> aioredis.Redis:
+        """获取异步 Redis 客户端（单例模式，有界连接池）
+        
+        供 FastAPI 请求处理路径使用，避免同步网络往返阻塞事件循环。
+        连接池满时请求会等待空闲连接，而不是无限创建新连接。
+        """
+        if cls._async_instance is None:
+            # 先确定连接模式（真实 Redis / FakeRedis 内存模式）
+            cls.get_client()
+            
+            if cls._fake_server is not None:
+                from fakeredis import aioredis as fake_aioredis
+                cls._async_instance = fake_aioredis.FakeRedis(
+                    server=cls._fake_server, decode_responses=False
+                )
+            elif isinstance(cls._instance, FallbackRedis):
+                raise RuntimeError("内存备用模式不支持异步客户端，请安装 fakeredis 或启动 Redis")
+            else:
+                pool = aioredis.BlockingConnectionPool(
+                    max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", 50)),
+                    timeout=float(os.getenv("REDIS_POOL_TIMEOUT", 5)),
+                    **cls._connection_params()
+                )
+                cls._async_instance = aioredis.Redis(connection_pool=pool)
+                print(f"✅ 异步 Redis 连接池已创建 (最大连接数: {pool.max_connections})")
+        
+        return cls._async_instance
+    
+    @classmethod
+    def create_blocking_async_client(cls) -> aioredis.Redis:
+        """创建供阻塞命令（BLPOP）使用的独立异步客户端
+        
+        不设置读超时，避免阻塞等待被 socket_timeout 打断；
+        不共享连接池，阻塞中的连接不会占用请求处理路径的连接。
+        调用方需在自己的事件循环中使用并负责关闭。
+        """
+        cls.get_client()
+        
+        if cls._fake_server is not None:
+            from fakeredis import aioredis as fake_aioredis
+            return fake_aioredis.FakeRedis(server=cls._fake_server, decode_responses=False)
+        if isinstance(cls._instance, FallbackRedis):
+            raise RuntimeError("内存备用模式不支持阻塞命令，请安装 fakeredis 或启动 Redis")
+        
+        connection_params = cls._connection_params()
+        connection_params["socket_timeout"] = None
+        return aioredis.Redis(**connection_params)
+    
     @classmethod
     def close(cls):
         """关闭连接"""
@@ -66,6 +122,17 @@ class RedisManager:
             except:
                 pass
             cls._instance = None
+    
+    @classmethod
+    async def close_async(cls):
+        """关闭异步连接池"""
+        if cls._async_instance:
+            try:
+                await cls._async_instance.aclose()
+                print("✅ 异步 Redis 连接池已关闭")
+            except:
+                pass
+            cls._async_instance = None
 
 
 class FallbackRedis:
@@ -4,33 +4,112 @@
 """
 
 import redis
+import redis.asyncio as aioredis
 import json
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
 import uuid
 
+from services import record_codec
+from services.summary_queue import SummaryQueue
+
+SESSION_TTL = 24 * 3600
+SUMMARY_TTL = 30 * 24 * 3600  # 会话总结保留30天
+SUMMARY_EVERY = 10  # 每10条消息触发一次会话总结
+
+# 追加会话消息：写入上下文、刷新过期时间、更新活跃时间和消息计数，
+# 并判断本次追加是否跨过总结阈值（整个过程在服务端原子执行）
+# KEYS: 会话哈希, 会话上下文, [用户活跃会话标记]
+# ARGV: 过期秒数, 活跃时间, 总结间隔, 消息...
+APPEND_MESSAGES_SCRIPT = """
+local ttl = tonumber(ARGV[1])
+local every = tonumber(ARGV[3])
+local added = #ARGV - 3
+
+for i = 4, #ARGV do
+    redis.call('RPUSH', KEYS[2], ARGV[i])
+end
+redis.call('EXPIRE', KEYS[2], ttl)
+redis.call('HSET', KEYS[1], 'last_active', ARGV[2])
+local count = redis.call('HINCRBY', KEYS[1], 'message_count', added)
+redis.call('EXPIRE', KEYS[1], ttl)
+if KEYS[3] then
+    redis.call('EXPIRE', KEYS[3], ttl)
+end
+
+local due = 0
+if math.floor(count / every) > math.floor((count - added) / every) then
+    due = 1
+end
+return {count, due}
+"""
+
+# 保存会话总结：拒绝令牌更小的旧写入，记录总结位置并更新会话状态
+# KEYS: 会话总结, 会话哈希, 会话上下文
+# ARGV: 防护令牌（0 表示不校验）, 过期秒数, 字段, 值, ...
+SAVE_SUMMARY_SCRIPT = """
+local token = tonumber(ARGV[1])
+if token > 0 then
+    local current = tonumber(redis.call('HGET', KEYS[1], 'fencing_token') or '0')
+    if current > token then
+        return -1
+    end
+end
+
+local count = redis.call('LLEN', KEYS[3])
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('HSET', KEYS[1], 'message_count_at_summary', count)
+if token > 0 then
+    redis.call('HSET', KEYS[1], 'fencing_token', token)
+end
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]))
+
+redis.call('HSET', KEYS[2], 'status', 'summarized')
+redis.call('HSET', KEYS[2], 'last_summarized_message_count', count)
+return count
+"""
+
 
 class SessionManager:
-    """会话管理器 - 区分短期上下文和长期画像"""
+    """会话管理器 - 区分短期上下文和长期画像
+    
+    同步方法供后台任务线程使用；`*_async` 方法使用异步客户端，
+    供 FastAPI 请求处理路径使用，避免阻塞事件循环。
+    """
     
-    def __init__(self, redis_client: redis.Redis):
+    def __init__(self, redis_client: redis.Redis, async_redis: Optional[aioredis.Redis] = None):
         self.redis = redis_client
+        self.async_redis = async_redis
+        
+        # 服务端脚本（EVALSHA，脚本缓存丢失时自动重新加载）
+        self._append_script = redis_client.register_script(APPEND_MESSAGES_SCRIPT)
+        self._save_summary_script = redis_client.register_script(SAVE_SUMMARY_SCRIPT)
+        self._append_script_async = (
+            async_redis.register_script(APPEND_MESSAGES_SCRIPT) if async_redis is not None else None
+        )
+        self.summary_queue = SummaryQueue(redis_client, async_redis)
         
     # ==================== 会话生命周期管理 ====================
     
-    def create_session(self, user_id: str) -> str:
-        """创建新会话"""
-        session_id = str(uuid.uuid4())
-        session_key = f"session:{session_id}"
-        
-        session_data = {
-            "session_id": session_id,
+    @staticmethod
+    def _new_session_data(user_id: str) -> Dict:
+        """生成新会话的初始数据"""
+        return {
+            "session_id": str(uuid.uuid4()),
             "user_id": user_id,
             "start_time": datetime.now().isoformat(),
             "last_active": datetime.now().isoformat(),
             "message_count": "0",
             "status": "active"  # active, ended, summarized
         }
+    
+    def create_session(self, user_id: str) -> str:
+        """创建新会话"""
+        session_data = self._new_session_data(user_id)
+        session_id = session_data["session_id"]
+        session_key = f"session:{session_id}"
         
         self.redis.hset(session_key, mapping=session_data)
         self.redis.expire(session_key, 24 * 3600)  # 24小时过期
@@ -40,6 +119,20 @@ class SessionManager:
         
         return session_id
     
+    async def create_session_async(self, user_id: str) -> str:
+        """创建新会话（异步版本，单次流水线往返）"""
+        session_data = self._new_session_data(user_id)
+        session_id = session_data["session_id"]
+        session_key = f"session:{session_id}"
+        
+        pipe = self.async_redis.pipeline(transaction=True)
+        pipe.hset(session_key, mapping=session_data)
+        pipe.expire(session_key, SESSION_TTL)  # 24小时过期
+        pipe.set(f"user:{user_id}:active_session", session_id, ex=SESSION_TTL)
+        await pipe.execute()
+        
+        return session_id
+    
     def get_active_session(self, user_id: str) -> Optional[str]:
         """获取用户的活跃会话"""
         session_id = self.redis.get(f"user:{user_id}:active_session")
@@ -47,6 +140,13 @@ class SessionManager:
             return session_id.decode() if isinstance(session_id, bytes) else session_id
         return None
     
+    async def get_active_session_async(self, user_id: str) -> Optional[str]:
+        """获取用户的活跃会话（异步版本）"""
+        session_id = await self.async_redis.get(f"user:{user_id}:active_session")
+        if session_id:
+            return session_id.decode() if isinstance(session_id, bytes) else session_id
+        return None
+    
     def get_or_create_session(self, user_id: str) -> str:
         """获取或创建会话"""
         session_id = self.get_active_session(user_id)
@@ -54,16 +154,22 @@ class SessionManager:
         if session_id:
             # 检查会话是否过期（超过30分钟无活动）
             last_active = self.get_session_last_active(session_id)
-            if last_active:
-                inactive_time = datetime.now() - datetime.fromisoformat(last_active)
-                if inactive_time.total_seconds() > 1800:  # 30分钟
-                    # 会话过期，结束并创建新会话
-                    self.end_session(session_id)
-                    return self.create_session(user_id)
+            if self.is_session_expired(last_active):
+                # 会话过期，结束并创建新会话
+                self.end_session(session_id)
+                return self.create_session(user_id)
             return session_id
         
         return self.create_session(user_id)
     
+    @staticmethod
+    def is_session_expired(last_active: Optional[str]) -> bool:
+        """判断会话是否因长时间无活动而过期（超过30分钟）"""
+        if not last_active:
+            return False
+        inactive_time = datetime.now() - datetime.fromisoformat(last_active)
+        return inactive_time.total_seconds() > 1800
+    
     def update_session_activity(self, session_id: str):
         """更新会话活跃时间"""
         session_key = f"session:{session_id}"
@@ -90,11 +196,33 @@ class SessionManager:
             user_id = session_data.get('user_id')
             self.redis.delete(f"user:{user_id}:active_session")
     
+    async def end_session_async(self, session_id: str):
+        """结束会话（异步版本）"""
+        session_key = f"session:{session_id}"
+        await self.async_redis.hset(session_key, mapping={
+            "status": "ended",
+            "end_time": datetime.now().isoformat()
+        })
+        
+        # 移除活跃会话标记
+        session_data = await self.get_session_data_async(session_id)
+        if session_data:
+            user_id = session_data.get('user_id')
+            await self.async_redis.delete(f"user:{user_id}:active_session")
+    
     def get_session_data(self, session_id: str) -> Optional[Dict]:
         """获取会话数据"""
         session_key = f"session:{session_id}"
-        data = self.redis.hgetall(session_key)
-        
+        return self._decode_hash(self.redis.hgetall(session_key))
+    
+    async def get_session_data_async(self, session_id: str) -> Optional[Dict]:
+        """获取会话数据（异步版本）"""
+        session_key = f"session:{session_id}"
+        return self._decode_hash(await self.async_redis.hgetall(session_key))
+    
+    @staticmethod
+    def _decode_hash(data: Dict) -> Optional[Dict]:
+        """解码 Redis 哈希"""
         if not data:
             return None
         
@@ -106,34 +234,56 @@ class SessionManager:
     
     # ==================== 短期上下文管理 ====================
     
-    def add_message_to_session(self, session_id: str, role: str, content: str):
-        """添加消息到会话上下文"""
-        context_key = f"session:{session_id}:context"
-        
+    @staticmethod
+    def _append_args(session_id: str, messages: List[Dict], user_id: Optional[str]):
+        keys = [f"session:{session_id}", f"session:{session_id}:context"]
+        if user_id:
+            keys.append(f"user:{user_id}:active_session")
+        args = [SESSION_TTL, datetime.now().isoformat(), SUMMARY_EVERY]
+        args.extend(record_codec.encode_many(messages))
+        return keys, args
+    
+    def append_messages(self, session_id: str, messages: List[Dict], user_id: Optional[str] = None) -> Dict:
+        """原子追加会话消息，返回新的消息数和是否应触发总结（一次往返）"""
+        keys, args = self._append_args(session_id, messages, user_id)
+        message_count, summary_due = self._append_script(keys=keys, args=args)
+        return {"message_count": int(message_count), "summary_due": bool(summary_due)}
+    
+    async def append_messages_async(self, session_id: str, messages: List[Dict], user_id: Optional[str] = None) -> Dict:
+        """原子追加会话消息（异步版本）"""
+        keys, args = self._append_args(session_id, messages, user_id)
+        message_count, summary_due = await self._append_script_async(keys=keys, args=args)
+        return {"message_count": int(message_count), "summary_due": bool(summary_due)}
+    
+    def add_message_to_session(self, session_id: str, role: str, content: str) -> Dict:
+        """添加消息到会话上下文，返回新的消息数和是否应触发总结"""
         message = {
             "role": role,
             "content": content,
             "timestamp": datetime.now().isoformat()
         }
-        
-        self.redis.rpush(context_key, json.dumps(message))
-        self.redis.expire(context_key, 24 * 3600)
-        
-        self.update_session_activity(session_id)
+        return self.append_messages(session_id, [message])
     
     def get_session_context(self, session_id: str, limit: int = 20) -> List[Dict]:
         """获取会话上下文（最近N条消息）"""
         context_key = f"session:{session_id}:context"
         messages = self.redis.lrange(context_key, -limit, -1)
         
-        return [json.loads(msg) for msg in messages]
+        return record_codec.decode_many(messages)
+    
+    async def get_session_context_async(self, session_id: str, limit: int = 20) -> List[Dict]:
+        """获取会话上下文（异步版本）"""
+        context_key = f"session:{session_id}:context"
+        messages = await self.async_redis.lrange(context_key, -limit, -1)
+        
+        return record_codec.decode_many(messages)
     
     def get_full_session_context(self, session_id: str) -> List[Dict]:
         """获取完整会话上下文"""
         context_key = f"session:{session_id}:context"
         messages = self.redis.lrange(context_key, 0, -1)
         
-        return [json.loads(msg) for msg in messages]
+        return record_codec.decode_many(messages)
     
     def get_new_session_context(self, session_id: str) -> List[Dict]:
         """获取自上次总结后的新消息（增量）"""
@@ -154,15 +304,18 @@ class SessionManager:
             messages = self.redis.lrange(context_key, 0, -1)
             print(f"  📊 首次总结：分析全部 {len(messages)} 条消息")
         
-        return [json.loads(msg) for msg in messages]
+        return record_codec.decode_many(messages)
     
     def get_last_summary_context(self, session_id: str) -> Optional[str]:
         """获取上次总结的简要内容（用于提供上下文）"""
-        summary = self.get_session_summary(session_id)
+        return self.format_summary_context(self.get_session_summary(session_id))
+    
+    @staticmethod
+    def format_summary_context(summary: Optional[Dict]) -> Optional[str]:
+        """提取会话总结的关键信息作为上下文"""
         if not summary:
             return None
         
-        # 提取关键信息作为上下文
         context_parts = []
         
         interests = summary.get('interests_mentioned', [])
@@ -182,73 +335,73 @@ class SessionManager:
     # ==================== 会话总结标记 ====================
     
     def mark_session_for_summary(self, session_id: str):
-        """标记会话需要总结（异步任务会处理）"""
-        summary_queue_key = "session:summary_queue"
-        
-        summary_task = {
-            "session_id": session_id,
-            "queued_at": datetime.now().isoformat(),
-            "status": "pending"
-        }
-        
-        # 添加到总结队列（去重）
-        self.redis.sadd(summary_queue_key, json.dumps(summary_task))
+        """标记会话需要总结（异步任务会处理，同一会话只排队一次）"""
+        self.summary_queue.mark(session_id)
     
-    def get_sessions_to_summarize(self) -> List[Dict]:
-        """获取待总结的会话列表"""
-        summary_queue_key = "session:summary_queue"
-        tasks = self.redis.smembers(summary_queue_key)
-        
-        return [json.loads(task) for task in tasks]
+    async def mark_session_for_summary_async(self, session_id: str):
+        """标记会话需要总结（异步版本）"""
+        await self.summary_queue.mark_async(session_id)
+    
+    def get_sessions_to_summarize(self, limit: int = 10) -> List[Dict]:
+        """领取待总结的会话（领取后需 remove_from_summary_queue 确认或 fail_summary 失败）"""
+        return self.summary_queue.claim(limit)
     
     def remove_from_summary_queue(self, session_id: str):
-        """从总结队列中移除"""
-        summary_queue_key = "session:summary_queue"
-        tasks = self.redis.smembers(summary_queue_key)
-        
-        for task in tasks:
-            task_data = json.loads(task)
-            if task_data.get("session_id") == session_id:
-                self.redis.srem(summary_queue_key, task)
-                break
-    
-    def save_session_summary(self, session_id: str, summary: Dict):
-        """保存会话总结"""
+        """确认会话总结完成，从队列中移除"""
+        self.summary_queue.ack(session_id)
+    
+    def fail_summary(self, session_id: str, error: str) -> bool:
+        """会话总结失败：退避后重试，超过最大次数进入死信列表"""
+        return self.summary_queue.fail(session_id, error)
+    
+    def save_session_summary(self, session_id: str, summary: Dict, fencing_token: Optional[int] = None) -> bool:
+        """保存会话总结
+        
+        带防护令牌时，比已保存总结的令牌更小的写入会被拒绝（租约过期后的旧持有者），
+        返回是否已保存。
+        """
         summary_key = f"session:{session_id}:summary"
         session_key = f"session:{session_id}"
         context_key = f"session:{session_id}:context"
         
-        # 获取当前消息数量，记录总结位置
-        current_message_count = self.redis.llen(context_key)
-        
         summary_data = {
             **summary,
-            "summarized_at": datetime.now().isoformat(),
-            "message_count_at_summary": current_message_count  # 记录总结时的消息数量
+            "summarized_at": datetime.now().isoformat()
         }
         
         # 将嵌套字典转换为JSON字符串
-        flat_summary = {}
+        args = [fencing_token or 0, SUMMARY_TTL]
         for k, v in summary_data.items():
+            args.append(k)
             if isinstance(v, (dict, list)):
-                flat_summary[k] = json.dumps(v, ensure_ascii=False)
+                args.append(json.dumps(v, ensure_ascii=False))
             else:
-                flat_summary[k] = str(v)
+                args.append(str(v))
         
-        self.redis.hset(summary_key, mapping=flat_summary)
-        self.redis.expire(summary_key, 30 * 24 * 3600)  # 保留30天
-        
-        # 更新会话状态和最后总结位置
-        self.redis.hset(session_key, "status", "summarized")
-        self.redis.hset(session_key, "last_summarized_message_count", str(current_message_count))
+        # 校验令牌、写入总结、记录总结位置（当前消息数量）在服务端原子完成
+        current_message_count = self._save_summary_script(
+            keys=[summary_key, session_key, context_key], args=args
+        )
+        if current_message_count < 0:
+            print(f"  ⚠️  会话 {session_id[:8]} 已有更新的总结，丢弃本次结果（令牌 {fencing_token}）")
+            return False
         
         print(f"  ✅ 已记录总结位置: {current_message_count} 条消息")
+        return True
     
     def get_session_summary(self, session_id: str) -> Optional[Dict]:
         """获取会话总结"""
         summary_key = f"session:{session_id}:summary"
-        data = self.redis.hgetall(summary_key)
-        
+        return self._parse_summary(self.redis.hgetall(summary_key))
+    
+    async def get_session_summary_async(self, session_id: str) -> Optional[Dict]:
+        """获取会话总结（异步版本）"""
+        summary_key = f"session:{session_id}:summary"
+        return self._parse_summary(await self.async_redis.hgetall(summary_key))
+    
+    @staticmethod
+    def _parse_summary(data: Dict) -> Optional[Dict]:
+        """解析会话总结哈希"""
         if not data:
             return None
         
@@ -268,7 +421,11 @@ class SessionManager:
     # ==================== 会话触发条件检查 ====================
     
     def should_trigger_summary(self, session_id: str) -> bool:
-        """检查是否应该触发总结"""
+        """检查是否应该触发总结
+        
+        追加消息时请直接使用 append_messages 返回的 summary_due，
+        避免并发回合之间重复或漏掉触发。
+        """
         session_data = self.get_session_data(session_id)
         
         if not session_data:
@@ -277,7 +434,7 @@ class SessionManager:
         message_count = int(session_data.get('message_count', 0))
         
         # 条件1: 消息数达到10/20/30条
-        if message_count > 0 and message_count % 10 == 0:
+        if message_count > 0 and message_count % SUMMARY_EVERY == 0:
             return True
         
         return False
@@ -0,0 +1,173 @@
+"""
+会话总结执行器
+从总结队列领取任务并发执行，队列积压时不再一次只等一个 LLM 往返：
+- 全局并发上限，以及每个 AI 提供商的并发上限
+- 每个任务有超时，超时或失败交给队列退避重试
+- 遇到限流时暂停领取新任务，等待一段时间后再继续
+- 统计队列深度、执行中数量和消化速率
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Set
+
+from services.summary_queue import SummaryQueue
+from services.task_lease import LeaseHeldError
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    error_str = str(error).lower()
+    return "rate limit" in error_str or "429" in error_str
+
+
+class SummaryExecutor:
+    """有界并发的会话总结执行器（在后台任务的事件循环中运行）"""
+
+    def __init__(
+        self,
+        summary_queue: SummaryQueue,
+        handler: Callable[[Dict], Awaitable[None]],
+        ai_provider=None
+    ):
+        self.queue = summary_queue
+        self.handler = handler
+
+        self.concurrency = int(os.getenv("SUMMARY_CONCURRENCY", 4))
+        self.task_timeout = float(os.getenv("SUMMARY_TASK_TIMEOUT", 60))
+        self.rate_limit_backoff = float(os.getenv("SUMMARY_RATE_LIMIT_BACKOFF", 10))
+        self.rate_limit_max_backoff = float(os.getenv("SUMMARY_RATE_LIMIT_MAX_BACKOFF", 120))
+
+        # 每个提供商的并发上限（<PROVIDER>_SUMMARY_CONCURRENCY，默认与全局上限相同）
+        self.ai_provider = ai_provider
+        self._provider_limits_set = False
+
+        self._in_flight: Set[asyncio.Task] = set()
+        self._paused_until = 0.0
+        self._current_backoff = self.rate_limit_backoff
+        self._completed_at = deque(maxlen=1000)  # 最近完成时间，用于计算消化速率
+
+        self.stats_counters = {
+            "completed": 0,
+            "failed": 0,
+            "timeouts": 0,
+            "rate_limited": 0
+        }
+        self.queue_depth = 0
+
+    def _ensure_provider_limits(self):
+        """在执行器的事件循环中创建提供商信号量"""
+        if self._provider_limits_set or self.ai_provider is None:
+            return
+        for provider in self.ai_provider.providers:
+            limit = int(os.getenv(f"{provider['name'].upper()}_SUMMARY_CONCURRENCY", self.concurrency))
+            self.ai_provider.set_concurrency_limit(provider["name"], limit)
+        self._provider_limits_set = True
+
+    # ==================== 调度 ====================
+
+    async def drain(self, should_continue: Callable[[], bool] = lambda: True):
+        """领取并执行到期任务，直到队列中没有到期任务且执行中的任务全部完成"""
+        self._ensure_provider_limits()
+
+        while should_continue():
+            # 限流暂停期间只等待执行中的任务
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                if self._in_flight:
+                    await asyncio.wait(self._in_flight, timeout=pause)
+                else:
+                    await asyncio.sleep(pause)
+                continue
+
+            free = self.concurrency - len(self._in_flight)
+            tasks = self.queue.claim(free) if free > 0 else []
+            for task in tasks:
+                job = asyncio.create_task(self._run(task))
+                self._in_flight.add(job)
+                job.add_done_callback(self._in_flight.discard)
+
+            if not tasks and not self._in_flight:
+                break
+
+            # 有空位但没有到期任务、或者并发已满时，等待任意一个任务完成再领取
+            if self._in_flight and (not tasks or len(self._in_flight) >= self.concurrency):
+                await asyncio.wait(self._in_flight, return_when=asyncio.FIRST_COMPLETED)
+
+            self._refresh_queue_depth()
+
+        self._refresh_queue_depth()
+
+    async def cancel(self):
+        """取消执行中的任务（未确认的任务在可见性超时后会被重新领取）"""
+        for job in list(self._in_flight):
+            job.cancel()
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+    async def _run(self, task: Dict):
+        session_id = task["session_id"]
+        try:
+            await asyncio.wait_for(self.handler(task), timeout=self.task_timeout)
+        except asyncio.TimeoutError:
+            self.stats_counters["timeouts"] += 1
+            self._fail(task, f"总结超时（{self.task_timeout:.0f}秒）")
+            return
+        except asyncio.CancelledError:
+            raise
+        except LeaseHeldError as e:
+            # 其他工作进程正在处理同一会话，租约到期后再领取
+            self.queue.release(session_id, max(e.retry_after, 1))
+            return
+        except Exception as e:
+            if is_rate_limit_error(e):
+                self._on_rate_limited()
+            self._fail(task, str(e))
+            return
+
+        self.queue.ack(session_id)
+        self.stats_counters["completed"] += 1
+        self._completed_at.append(time.monotonic())
+        self._current_backoff = self.rate_limit_backoff
+
+    def _fail(self, task: Dict, error: str):
+        session_id = task["session_id"]
+        self.stats_counters["failed"] += 1
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ 会话总结失败 {session_id[:8]} (第{task.get('attempts')}次): {error}")
+        if not self.queue.fail(session_id, error):
+            print(f"  ☠️  会话 {session_id[:8]} 多次总结失败，已移入死信列表")
+
+    def _on_rate_limited(self):
+        """限流：暂停领取新任务，连续限流时退避时间翻倍"""
+        self.stats_counters["rate_limited"] += 1
+        self._paused_until = time.monotonic() + self._current_backoff
+        print(f"⏸️  AI 服务限流，暂停领取总结任务 {self._current_backoff:.1f} 秒")
+        self._current_backoff = min(self._current_backoff * 2, self.rate_limit_max_backoff)
+
+    # ==================== 统计 ====================
+
+    def _refresh_queue_depth(self):
+        try:
+            queue_stats = self.queue.stats()
+            self.queue_depth = queue_stats["pending"]
+        except Exception:
+            pass
+
+    def drain_rate(self, window: float = 60) -> float:
+        """最近 window 秒内每分钟完成的总结数"""
+        since = time.monotonic() - window
+        recent = sum(1 for t in self._completed_at if t >= since)
+        return round(recent * 60 / window, 2)
+
+    def stats(self) -> Dict:
+        """执行器状态（不访问 Redis，可在其他线程读取）"""
+        return {
+            "queue_depth": self.queue_depth,
+            "in_flight": len(self._in_flight),
+            "concurrency": self.concurrency,
+            "drain_rate_per_min": self.drain_rate(),
+            "paused": self._paused_until > time.monotonic(),
+            **self.stats_counters
+        }
@@ -0,0 +1,261 @@
+"""
+会话总结工作队列
+以会话ID为成员的有序集合队列，取代原来 JSON 写入 SET 的方式：
+- 去重：同一会话在队列中只有一条，处理中再次标记会在处理完成后重新排队
+- 可见性超时：领取的任务在超时前未确认，会被重新领取
+- 重试计数：失败后按指数退避重新排队，超过最大次数进入死信列表
+领取、确认、失败都是服务端脚本，复杂度与队列长度无关（O(log N)）
+"""
+
+import redis
+import redis.asyncio as aioredis
+import os
+import json
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from services import task_signals
+
+PENDING_KEY = "summary_queue:pending"        # ZSET 会话ID -> 可领取时间
+PROCESSING_KEY = "summary_queue:processing"  # ZSET 会话ID -> 可见性超时时间
+ATTEMPTS_KEY = "summary_queue:attempts"      # HASH 会话ID -> 已领取次数
+DEAD_LETTER_KEY = "summary_queue:dead"       # LIST 多次失败的任务
+LEGACY_QUEUE_KEY = "session:summary_queue"   # 旧版 SET 队列（JSON 任务）
+
+DEAD_LETTER_MAX = 1000
+
+# 标记：处理中的会话排在可见性超时之后，避免被并发领取；新入队时唤醒后台任务
+# KEYS: pending, processing, signals
+# ARGV: 会话ID, 可领取时间, 信号, 信号上限
+MARK_SCRIPT = """
+local score = redis.call('ZSCORE', KEYS[2], ARGV[1]) or ARGV[2]
+local added = redis.call('ZADD', KEYS[1], 'NX', score, ARGV[1])
+if added == 1 then
+    redis.call('LPUSH', KEYS[3], ARGV[3])
+    redis.call('LTRIM', KEYS[3], 0, tonumber(ARGV[4]) - 1)
+end
+return added
+"""
+
+# 领取：先回收可见性超时的任务（超过最大次数的进入死信），再领取到期任务
+# KEYS: pending, processing, attempts, dead
+# ARGV: 当前时间, 可见性超时, 领取数量, 最大次数, 死信上限, 失败时间
+CLAIM_SCRIPT = """
+local now = tonumber(ARGV[1])
+local limit = tonumber(ARGV[3])
+local max_attempts = tonumber(ARGV[4])
+
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now, 'LIMIT', 0, limit)
+for _, member in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], member)
+    local attempts = tonumber(redis.call('HGET', KEYS[3], member) or '0')
+    if attempts >= max_attempts then
+        redis.call('HDEL', KEYS[3], member)
+        redis.call('ZREM', KEYS[1], member)
+        local escaped = string.gsub(member, '[%c"\\\\]', function(c)
+            return string.format('\\\\u%04x', string.byte(c))
+        end)
+        redis.call('LPUSH', KEYS[4], '{"session_id": "' .. escaped .. '", "attempts": ' .. attempts ..
+            ', "error": "visibility timeout", "failed_at": "' .. ARGV[6] .. '"}')
+        redis.call('LTRIM', KEYS[4], 0, tonumber(ARGV[5]) - 1)
+    else
+        redis.call('ZADD', KEYS[1], 'NX', now, member)
+    end
+end
+
+local claimed = {}
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, limit)
+for _, member in ipairs(due) do
+    redis.call('ZREM', KEYS[1], member)
+    redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), member)
+    local attempts = redis.call('HINCRBY', KEYS[3], member, 1)
+    table.insert(claimed, member)
+    table.insert(claimed, attempts)
+end
+return claimed
+"""
+
+# 确认：处理期间再次标记的会话立即可领取
+# KEYS: pending, processing, attempts
+ACK_SCRIPT = """
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('ZADD', KEYS[1], 'XX', ARGV[2], ARGV[1])
+return 1
+"""
+
+# 失败：读取尝试次数、计算退避时间、决定重试还是进入死信列表都在同一个脚本中完成
+# KEYS: pending, processing, attempts, dead
+# ARGV: 会话ID, 当前时间, 重试基础延迟, 最大次数, 死信记录前半部分, 死信记录后半部分, 死信上限
+# （死信记录在客户端按 JSON 转义，脚本只在两部分之间填入尝试次数）
+FAIL_SCRIPT = """
+if not redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    return -1
+end
+redis.call('ZREM', KEYS[2], ARGV[1])
+local attempts = math.max(tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or '0'), 1)
+if attempts >= tonumber(ARGV[4]) then
+    redis.call('HDEL', KEYS[3], ARGV[1])
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('LPUSH', KEYS[4], ARGV[5] .. attempts .. ARGV[6])
+    redis.call('LTRIM', KEYS[4], 0, tonumber(ARGV[7]) - 1)
+    return 0
+end
+local retry_at = tonumber(ARGV[2]) + tonumber(ARGV[3]) * 2 ^ (attempts - 1)
+redis.call('ZADD', KEYS[1], 'LT', retry_at, ARGV[1])
+return 1
+"""
+
+# 归还：任务未处理（如租约被其他进程持有），延迟后重新排队，不计入尝试次数
+# KEYS: pending, processing, attempts
+# ARGV: 会话ID, 重新排队时间
+RELEASE_SCRIPT = """
+if redis.call('ZREM', KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+if tonumber(redis.call('HINCRBY', KEYS[3], ARGV[1], -1)) <= 0 then
+    redis.call('HDEL', KEYS[3], ARGV[1])
+end
+redis.call('ZADD', KEYS[1], 'NX', ARGV[2], ARGV[1])
+return 1
+"""
+
+
+def _decode(value) -> str:
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class SummaryQueue:
+    """会话总结工作队列
+
+    标记方法有同步和异步两个版本；领取、确认、失败由后台任务线程调用（同步客户端）。
+    """
+
+    def __init__(self, redis_client: redis.Redis, async_redis: Optional[aioredis.Redis] = None):
+        self.redis = redis_client
+        self.async_redis = async_redis
+
+        self.visibility_timeout = float(os.getenv("SUMMARY_VISIBILITY_TIMEOUT", 300))
+        self.max_attempts = int(os.getenv("SUMMARY_MAX_ATTEMPTS", 3))
+        self.retry_delay = float(os.getenv("SUMMARY_RETRY_DELAY", 30))
+
+        self._mark = redis_client.register_script(MARK_SCRIPT)
+        self._mark_async = async_redis.register_script(MARK_SCRIPT) if async_redis is not None else None
+        self._claim = redis_client.register_script(CLAIM_SCRIPT)
+        self._ack = redis_client.register_script(ACK_SCRIPT)
+        self._fail = redis_client.register_script(FAIL_SCRIPT)
+        self._release = redis_client.register_script(RELEASE_SCRIPT)
+
+    # ==================== 入队 ====================
+
+    @staticmethod
+    def _mark_args(session_id: str, delay: float):
+        keys = [PENDING_KEY, PROCESSING_KEY, task_signals.SIGNAL_KEY]
+        args = [session_id, time.time() + delay, task_signals.SUMMARY, task_signals.SIGNAL_MAX]
+        return keys, args
+
+    def mark(self, session_id: str, delay: float = 0) -> bool:
+        """标记会话需要总结；已在队列中则忽略，返回是否新入队"""
+        keys, args = self._mark_args(session_id, delay)
+        return bool(self._mark(keys=keys, args=args))
+
+    async def mark_async(self, session_id: str, delay: float = 0) -> bool:
+        """标记会话需要总结（异步版本）"""
+        keys, args = self._mark_args(session_id, delay)
+        return bool(await self._mark_async(keys=keys, args=args))
+
+    # ==================== 消费 ====================
+
+    def claim(self, limit: int = 10) -> List[Dict]:
+        """领取最多 limit 个到期任务，返回 [{"session_id", "attempts"}]"""
+        result = self._claim(
+            keys=[PENDING_KEY, PROCESSING_KEY, ATTEMPTS_KEY, DEAD_LETTER_KEY],
+            args=[
+                time.time(), self.visibility_timeout, limit,
+                self.max_attempts, DEAD_LETTER_MAX, datetime.now().isoformat()
+            ]
+        )
+        return [
+            {"session_id": _decode(result[i]), "attempts": int(result[i + 1])}
+            for i in range(0, len(result), 2)
+        ]
+
+    def ack(self, session_id: str):
+        """确认任务完成（包括无需总结而跳过的任务）"""
+        self._ack(keys=[PENDING_KEY, PROCESSING_KEY, ATTEMPTS_KEY], args=[session_id, time.time()])
+
+    def release(self, session_id: str, delay: float):
+        """归还未处理的任务，delay 秒后可再次领取（不计入尝试次数）"""
+        self._release(keys=[PENDING_KEY, PROCESSING_KEY, ATTEMPTS_KEY], args=[session_id, time.time() + delay])
+
+    def fail(self, session_id: str, error: str) -> bool:
+        """任务失败：退避后重新排队，返回 False 表示已进入死信列表"""
+        # {"session_id": ..., "attempts": <脚本填入>, "error": ..., "failed_at": ...}
+        head = json.dumps({"session_id": session_id}, ensure_ascii=False)[:-1] + ', "attempts": '
+        tail = ", " + json.dumps({
+            "error": error,
+            "failed_at": datetime.now().isoformat()
+        }, ensure_ascii=False)[1:]
+
+        result = self._fail(
+            keys=[PENDING_KEY, PROCESSING_KEY, ATTEMPTS_KEY, DEAD_LETTER_KEY],
+            args=[session_id, time.time(), self.retry_delay, self.max_attempts, head, tail, DEAD_LETTER_MAX]
+        )
+        return result != 0
+
+    def next_due_in(self) -> Optional[float]:
+        """距离下一个任务到期（含可见性超时）的秒数，队列为空时返回 None"""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zrange(PENDING_KEY, 0, 0, withscores=True)
+        pipe.zrange(PROCESSING_KEY, 0, 0, withscores=True)
+        scores = [entries[0][1] for entries in pipe.execute() if entries]
+        if not scores:
+            return None
+        return max(min(scores) - time.time(), 0.0)
+
+    # ==================== 维护 ====================
+
+    def migrate_legacy_queue(self) -> int:
+        """把旧版 SET 队列中的任务迁移到新队列（按会话去重），返回迁移的会话数"""
+        tasks = self.redis.smembers(LEGACY_QUEUE_KEY)
+        if not tasks:
+            return 0
+
+        queued = {}
+        for task in tasks:
+            try:
+                task_data = json.loads(task)
+                session_id = task_data["session_id"]
+                queued_at = datetime.fromisoformat(task_data["queued_at"]).timestamp()
+            except Exception:
+                continue
+            queued[session_id] = min(queued_at, queued.get(session_id, queued_at))
+
+        pipe = self.redis.pipeline(transaction=True)
+        if queued:
+            pipe.zadd(PENDING_KEY, queued, nx=True)
+        pipe.delete(LEGACY_QUEUE_KEY)
+        pipe.execute()
+
+        print(f"📦 旧版总结队列已迁移: {len(tasks)} 个任务 → {len(queued)} 个会话")
+        return len(queued)
+
+    def stats(self) -> Dict:
+        """队列状态"""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zcard(PENDING_KEY)
+        pipe.zcount(PENDING_KEY, "-inf", time.time())
+        pipe.zcard(PROCESSING_KEY)
+        pipe.llen(DEAD_LETTER_KEY)
+        pending, due, processing, dead = pipe.execute()
+        return {
+            "pending": pending,
+            "due": due,
+            "processing": processing,
+            "dead_letter": dead
+        }
+
+    def get_dead_letters(self, limit: int = 50) -> List[Dict]:
+        """最近进入死信列表的任务"""
+        return [json.loads(item) for item in self.redis.lrange(DEAD_LETTER_KEY, 0, limit - 1)]
@@ -0,0 +1,69 @@
+"""
+任务租约
+多个后台工作进程共享总结和画像任务时，用 Redis 租约保证同一任务同一时间只有一个持有者：
+- 获取：SET NX PX，值为单调递增的防护令牌（fencing token）
+- 持有者处理过慢导致租约过期时，其他进程可以重新获取并拿到更大的令牌；
+  写入结果时带上令牌，存储端拒绝比已写入令牌更小的旧写入
+- 释放只在令牌仍匹配时生效
+"""
+
+import redis
+import os
+from typing import Optional
+
+LEASE_KEY_PREFIX = "lease:"
+FENCING_COUNTER_KEY = "lease:fencing_counter"
+
+# KEYS: 租约键, 令牌计数器  ARGV: 租约毫秒数
+ACQUIRE_SCRIPT = """
+local token = redis.call('INCR', KEYS[2])
+if redis.call('SET', KEYS[1], token, 'NX', 'PX', ARGV[1]) then
+    return token
+end
+return false
+"""
+
+# KEYS: 租约键  ARGV: 令牌
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class LeaseHeldError(Exception):
+    """任务租约被其他工作进程持有"""
+
+    def __init__(self, resource: str, retry_after: float):
+        super().__init__(f"租约 {resource} 被其他进程持有")
+        self.retry_after = retry_after
+
+
+class TaskLease:
+    """基于 Redis 的任务租约（带防护令牌）"""
+
+    def __init__(self, redis_client: redis.Redis, ttl: Optional[float] = None):
+        self.redis = redis_client
+        self.ttl_ms = int((ttl if ttl is not None else float(os.getenv("WORKER_LEASE_TTL", 120))) * 1000)
+
+        self._acquire = redis_client.register_script(ACQUIRE_SCRIPT)
+        self._release = redis_client.register_script(RELEASE_SCRIPT)
+
+    @staticmethod
+    def _key(resource: str) -> str:
+        return f"{LEASE_KEY_PREFIX}{resource}"
+
+    def acquire(self, resource: str) -> Optional[int]:
+        """获取租约，成功返回防护令牌，已被其他进程持有时返回 None"""
+        token = self._acquire(keys=[self._key(resource), FENCING_COUNTER_KEY], args=[self.ttl_ms])
+        return int(token) if token else None
+
+    def release(self, resource: str, token: int) -> bool:
+        """释放租约（令牌不匹配说明租约已过期并被他人获取，不做任何操作）"""
+        return bool(self._release(keys=[self._key(resource)], args=[token]))
+
+    def remaining(self, resource: str) -> float:
+        """租约剩余秒数（未被持有时为 0）"""
+        ttl_ms = self.redis.pttl(self._key(resource))
+        return max(ttl_ms, 0) / 1000
@@ -0,0 +1,18 @@
+"""
+后台任务唤醒信号
+写入方在产生后台工作时推送一个信号，后台任务阻塞在信号列表上（BLPOP），
+有工作时立即唤醒，空闲时不轮询
+"""
+
+SIGNAL_KEY = "background:signals"
+SIGNAL_MAX = 64  # 信号只用于唤醒，列表保留少量即可
+SIGNAL_POP_MAX = 8  # 每个工作进程一次最多取走的信号数，其余留给其他工作进程
+
+SUMMARY = "summary"  # 有会话进入总结队列
+PROFILE = "profile"  # 有用户产生了新的聊天或行为数据
+
+
+def push_signal(pipe, kind: str):
+    """把唤醒信号加入流水线（同步/异步流水线均可）"""
+    pipe.lpush(SIGNAL_KEY, kind)
+    pipe.ltrim(SIGNAL_KEY, 0, SIGNAL_MAX - 1)
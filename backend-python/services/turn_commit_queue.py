@@ -0,0 +1,226 @@
+"""
+回合提交队列（写后队列）
+LLM 回复后的簿记写入不影响回复内容，因此不放在响应路径上：
+- 长期聊天历史、用户行为、last_seen、互动计数、亲密度和关系等级
+- 每个回合由一个服务端脚本原子写入，回合ID作为幂等键：重试或重复提交已写入的回合不会重复计数
+- 后台任务按批合并为一次流水线往返，失败时退避重试
+- 关闭时先把队列中剩余的回合写完
+"""
+
+import asyncio
+import os
+import uuid
+import redis.asyncio as aioredis
+from typing import Dict, List, Optional
+
+from services import behavior_rollup
+from services import record_codec
+from services.user_profile_service import RELATIONSHIP_LEVELS, TOP_RELATIONSHIP_LEVEL
+
+CHAT_HISTORY_MAX = 500
+BEHAVIOR_HISTORY_MAX = 200
+
+# 提交一个回合：幂等键已存在时不做任何修改（返回 0），否则写入长期历史、行为和汇总，
+# 累加互动计数和亲密度，并按累加后的亲密度设置关系等级
+# KEYS: 幂等键, 聊天历史, 消息序号, 行为记录, 画像, 行为汇总, 行为时间范围
+# ARGV: 幂等键过期时间, 历史上限, 行为上限, 时间, 用户消息, 回复, 行为,
+#       等级数 N, 上限1, 等级1, ..., 上限N, 等级N, 最高等级, 行为汇总增量（behavior_rollup.increment_args）
+COMMIT_TURN_SCRIPT = """
+if not redis.call('SET', KEYS[1], '1', 'NX', 'EX', ARGV[1]) then
+    return 0
+end
+redis.call('RPUSH', KEYS[2], ARGV[5], ARGV[6])
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[2]), -1)
+redis.call('INCRBY', KEYS[3], 2)
+redis.call('RPUSH', KEYS[4], ARGV[7])
+redis.call('LTRIM', KEYS[4], -tonumber(ARGV[3]), -1)
+
+redis.call('HSET', KEYS[5], 'last_seen', ARGV[4])
+redis.call('HINCRBY', KEYS[5], 'total_interactions', 1)
+local score = redis.call('HINCRBY', KEYS[5], 'intimacy_score', 1)
+local levels = tonumber(ARGV[8])
+local level = ARGV[9 + 2 * levels]
+for i = 0, levels - 1 do
+    if score < tonumber(ARGV[9 + 2 * i]) then
+        level = ARGV[10 + 2 * i]
+        break
+    end
+end
+redis.call('HSET', KEYS[5], 'relationship_level', level)
+
+local i = 10 + 2 * levels
+if ARGV[i] ~= '' then
+    redis.call('ZADD', KEYS[7], 'LT', ARGV[i], 'first')
+    redis.call('ZADD', KEYS[7], 'GT', ARGV[i + 1], 'last')
+end
+i = i + 2
+for _ = 1, tonumber(ARGV[i]) do
+    redis.call('HINCRBY', KEYS[6], ARGV[i + 1], ARGV[i + 2])
+    i = i + 2
+end
+i = i + 1
+for _ = 1, tonumber(ARGV[i]) do
+    redis.call('HINCRBYFLOAT', KEYS[6], ARGV[i + 1], ARGV[i + 2])
+    i = i + 2
+end
+return 1
+"""
+
+_LEVEL_ARGS = [len(RELATIONSHIP_LEVELS)]
+for _upper, _level in RELATIONSHIP_LEVELS:
+    _LEVEL_ARGS.extend([_upper, _level])
+_LEVEL_ARGS.append(TOP_RELATIONSHIP_LEVEL)
+
+# 停止信号：排在它之前的回合都会被提交
+_STOP = object()
+
+
+class TurnCommitQueue:
+    """回合簿记写入的异步批量队列"""
+
+    def __init__(self, async_redis: aioredis.Redis, profile_service):
+        self.redis = async_redis
+        self.profile_service = profile_service
+
+        self.batch_size = int(os.getenv("TURN_COMMIT_BATCH_SIZE", 50))
+        self.batch_window = float(os.getenv("TURN_COMMIT_BATCH_WINDOW", 0.05))
+        self.max_retries = int(os.getenv("TURN_COMMIT_MAX_RETRIES", 3))
+        self.retry_delay = float(os.getenv("TURN_COMMIT_RETRY_DELAY", 0.5))
+        self.dedup_ttl = int(os.getenv("TURN_COMMIT_DEDUP_TTL", 86400))
+        self._commit_turn = async_redis.register_script(COMMIT_TURN_SCRIPT)
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+        self.stats = {
+            "committed": 0,
+            "batches": 0,
+            "retries": 0,
+            "dropped": 0,
+            "duplicates": 0
+        }
+
+    # ==================== 入队 ====================
+
+    async def enqueue(self, turn: Dict, user_message: str, reply: str, timestamp: str):
+        """提交一个回合的簿记写入（队列未启动时直接写入）"""
+        item = {
+            "turn_id": uuid.uuid4().hex,
+            "user_id": turn["user_id"],
+            "user_message": user_message,
+            "reply": reply,
+            "timestamp": timestamp
+        }
+
+        if self._worker is None:
+            await self._commit_with_retry([item])
+            return
+
+        # 有界队列：写入积压时对请求形成背压，而不是无限占用内存
+        await self._queue.put(item)
+
+    def pending(self) -> int:
+        """队列中尚未提交的回合数"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    # ==================== 生命周期 ====================
+
+    async def start(self):
+        """启动后台提交任务"""
+        if self._worker is None:
+            self._queue = asyncio.Queue(maxsize=int(os.getenv("TURN_COMMIT_QUEUE_SIZE", 10000)))
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台提交任务（先写完队列中剩余的回合）"""
+        if self._worker is None:
+            return
+
+        await self._queue.put(_STOP)
+        await self._worker
+        self._worker = None
+
+        # 停止信号之后才入队的回合
+        remaining = [item for item in self._drain() if item is not _STOP]
+        if remaining:
+            await self._commit_with_retry(remaining)
+
+    async def _run(self):
+        """按批收集回合：拿到第一个后等待一个批处理窗口，再取走已到达的回合"""
+        while True:
+            batch = [await self._queue.get()]
+            if self._queue.qsize() < self.batch_size:
+                await asyncio.sleep(self.batch_window)
+            batch.extend(self._drain(self.batch_size - 1))
+
+            stopping = _STOP in batch
+            batch = [item for item in batch if item is not _STOP]
+            if batch:
+                await self._commit_with_retry(batch)
+            if stopping:
+                return
+
+    def _drain(self, limit: Optional[int] = None) -> List:
+        items = []
+        while (limit is None or len(items) < limit) and not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        return items
+
+    # ==================== 批量提交 ====================
+
+    async def _commit_with_retry(self, batch: List[Dict]):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self._commit_batch(batch)
+                self.stats["committed"] += len(batch)
+                self.stats["batches"] += 1
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if attempt >= self.max_retries:
+                    self.stats["dropped"] += len(batch)
+                    print(f"❌ 回合簿记写入失败，丢弃 {len(batch)} 个回合: {str(e)}")
+                    return
+                self.stats["retries"] += 1
+                print(f"⚠️  回合簿记写入失败，{self.retry_delay * 2 ** attempt:.1f}秒后重试: {str(e)}")
+                await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+    async def _commit_batch(self, batch: List[Dict]):
+        """一个批次的全部回合在一次流水线往返中提交（每个回合由脚本原子写入）"""
+        pipe = self.redis.pipeline(transaction=False)
+
+        for item in batch:
+            user_id = item["user_id"]
+            now = item["timestamp"]
+            behavior = {
+                "type": "chat",
+                "timestamp": now,
+                "metadata": {"message_length": len(item["user_message"])}
+            }
+            keys = [
+                f"turn:committed:{item['turn_id']}",
+                f"user:{user_id}:chat_history",
+                # 消息序号只增不减（历史会被截断），规则引擎据此增量统计新消息
+                f"user:{user_id}:chat_history_seq",
+                f"user:{user_id}:behaviors",
+                f"user:{user_id}:profile",
+                behavior_rollup.rollup_key(user_id),
+                behavior_rollup.span_key(user_id)
+            ]
+            args = [
+                self.dedup_ttl, CHAT_HISTORY_MAX, BEHAVIOR_HISTORY_MAX, now,
+                record_codec.encode({"role": "user", "content": item["user_message"], "timestamp": now}),
+                record_codec.encode({"role": "assistant", "content": item["reply"], "timestamp": now}),
+                record_codec.encode(behavior),
+                *_LEVEL_ARGS,
+                *behavior_rollup.increment_args([behavior])
+            ]
+            await self._commit_turn(keys=keys, args=args, client=pipe)
+
+        # 待刷新画像索引（并唤醒后台任务）
+        for user_id in {item["user_id"] for item in batch}:
+            self.profile_service.mark_profile_dirty(pipe, user_id)
+        results = await pipe.execute()
+
+        self.stats["duplicates"] += sum(1 for committed in results[:len(batch)] if not committed)
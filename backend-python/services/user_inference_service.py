@@ -1,17 +1,41 @@
 """
 用户属性推测服务
 基于聊天内容推测用户的年龄、性别、职业等属性
+
+所有词库编译成一个多关键词匹配器，每段文本只扫描一遍，结果供各项分析共用；
+设置 USER_INFERENCE_DICTIONARY 指向 JSON 词库文件后，文件修改会在下次使用时自动重新加载
 """
 
+import os
 import re
-from typing import Dict, List, Optional, Tuple
+import json
+import hashlib
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
 from datetime import datetime
 
+from services.keyword_matcher import KeywordMatcher
+
+# 可从词库文件覆盖的词库（JSON 顶层键与属性名相同）
+DICTIONARY_TABLES = (
+    "occupation_keywords",
+    "interest_keywords",
+    "age_indicators",
+    "gender_indicators",
+    "education_keywords",
+    "style_indicators",
+    "emotion_keywords",
+)
+
 
 class UserInferenceService:
     """用户属性推测服务"""
     
-    def __init__(self):
+    def __init__(self, dictionary_path: Optional[str] = None):
+        self.dictionary_path = dictionary_path or os.getenv("USER_INFERENCE_DICTIONARY")
+        self._dictionary_mtime: Optional[float] = None
+        self._reload_lock = threading.Lock()
+        
         # 职业关键词库
         self.occupation_keywords = {
             "程序员": ["编程", "代码", "bug", "调试", "开发", "算法", "github", "python", "java"],
@@ -52,34 +76,125 @@ class UserInferenceService:
             "male": ["哥们", "兄弟", "老铁", "篮球", "足球", "游戏", "码农"],
             "female": ["姐妹", "小姐姐", "护肤", "化妆", "逛街", "包包", "美甲"]
         }
+        
+        # 教育程度关键词（按顺序匹配，先命中的优先）
+        self.education_keywords = {
+            "博士": ["博士", "PhD", "读博", "博导"],
+            "硕士": ["硕士", "研究生", "考研", "导师"],
+            "本科": ["本科", "大学", "学士", "大学生"],
+            "专科": ["专科", "大专"]
+        }
+        
+        # 沟通风格指示词（正式程度和标点）
+        self.style_indicators = {
+            "formal": ["请问", "您好", "谢谢", "麻烦", "不好意思"],
+            "casual": ["哈哈", "嘿嘿", "啊", "呀", "哦", "嗯"],
+            "question": ["?", "？"],
+            "exclamation": ["!", "！"]
+        }
+        
+        # 情感关键词
+        self.emotion_keywords = {
+            "positive": ["开心", "高兴", "快乐", "哈哈", "喜欢", "爱", "棒", "好", "赞", "不错", "太好了"],
+            "negative": ["难过", "伤心", "生气", "烦", "累", "讨厌", "糟糕", "不好", "失望"],
+            "anxious": ["焦虑", "紧张", "担心", "害怕", "不安", "压力"]
+        }
+        
+        self._build_matcher()
+        self.reload_if_changed()
+    
+    def _build_matcher(self):
+        """把所有词库编译成一个匹配器，并计算词库版本（词库变化时已累计的计数需要重建）"""
+        keywords = set()
+        for table in DICTIONARY_TABLES:
+            for words in getattr(self, table).values():
+                keywords.update(words)
+        matcher = KeywordMatcher(keywords)
+        self.dictionary_version = hashlib.md5(
+            json.dumps(matcher.keywords, ensure_ascii=False).encode()
+        ).hexdigest()[:12]
+        self.matcher = matcher
+    
+    def reload_if_changed(self) -> bool:
+        """词库文件有修改时重新加载，返回是否重新加载
+        
+        文件中出现的词库整体替换默认词库，未出现的保持不变；
+        加载失败时继续使用当前词库
+        """
+        if not self.dictionary_path:
+            return False
+        try:
+            mtime = os.path.getmtime(self.dictionary_path)
+        except OSError:
+            return False
+        if mtime == self._dictionary_mtime:
+            return False
+        
+        with self._reload_lock:
+            if mtime == self._dictionary_mtime:
+                return False
+            try:
+                with open(self.dictionary_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                tables = {
+                    table: {label: list(words) for label, words in data[table].items()}
+                    for table in DICTIONARY_TABLES if table in data
+                }
+            except Exception as e:
+                print(f"⚠️  推测词库加载失败，继续使用当前词库: {str(e)}")
+                self._dictionary_mtime = mtime
+                return False
+            
+            for table, value in tables.items():
+                setattr(self, table, value)
+            self._build_matcher()
+            self._dictionary_mtime = mtime
+            print(f"📖 推测词库已加载: {self.dictionary_path} (版本 {self.dictionary_version})")
+            return True
+    
+    @property
+    def keywords(self) -> List[str]:
+        return self.matcher.keywords
+    
+    def count_keywords(self, texts: Iterable[str]) -> Dict[str, int]:
+        """统计每个关键词在文本中出现的次数（只返回出现过的关键词）
+        
+        计数与逐个关键词 `str.count` 一致；关键词不含空格，逐条统计后相加与统计拼接后的全文结果一致，
+        因此计数可以按新消息增量累加
+        """
+        return self.matcher.count_all(texts)
     
     def infer_from_messages(self, messages: List[Dict]) -> Dict:
         """从聊天消息推测用户属性"""
-        
-        # 合并所有用户消息
         user_messages = [msg["content"] for msg in messages if msg.get("role") == "user"]
-        combined_text = " ".join(user_messages)
-        
-        result = {
-            "occupation": self._infer_occupation(combined_text),
-            "age_range": self._infer_age_range(combined_text),
-            "gender": self._infer_gender(combined_text),
-            "interests": self._extract_interests(combined_text),
-            "education": self._infer_education(combined_text)
+        return self.infer_from_counts(self.count_keywords(user_messages))
+    
+    def infer_from_counts(self, counts: Dict[str, int]) -> Dict:
+        """从累计的关键词计数推测用户属性"""
+        return {
+            "occupation": self._infer_occupation(counts),
+            "age_range": self._infer_age_range(counts),
+            "gender": self._infer_gender(counts),
+            "interests": self._extract_interests(counts),
+            "education": self._infer_education(counts)
         }
-        
-        return result
     
-    def _infer_occupation(self, text: str) -> Tuple[Optional[str], float]:
+    @staticmethod
+    def _mentioned(counts: Dict[str, int], keywords: List[str]) -> int:
+        """出现过的不同关键词个数"""
+        return sum(1 for keyword in keywords if counts.get(keyword, 0) > 0)
+    
+    @staticmethod
+    def _total(counts: Dict[str, int], keywords: List[str]) -> int:
+        """关键词出现的总次数"""
+        return sum(counts.get(keyword, 0) for keyword in keywords)
+    
+    def _infer_occupation(self, counts: Dict[str, int]) -> Tuple[Optional[str], float]:
         """推测职业"""
         occupation_scores = {}
         
         for occupation, keywords in self.occupation_keywords.items():
-            score = 0
-            for keyword in keywords:
-                if keyword in text:
-                    score += text.count(keyword)
-            occupation_scores[occupation] = score
+            occupation_scores[occupation] = self._total(counts, keywords)
         
         if not occupation_scores or max(occupation_scores.values()) == 0:
             return None, 0.0
@@ -94,13 +209,12 @@ class UserInferenceService:
         
         return None, 0.0
     
-    def _infer_age_range(self, text: str) -> Tuple[Optional[str], float]:
+    def _infer_age_range(self, counts: Dict[str, int]) -> Tuple[Optional[str], float]:
         """推测年龄段"""
         age_scores = {}
         
         for age_range, keywords in self.age_indicators.items():
-            score = sum(1 for keyword in keywords if keyword in text)
-            age_scores[age_range] = score
+            age_scores[age_range] = self._mentioned(counts, keywords)
         
         if not age_scores or max(age_scores.values()) == 0:
             return None, 0.0
@@ -113,10 +227,10 @@ class UserInferenceService:
         
         return None, 0.0
     
-    def _infer_gender(self, text: str) -> Tuple[str, float]:
+    def _infer_gender(self, counts: Dict[str, int]) -> Tuple[str, float]:
         """推测性别"""
-        male_score = sum(1 for keyword in self.gender_indicators["male"] if keyword in text)
-        female_score = sum(1 for keyword in self.gender_indicators["female"] if keyword in text)
+        male_score = self._mentioned(counts, self.gender_indicators["male"])
+        female_score = self._mentioned(counts, self.gender_indicators["female"])
         
         if male_score == 0 and female_score == 0:
             return "unknown", 0.0
@@ -130,12 +244,12 @@ class UserInferenceService:
         else:
             return "unknown", 0.0
     
-    def _extract_interests(self, text: str) -> List[Tuple[str, float]]:
+    def _extract_interests(self, counts: Dict[str, int]) -> List[Tuple[str, float]]:
         """提取兴趣领域"""
         interests = []
         
         for interest, keywords in self.interest_keywords.items():
-            score = sum(1 for keyword in keywords if keyword in text)
+            score = self._mentioned(counts, keywords)
             if score >= 2:  # 至少提及2次
                 weight = min(score * 0.1, 1.0)
                 interests.append((interest, weight))
@@ -144,24 +258,16 @@ class UserInferenceService:
         interests.sort(key=lambda x: x[1], reverse=True)
         return interests[:5]  # 返回前5个兴趣
     
-    def _infer_education(self, text: str) -> Tuple[Optional[str], float]:
+    def _infer_education(self, counts: Dict[str, int]) -> Tuple[Optional[str], float]:
         """推测教育程度"""
-        education_keywords = {
-            "博士": ["博士", "PhD", "读博", "博导"],
-            "硕士": ["硕士", "研究生", "考研", "导师"],
-            "本科": ["本科", "大学", "学士", "大学生"],
-            "专科": ["专科", "大专"]
-        }
-        
-        for edu_level, keywords in education_keywords.items():
-            for keyword in keywords:
-                if keyword in text:
-                    return edu_level, 0.7
+        for edu_level, keywords in self.education_keywords.items():
+            if self._mentioned(counts, keywords):
+                return edu_level, 0.7
         
         return None, 0.0
     
-    def analyze_communication_style(self, messages: List[Dict]) -> Dict:
-        """分析沟通风格"""
+    def analyze_communication_style(self, messages: List[Dict], counts: Optional[Dict[str, int]] = None) -> Dict:
+        """分析沟通风格（counts 为这些消息已统计好的关键词计数，可省略）"""
         user_messages = [msg["content"] for msg in messages if msg.get("role") == "user"]
         
         if not user_messages:
@@ -181,16 +287,16 @@ class UserInferenceService:
         emoji_count = sum(len(emoji_pattern.findall(msg)) for msg in user_messages)
         emoji_ratio = emoji_count / len(user_messages)
         
+        if counts is None:
+            counts = self.count_keywords(user_messages)
+        
         # 问号和感叹号使用
-        question_marks = sum(msg.count("?") + msg.count("？") for msg in user_messages)
-        exclamation_marks = sum(msg.count("!") + msg.count("！") for msg in user_messages)
+        question_marks = self._total(counts, self.style_indicators.get("question", []))
+        exclamation_marks = self._total(counts, self.style_indicators.get("exclamation", []))
         
         # 正式程度（基于标点符号和书面语）
-        formal_indicators = ["请问", "您好", "谢谢", "麻烦", "不好意思"]
-        casual_indicators = ["哈哈", "嘿嘿", "啊", "呀", "哦", "嗯"]
-        
-        formal_count = sum(sum(msg.count(word) for word in formal_indicators) for msg in user_messages)
-        casual_count = sum(sum(msg.count(word) for word in casual_indicators) for msg in user_messages)
+        formal_count = self._total(counts, self.style_indicators.get("formal", []))
+        casual_count = self._total(counts, self.style_indicators.get("casual", []))
         
         return {
             "avg_message_length": int(avg_length),
@@ -202,21 +308,18 @@ class UserInferenceService:
             "response_length_preference": "detailed" if avg_length > 50 else "medium" if avg_length > 20 else "short"
         }
     
-    def analyze_emotional_patterns(self, messages: List[Dict]) -> Dict:
-        """分析情感模式"""
+    def analyze_emotional_patterns(self, messages: List[Dict], counts: Optional[Dict[str, int]] = None) -> Dict:
+        """分析情感模式（counts 为这些消息已统计好的关键词计数，可省略）"""
         user_messages = [msg["content"] for msg in messages if msg.get("role") == "user"]
         
         if not user_messages:
             return {}
         
-        # 情感关键词
-        positive_words = ["开心", "高兴", "快乐", "哈哈", "喜欢", "爱", "棒", "好", "赞", "不错", "太好了"]
-        negative_words = ["难过", "伤心", "生气", "烦", "累", "讨厌", "糟糕", "不好", "失望"]
-        anxious_words = ["焦虑", "紧张", "担心", "害怕", "不安", "压力"]
-        
-        positive_count = sum(sum(msg.count(word) for word in positive_words) for msg in user_messages)
-        negative_count = sum(sum(msg.count(word) for word in negative_words) for msg in user_messages)
-        anxious_count = sum(sum(msg.count(word) for word in anxious_words) for msg in user_messages)
+        if counts is None:
+            counts = self.count_keywords(user_messages)
+        positive_count = self._total(counts, self.emotion_keywords.get("positive", []))
+        negative_count = self._total(counts, self.emotion_keywords.get("negative", []))
+        anxious_count = self._total(counts, self.emotion_keywords.get("anxious", []))
         
         total_emotional = positive_count + negative_count + anxious_count
         
@@ -5,49 +5,270 @@
 """
 
 import redis
+import redis.asyncio as aioredis
+import asyncio
 import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor
 from datetime import datetime
 from typing import Dict, List, Optional, Tuple, Any
 import hashlib
+import time
+
+from services import task_signals
+from services import profile_inference
+from services import behavior_rollup
+from services import record_codec
+from services.behavior_rollup import BehaviorRollup
+
+# 待刷新画像的用户索引：ZSET 用户ID -> 最近活跃时间（或推迟后的可刷新时间、领取后的可见性超时时间）
+PROFILE_DIRTY_KEY = "user:profile_dirty"
+
+# 领取已到期的待刷新用户（按分数从小到大，最久未处理的先出）：
+# 用户留在索引中，分数改为可见性超时时间，处理完成前工作进程退出时会被重新领取
+# KEYS: 待刷新索引  ARGV: 当前时间, 领取数量, 可见性超时时间
+CLAIM_DIRTY_SCRIPT = """
+local users = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, user_id in ipairs(users) do
+    redis.call('ZADD', KEYS[1], 'XX', ARGV[3], user_id)
+end
+return users
+"""
+
+# 确认：只移除分数仍为本次可见性超时时间的用户（处理期间重新标记或被推迟的保留）
+# KEYS: 待刷新索引  ARGV: 可见性超时时间, 用户ID...
+ACK_DIRTY_SCRIPT = """
+local deadline = tonumber(ARGV[1])
+local removed = 0
+for i = 2, #ARGV do
+    if tonumber(redis.call('ZSCORE', KEYS[1], ARGV[i])) == deadline then
+        removed = removed + redis.call('ZREM', KEYS[1], ARGV[i])
+    end
+end
+return removed
+"""
+
+# 写回画像字段（带防护令牌时，比已写入令牌更小的写入被拒绝，返回 0）
+# KEYS: 画像, 画像防护令牌  ARGV: 令牌（0 表示不检查）, 字段1, 值1, ...
+WRITE_PROFILE_SCRIPT = """
+local token = tonumber(ARGV[1])
+if token > 0 then
+    if tonumber(redis.call('GET', KEYS[2]) or '0') > token then
+        return 0
+    end
+    redis.call('SET', KEYS[2], token)
+end
+for i = 2, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+return 1
+"""
+
+# 关系等级：亲密度低于上限时取对应等级，超过全部上限时为最高等级
+RELATIONSHIP_LEVELS = ((10, "陌生人"), (30, "初识"), (60, "熟人"), (100, "朋友"), (200, "好友"))
+TOP_RELATIONSHIP_LEVEL = "挚友"
+
+# 规则推测中沟通风格和情感分析使用的最近消息数
+PROFILE_RECENT_MESSAGES = 100
+
+# 规则引擎关键词计数：HASH 关键词 -> 累计次数，另有保留字段记录检查点和词库版本
+# 聊天历史会被截断，检查点使用单调递增的消息序号 user:{id}:chat_history_seq
+KEYWORD_CHECKPOINT_FIELD = "_checkpoint"
+KEYWORD_DICTIONARY_FIELD = "_dictionary"
+
+# 读取检查点之后的新消息；没有检查点或词库版本变化时返回全部历史用于重建
+# KEYS: 聊天历史, 消息序号, 关键词计数  ARGV: 词库版本
+# 返回: {消息序号, 是否重建, 检查点, 消息列表}
+READ_NEW_MESSAGES_SCRIPT = """
+local seq = tonumber(redis.call('GET', KEYS[2]) or '0')
+local checkpoint = redis.call('HGET', KEYS[3], '_checkpoint')
+if not checkpoint or redis.call('HGET', KEYS[3], '_dictionary') ~= ARGV[1] then
+    return {seq, 1, checkpoint or '', redis.call('LRANGE', KEYS[1], 0, -1)}
+end
+local new = seq - tonumber(checkpoint)
+if new <= 0 then
+    return {seq, 0, checkpoint, {}}
+end
+return {seq, 0, checkpoint, redis.call('LRANGE', KEYS[1], -new, -1)}
+"""
+
+# 累加计数并推进检查点；检查点已被其他进程推进时放弃（避免重复累加）
+# KEYS: 关键词计数  ARGV: 读取时的检查点（没有时为空）, 新检查点, 词库版本, 是否重建, 关键词1, 次数1, ...
+APPLY_KEYWORD_COUNTS_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], '_checkpoint') or ''
+if current ~= ARGV[1] then
+    return 0
+end
+if ARGV[4] == '1' then
+    redis.call('DEL', KEYS[1])
+end
+for i = 5, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('HSET', KEYS[1], '_checkpoint', ARGV[2], '_dictionary', ARGV[3])
+return 1
+"""
 
 
 class UserProfileService:
-    """用户画像服务（统一版本）"""
+    """用户画像服务（统一版本）
+    
+    同步方法供后台任务线程使用；`*_async` 方法和 `init_user` 使用异步客户端，
+    供 FastAPI 请求处理路径使用，避免阻塞事件循环。
+    """
     
-    def __init__(self, redis_client: redis.Redis, llm_analyzer=None):
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        llm_analyzer=None,
+        async_redis: Optional[aioredis.Redis] = None
+    ):
         self.redis = redis_client
+        self.async_redis = async_redis
         self.llm_analyzer = llm_analyzer  # 可选的LLM分析器
         
+        # 用户ID映射缓存（raw_id -> user_id）
+        self.user_id_cache_size = int(os.getenv("USER_ID_CACHE_SIZE", 10000))
+        self.user_id_write_behind = os.getenv("USER_ID_WRITE_BEHIND", "false").lower() == "true"
+        self._user_id_cache: "OrderedDict[str, str]" = OrderedDict()
+        self._user_id_lock = threading.Lock()
+        self._pending_mapping_writes = set()
+        
+        self.dirty_visibility_timeout = float(os.getenv("PROFILE_VISIBILITY_TIMEOUT", 300))
+        self._claim_dirty_script = redis_client.register_script(CLAIM_DIRTY_SCRIPT)
+        self._ack_dirty_script = redis_client.register_script(ACK_DIRTY_SCRIPT)
+        self._write_profile_script = redis_client.register_script(WRITE_PROFILE_SCRIPT)
+        self._read_new_messages = redis_client.register_script(READ_NEW_MESSAGES_SCRIPT)
+        self._apply_keyword_counts = redis_client.register_script(APPLY_KEYWORD_COUNTS_SCRIPT)
+        self._backfill_rollup = redis_client.register_script(behavior_rollup.BACKFILL_SCRIPT)
+        self._backfill_rollup_async = (
+            async_redis.register_script(behavior_rollup.BACKFILL_SCRIPT) if async_redis is not None else None
+        )
+        
         # 延迟导入以避免循环依赖
         self._inference_service = None
         self._models_loaded = False
     
-    def get_user_id(self, raw_id: str = "default") -> str:
-        """生成或获取用户ID"""
+    @staticmethod
+    def _user_mapping(raw_id: str) -> Tuple[str, str]:
+        """返回用户映射键和新用户应分配的ID"""
         if not raw_id or raw_id == "default":
-            default_key = "user:default:mapping"
-            existing_id = self.redis.get(default_key)
-            if existing_id:
-                return existing_id.decode() if isinstance(existing_id, bytes) else existing_id
-            
             user_id = hashlib.md5(f"default_{datetime.now().isoformat()}".encode()).hexdigest()
-            self.redis.set(default_key, user_id)
+            return "user:default:mapping", user_id
+        
+        return f"user:{raw_id}:mapping", hashlib.md5(raw_id.encode()).hexdigest()
+    
+    # ==================== 用户ID映射（进程内LRU缓存） ====================
+    # 映射一经创建不再变化，命中缓存时不访问 Redis。
+    # 未命中时用 SET NX + GET 在一次往返内写入或读取已有映射，
+    # 并发的首次请求都会拿到先写入者的ID（避免 default 用户被分配两个ID）。
+    
+    def _cache_get_user_id(self, raw_key: str) -> Optional[str]:
+        with self._user_id_lock:
+            user_id = self._user_id_cache.get(raw_key)
+            if user_id is not None:
+                self._user_id_cache.move_to_end(raw_key)
+            return user_id
+    
+    def _cache_put_user_id(self, raw_key: str, user_id: str):
+        with self._user_id_lock:
+            self._user_id_cache[raw_key] = user_id
+            self._user_id_cache.move_to_end(raw_key)
+            while len(self._user_id_cache) > self.user_id_cache_size:
+                self._user_id_cache.popitem(last=False)
+    
+    def get_user_id(self, raw_id: str = "default") -> str:
+        """生成或获取用户ID"""
+        raw_key = raw_id or "default"
+        user_id = self._cache_get_user_id(raw_key)
+        if user_id is not None:
+            return user_id
+        
+        mapping_key, new_id = self._user_mapping(raw_id)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.set(mapping_key, new_id, nx=True)
+        pipe.get(mapping_key)
+        _, existing_id = pipe.execute()
+        
+        user_id = existing_id.decode() if isinstance(existing_id, bytes) else existing_id
+        self._cache_put_user_id(raw_key, user_id)
+        return user_id
+    
+    async def get_user_id_async(self, raw_id: str = "default") -> str:
+        """生成或获取用户ID（异步版本）"""
+        raw_key = raw_id or "default"
+        user_id = self._cache_get_user_id(raw_key)
+        if user_id is not None:
             return user_id
         
-        mapping_key = f"user:{raw_id}:mapping"
-        existing_id = self.redis.get(mapping_key)
-        if existing_id:
-            return existing_id.decode() if isinstance(existing_id, bytes) else existing_id
+        mapping_key, new_id = self._user_mapping(raw_id)
         
-        user_id = hashlib.md5(raw_id.encode()).hexdigest()
-        self.redis.set(mapping_key, user_id)
+        # 非 default 用户的ID就是 md5(raw_id)，可以先返回，映射在后台写入
+        if self.user_id_write_behind and raw_key != "default":
+            self._cache_put_user_id(raw_key, new_id)
+            task = asyncio.create_task(self._write_user_mapping(raw_key, mapping_key, new_id))
+            self._pending_mapping_writes.add(task)
+            task.add_done_callback(self._pending_mapping_writes.discard)
+            return new_id
+        
+        return await self._write_user_mapping(raw_key, mapping_key, new_id)
+    
+    async def get_user_ids_async(self, raw_ids: List[str]) -> Dict[str, str]:
+        """批量生成或获取用户ID，返回 raw_id -> user_id（未命中缓存的在一个事务中写入或读取映射）"""
+        resolved = {}
+        missing = []
+        for raw_id in dict.fromkeys(raw_ids):
+            user_id = self._cache_get_user_id(raw_id or "default")
+            if user_id is not None:
+                resolved[raw_id] = user_id
+            else:
+                missing.append(raw_id)
+        
+        if not missing:
+            return resolved
+        
+        if self.user_id_write_behind:
+            for raw_id in missing:
+                resolved[raw_id] = await self.get_user_id_async(raw_id)
+            return resolved
+        
+        pipe = self.async_redis.pipeline(transaction=True)
+        for raw_id in missing:
+            mapping_key, new_id = self._user_mapping(raw_id)
+            pipe.set(mapping_key, new_id, nx=True)
+            pipe.get(mapping_key)
+        results = await pipe.execute()
+        
+        for raw_id, existing_id in zip(missing, results[1::2]):
+            user_id = existing_id.decode() if isinstance(existing_id, bytes) else existing_id
+            self._cache_put_user_id(raw_id or "default", user_id)
+            resolved[raw_id] = user_id
+        return resolved
+    
+    async def _write_user_mapping(self, raw_key: str, mapping_key: str, new_id: str) -> str:
+        """写入映射（已存在则保留原值），返回最终生效的用户ID并放入缓存"""
+        try:
+            pipe = self.async_redis.pipeline(transaction=True)
+            pipe.set(mapping_key, new_id, nx=True)
+            pipe.get(mapping_key)
+            _, existing_id = await pipe.execute()
+        except Exception as e:
+            if not self.user_id_write_behind:
+                raise
+            print(f"⚠️  用户映射写入失败 {raw_key}: {str(e)}")
+            return new_id
+        
+        user_id = existing_id.decode() if isinstance(existing_id, bytes) else existing_id
+        self._cache_put_user_id(raw_key, user_id)
         return user_id
     
     async def init_user(self, user_id: str):
         """初始化用户画像"""
         profile_key = f"user:{user_id}:profile"
         
-        if self.redis.exists(profile_key):
+        if await self.async_redis.exists(profile_key):
             return
         
         initial_profile = {
@@ -63,7 +284,7 @@ class UserProfileService:
             "chat_style": json.dumps({}),
         }
         
-        self.redis.hset(profile_key, mapping=initial_profile)
+        await self.async_redis.hset(profile_key, mapping=initial_profile)
         print(f"✅ 初始化用户画像: {user_id}")
     
     def get_user_profile(self, user_id: str) -> Optional[Dict]:
@@ -71,6 +292,18 @@ class UserProfileService:
         profile_key = f"user:{user_id}:profile"
         data = self.redis.hgetall(profile_key)
         
+        return self.parse_profile(data)
+    
+    async def get_user_profile_async(self, user_id: str) -> Optional[Dict]:
+        """获取用户画像（异步版本）"""
+        profile_key = f"user:{user_id}:profile"
+        data = await self.async_redis.hgetall(profile_key)
+        
+        return self.parse_profile(data)
+    
+    @staticmethod
+    def parse_profile(data: Dict) -> Optional[Dict]:
+        """解析 Redis 中的画像哈希（供流水线读取复用）"""
         if not data:
             return None
         
@@ -99,15 +332,18 @@ class UserProfileService:
             "timestamp": datetime.now().isoformat()
         }
         
-        self.redis.rpush(history_key, json.dumps(message))
-        self.redis.ltrim(history_key, -500, -1)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.rpush(history_key, record_codec.encode(message))
+        pipe.ltrim(history_key, -500, -1)
+        pipe.incr(f"user:{user_id}:chat_history_seq")
+        pipe.execute()
     
     def get_chat_history(self, user_id: str, limit: int = 100) -> List[Dict]:
         """获取聊天历史"""
         history_key = f"user:{user_id}:chat_history"
         messages = self.redis.lrange(history_key, -limit, -1)
         
-        return [json.loads(msg) for msg in messages]
+        return record_codec.decode_many(messages)
     
     def record_behavior(self, user_id: str, behavior_type: str, metadata: Dict = None):
         """记录用户行为"""
@@ -119,8 +355,160 @@ class UserProfileService:
             "metadata": metadata or {}
         }
         
-        self.redis.rpush(behavior_key, json.dumps(behavior))
-        self.redis.ltrim(behavior_key, -200, -1)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.rpush(behavior_key, record_codec.encode(behavior))
+        pipe.ltrim(behavior_key, -200, -1)
+        behavior_rollup.record(pipe, user_id, [behavior])
+        self.mark_profile_dirty(pipe, user_id)
+        pipe.execute()
+    
+    async def record_behavior_async(self, user_id: str, behavior_type: str, metadata: Dict = None):
+        """记录用户行为（异步版本，单次流水线往返）"""
+        behavior_key = f"user:{user_id}:behaviors"
+        
+        behavior = {
+            "type": behavior_type,
+            "timestamp": datetime.now().isoformat(),
+            "metadata": metadata or {}
+        }
+        
+        pipe = self.async_redis.pipeline(transaction=False)
+        pipe.rpush(behavior_key, record_codec.encode(behavior))
+        pipe.ltrim(behavior_key, -200, -1)
+        behavior_rollup.record(pipe, user_id, [behavior])
+        self.mark_profile_dirty(pipe, user_id)
+        await pipe.execute()
+    
+    async def record_behaviors_async(self, behaviors_by_user: Dict[str, List[Tuple[str, Dict]]]) -> int:
+        """批量记录多个用户的行为（单次流水线往返），返回记录的条数"""
+        pipe = self.async_redis.pipeline(transaction=False)
+        recorded = self.queue_behaviors(pipe, behaviors_by_user)
+        if recorded:
+            await pipe.execute()
+        return recorded
+    
+    def queue_behaviors(self, pipe, behaviors_by_user: Dict[str, List[Tuple[str, Dict]]]) -> int:
+        """把批量行为写入加入调用方的流水线，返回行为条数
+        
+        behaviors_by_user: user_id -> [(行为类型, metadata)]，每个用户一次 RPUSH 和一次 LTRIM
+        """
+        now = datetime.now().isoformat()
+        recorded = 0
+        
+        for user_id, events in behaviors_by_user.items():
+            if not events:
+                continue
+            behavior_key = f"user:{user_id}:behaviors"
+            behaviors = [
+                {"type": behavior_type, "timestamp": now, "metadata": metadata or {}}
+                for behavior_type, metadata in events
+            ]
+            pipe.rpush(behavior_key, *record_codec.encode_many(behaviors))
+            pipe.ltrim(behavior_key, -200, -1)
+            behavior_rollup.record(pipe, user_id, behaviors)
+            self.mark_profile_dirty(pipe, user_id)
+            recorded += len(behaviors)
+        return recorded
+    
+    async def get_behaviors_async(self, user_id: str) -> List[Dict]:
+        """获取用户行为记录（异步版本，跳过无法解析的条目）"""
+        behavior_key = f"user:{user_id}:behaviors"
+        behaviors_raw = await self.async_redis.lrange(behavior_key, 0, -1)
+        return self._parse_behaviors(behaviors_raw)
+    
+    @staticmethod
+    def _parse_behaviors(behaviors_raw: List) -> List[Dict]:
+        behaviors = []
+        for b in behaviors_raw:
+            try:
+                behaviors.append(record_codec.decode(b))
+            except:
+                continue
+        return behaviors
+    
+    # ==================== 行为汇总 ====================
+    # 行为写入时在同一流水线中更新汇总（见 services/behavior_rollup.py），分析接口直接读取汇总。
+    # 汇总为空但有行为列表时（汇总功能上线前的用户），从列表补建一次。
+    
+    @staticmethod
+    def _read_rollup(pipe, user_id: str):
+        """把读取汇总的命令加入流水线（两个回复：汇总哈希、时间范围）"""
+        pipe.hgetall(behavior_rollup.rollup_key(user_id))
+        pipe.zrange(behavior_rollup.span_key(user_id), 0, -1, withscores=True)
+    
+    def get_behavior_rollup(self, user_id: str) -> BehaviorRollup:
+        """读取行为汇总"""
+        pipe = self.redis.pipeline(transaction=False)
+        self._read_rollup(pipe, user_id)
+        fields, span = pipe.execute()
+        
+        if not fields:
+            behaviors = self._parse_behaviors(self.redis.lrange(f"user:{user_id}:behaviors", 0, -1))
+            if behaviors:
+                pipe = self.redis.pipeline(transaction=False)
+                self._backfill_rollup(
+                    keys=[behavior_rollup.rollup_key(user_id), behavior_rollup.span_key(user_id)],
+                    args=behavior_rollup.backfill_args(behaviors),
+                    client=pipe
+                )
+                self._read_rollup(pipe, user_id)
+                _, fields, span = pipe.execute()
+        return BehaviorRollup(fields, span)
+    
+    async def get_behavior_rollup_async(self, user_id: str) -> BehaviorRollup:
+        """读取行为汇总（异步版本）"""
+        pipe = self.async_redis.pipeline(transaction=False)
+        self._read_rollup(pipe, user_id)
+        fields, span = await pipe.execute()
+        
+        if not fields:
+            behaviors = await self.get_behaviors_async(user_id)
+            if behaviors:
+                await self._backfill_rollup_async(
+                    keys=[behavior_rollup.rollup_key(user_id), behavior_rollup.span_key(user_id)],
+                    args=behavior_rollup.backfill_args(behaviors)
+                )
+                pipe = self.async_redis.pipeline(transaction=False)
+                self._read_rollup(pipe, user_id)
+                fields, span = await pipe.execute()
+        return BehaviorRollup(fields, span)
+    
+    # ==================== 待刷新画像索引 ====================
+    # 聊天回合和行为写入时把用户加入索引，后台任务按最久未处理的顺序分批取出，
+    # 刷新成本只与活跃用户数有关，不再扫描全部键。
+    
+    @staticmethod
+    def mark_profile_dirty(pipe, user_id: str):
+        """把用户加入待刷新索引并唤醒后台任务（加入调用方的流水线，同步/异步均可）"""
+        pipe.zadd(PROFILE_DIRTY_KEY, {user_id: time.time()})
+        task_signals.push_signal(pipe, task_signals.PROFILE)
+    
+    def claim_dirty_users(self, limit: int = 10) -> Tuple[List[str], float]:
+        """领取最多 limit 个已到期的待刷新用户，返回 (用户列表, 可见性超时时间)
+        
+        处理完成后调用 ack_dirty_users；超时前未确认的用户会被重新领取
+        """
+        now = time.time()
+        deadline = now + self.dirty_visibility_timeout
+        users = self._claim_dirty_script(keys=[PROFILE_DIRTY_KEY], args=[now, limit, deadline])
+        return [u.decode() if isinstance(u, bytes) else u for u in users], deadline
+    
+    def ack_dirty_users(self, user_ids: List[str], deadline: float) -> int:
+        """确认领取的用户已处理（处理期间重新标记或被推迟的用户保留在索引中）"""
+        if not user_ids:
+            return 0
+        return int(self._ack_dirty_script(keys=[PROFILE_DIRTY_KEY], args=[deadline, *user_ids]))
+    
+    def defer_profile_update(self, user_id: str, eligible_at: float):
+        """推迟已领取用户的画像刷新（替换可见性超时时间）"""
+        self.redis.zadd(PROFILE_DIRTY_KEY, {user_id: eligible_at})
+    
+    def next_dirty_due_in(self) -> Optional[float]:
+        """距离下一个待刷新用户到期的秒数，索引为空时返回 None"""
+        entries = self.redis.zrange(PROFILE_DIRTY_KEY, 0, 0, withscores=True)
+        if not entries:
+            return None
+        return max(entries[0][1] - time.time(), 0.0)
     
     def update_last_seen(self, user_id: str):
         """更新最后活跃时间"""
@@ -159,18 +547,10 @@ class UserProfileService:
     
     def _calculate_relationship_level(self, score: int) -> str:
         """计算关系等级"""
-        if score < 10:
-            return "陌生人"
-        elif score < 30:
-            return "初识"
-        elif score < 60:
-            return "熟人"
-        elif score < 100:
-            return "朋友"
-        elif score < 200:
-            return "好友"
-        else:
-            return "挚友"
+        for upper, level in RELATIONSHIP_LEVELS:
+            if score < upper:
+                return level
+        return TOP_RELATIONSHIP_LEVEL
     
     def calculate_intimacy(self, user_id: str) -> int:
         """计算当前亲密度"""
@@ -196,8 +576,10 @@ class UserProfileService:
     
     def get_chat_context_prompt(self, user_id: str) -> str:
         """生成个性化聊天上下文提示"""
-        profile = self.get_user_profile(user_id)
-        
+        return self.build_chat_context_prompt(self.get_user_profile(user_id))
+    
+    def build_chat_context_prompt(self, profile: Optional[Dict]) -> str:
+        """根据已读取的画像生成个性化聊天上下文提示"""
         if not profile:
             return ""
         
@@ -259,6 +641,9 @@ class UserProfileService:
             except Exception as e:
                 print(f"⚠️  无法加载推测服务: {str(e)}")
                 self._inference_service = None
+        else:
+            # 词库文件修改后自动重新加载
+            self._inference_service.reload_if_changed()
         return self._inference_service
     
     async def update_enhanced_profile(self, user_id: str, force_llm: bool = False):
@@ -269,94 +654,159 @@ class UserProfileService:
             user_id: 用户ID
             force_llm: 是否强制使用LLM分析（默认根据消息数量自动判断）
         """
+        await self.update_profiles_batch([user_id], force_llm=force_llm)
+    
+    async def update_profiles_batch(
+        self,
+        user_ids: List[str],
+        executor: Optional[Executor] = None,
+        force_llm: bool = False,
+        fencing_tokens: Optional[Dict[str, int]] = None
+    ) -> Dict[str, List[str]]:
+        """
+        批量更新用户画像：一个流水线读取整批输入，规则推测和行为分析分发到 executor
+        （进程池；为空时在当前线程执行），结果在一个流水线中写回
+        
+        fencing_tokens: 用户ID -> 租约防护令牌；租约过期后其他进程已写入更新的结果时，
+        本次结果不写入（计入 stale）
+        
+        Returns:
+            {"updated": [...], "failed": [...], "stale": [...]}
+        """
+        outcome = {"updated": [], "failed": [], "stale": []}
+        if not user_ids:
+            return outcome
+        
+        inference_service = self._get_inference_service()
+        if inference_service is None:
+            print(f"  ⚠️  规则引擎未加载，跳过 {len(user_ids)} 个用户的画像更新")
+            outcome["failed"] = list(user_ids)
+            return outcome
+        
         try:
-            # 获取聊天历史
-            messages = self.get_chat_history(user_id, limit=100)
-            
-            # 🔧 降低消息数量限制，从5降到2
-            if len(messages) < 2:
-                print(f"  ⏭️  用户 {user_id[:8]} 消息太少({len(messages)}条)，跳过更新")
-                return
-            
-            # 1. 使用规则引擎进行快速推测
-            inference_service = self._get_inference_service()
-            if inference_service:
-                await self._update_from_rules(user_id, messages, inference_service)
+            payloads = self._fetch_inference_inputs(user_ids, inference_service.dictionary_version)
+        except Exception as e:
+            print(f"❌ 读取画像输入失败: {str(e)}")
+            outcome["failed"] = list(user_ids)
+            return outcome
+        
+        # 1. 规则引擎和行为分析（CPU 计算，批量时分发到进程池）
+        if executor is not None and len(payloads) > 1:
+            loop = asyncio.get_running_loop()
+            results = await asyncio.gather(
+                *(loop.run_in_executor(executor, profile_inference.analyze_user, payload) for payload in payloads),
+                return_exceptions=True
+            )
+        else:
+            results = []
+            for payload in payloads:
+                try:
+                    results.append(profile_inference.analyze_user(payload, inference_service))
+                except Exception as e:
+                    results.append(e)
+        
+        analyzed = []
+        for payload, result in zip(payloads, results):
+            if isinstance(result, Exception):
+                print(f"❌ 画像更新失败 {payload['user_id'][:8]}: {str(result)}")
+                outcome["failed"].append(payload["user_id"])
             else:
-                print(f"  ⚠️  用户 {user_id[:8]} 规则引擎未加载")
-            
-            # 2. 如果有LLM分析器且消息足够多，使用LLM深度分析
-            if self.llm_analyzer and (len(messages) >= 8 or force_llm):
+                analyzed.append((payload, result))
+        
+        try:
+            stale = self._write_inference_results(analyzed, fencing_tokens or {})
+        except Exception as e:
+            print(f"❌ 写回画像失败: {str(e)}")
+            outcome["failed"].extend(payload["user_id"] for payload, _ in analyzed)
+            return outcome
+        
+        # 2. 如果有LLM分析器且消息足够多，使用LLM深度分析
+        for payload, result in analyzed:
+            user_id = payload["user_id"]
+            message_count = result["message_count"]
+            if user_id in stale:
+                print(f"  ⏭️  用户 {user_id[:8]} 的租约已过期，其他进程已写入更新的画像")
+                outcome["stale"].append(user_id)
+                continue
+            if message_count < 2:
+                print(f"  ⏭️  用户 {user_id[:8]} 消息太少({message_count}条)，跳过更新")
+            elif self.llm_analyzer and (message_count >= 8 or force_llm):
+                messages = record_codec.decode_many(payload["recent_messages"])
                 await self._update_from_llm(user_id, messages)
-                print(f"✅ 用户画像已更新(含LLM): {user_id[:8]} ({len(messages)}条消息)")
+                print(f"✅ 用户画像已更新(含LLM): {user_id[:8]} ({message_count}条消息)")
             else:
-                print(f"✅ 用户画像已更新(规则): {user_id[:8]} ({len(messages)}条消息)")
-            
-        except Exception as e:
-            print(f"❌ 画像更新失败 {user_id[:8]}: {str(e)}")
-            import traceback
-            traceback.print_exc()
+                print(f"✅ 用户画像已更新(规则): {user_id[:8]} ({message_count}条消息)")
+            outcome["updated"].append(user_id)
+        
+        return outcome
     
-    async def _update_from_rules(self, user_id: str, messages: List[Dict], inference_service):
-        """使用规则引擎更新画像"""
-        try:
-            # 推测基础属性
-            inference_result = inference_service.infer_from_messages(messages)
-            
+    def _fetch_inference_inputs(self, user_ids: List[str], dictionary_version: str) -> List[Dict]:
+        """一个事务读取整批用户的推测输入（关键词检查点之后的新消息、最近聊天、当前画像字段）"""
+        pipe = self.redis.pipeline(transaction=True)
+        for user_id in user_ids:
+            counts_key = f"user:{user_id}:keyword_counts"
+            self._read_new_messages(
+                keys=[f"user:{user_id}:chat_history", f"user:{user_id}:chat_history_seq", counts_key],
+                args=[dictionary_version],
+                client=pipe
+            )
+            pipe.hgetall(counts_key)
+            pipe.lrange(f"user:{user_id}:chat_history", -PROFILE_RECENT_MESSAGES, -1)
+            pipe.hmget(f"user:{user_id}:profile", "occupation_data", "interests")
+        responses = pipe.execute()
+        
+        payloads = []
+        for i, user_id in enumerate(user_ids):
+            (seq, rebuild, checkpoint, new_messages), stored_counts, recent, (occupation, interests) = \
+                responses[i * 4:(i + 1) * 4]
+            payloads.append({
+                "user_id": user_id,
+                "dictionary_version": dictionary_version,
+                "seq": seq,
+                "rebuild": rebuild,
+                "checkpoint": checkpoint,
+                "new_messages": new_messages,
+                "stored_counts": stored_counts,
+                "recent_messages": recent,
+                "current_occupation": occupation,
+                "current_interests": interests
+            })
+        return payloads
+    
+    def _write_inference_results(self, analyzed: List[Tuple[Dict, Dict]], fencing_tokens: Dict[str, int]) -> set:
+        """一个流水线写回整批分析结果，返回因防护令牌过期而未写入画像的用户"""
+        if not analyzed:
+            return set()
+        
+        pipe = self.redis.pipeline(transaction=False)
+        profile_writes = []
+        for payload, result in analyzed:
+            user_id = payload["user_id"]
             profile_key = f"user:{user_id}:profile"
             
-            # 更新职业
-            if inference_result.get("occupation"):
-                occupation, confidence = inference_result["occupation"]
-                if confidence > 0.5:
-                    current_data = self.redis.hget(profile_key, "occupation_data")
-                    if not current_data or confidence > 0.6:  # 新数据或更高置信度才更新
-                        occupation_data = json.dumps({
-                            "value": occupation,
-                            "confidence": confidence
-                        }, ensure_ascii=False)
-                        self.redis.hset(profile_key, "occupation_data", occupation_data)
-            
-            # 更新年龄段
-            if inference_result.get("age_range"):
-                age_range, confidence = inference_result["age_range"]
-                if confidence > 0.4:
-                    age_data = json.dumps({
-                        "value": age_range,
-                        "confidence": confidence
-                    }, ensure_ascii=False)
-                    self.redis.hset(profile_key, "age_data", age_data)
-            
-            # 更新性别
-            if inference_result.get("gender"):
-                gender, confidence = inference_result["gender"]
-                if confidence > 0.5:
-                    gender_data = json.dumps({
-                        "value": gender,
-                        "confidence": confidence
-                    }, ensure_ascii=False)
-                    self.redis.hset(profile_key, "gender_data", gender_data)
-            
-            # 更新兴趣标签（累积）
-            if inference_result.get("interests"):
-                interests_to_add = [interest for interest, weight in inference_result["interests"]]
-                if interests_to_add:
-                    self.add_interest_tags(user_id, interests_to_add)
-            
-            # 分析沟通风格
-            comm_style = inference_service.analyze_communication_style(messages)
-            if comm_style:
-                self.redis.hset(profile_key, "communication_style", 
-                               json.dumps(comm_style, ensure_ascii=False))
-            
-            # 分析情感模式
-            emotional = inference_service.analyze_emotional_patterns(messages)
-            if emotional:
-                self.redis.hset(profile_key, "emotional_pattern",
-                               json.dumps(emotional, ensure_ascii=False))
-            
-        except Exception as e:
-            print(f"规则引擎更新失败: {str(e)}")
+            # 关键词计数：推进检查点（分析时词库版本变化则本次不累加，下次重建）
+            if result["message_count"] >= 2 and result["dictionary_version"] == payload["dictionary_version"] \
+                    and (payload["new_messages"] or payload["rebuild"]):
+                args = [payload["checkpoint"], payload["seq"], payload["dictionary_version"], payload["rebuild"]]
+                for keyword, count in result["new_counts"].items():
+                    args.extend([keyword, count])
+                self._apply_keyword_counts(keys=[f"user:{user_id}:keyword_counts"], args=args, client=pipe)
+            
+            fields = dict(result["fields"])
+            if result["interests"] is not None:
+                fields["interests"] = json.dumps(result["interests"], ensure_ascii=False)
+                print(f"✅ 更新用户兴趣标签: {user_id[:8]} -> {result['interests']}")
+            token = fencing_tokens.get(user_id, 0)
+            if fields or token:
+                args = [token]
+                for field, value in fields.items():
+                    args.extend([field, value])
+                self._write_profile_script(
+                    keys=[profile_key, f"user:{user_id}:profile_fencing_token"], args=args, client=pipe
+                )
+                profile_writes.append((user_id, len(pipe) - 1))
+        responses = pipe.execute()
+        return {user_id for user_id, index in profile_writes if not responses[index]}
     
     async def _update_from_llm(self, user_id: str, messages: List[Dict]):
         """使用LLM深度分析更新画像"""
@@ -528,32 +978,21 @@ class UserProfileService:
         return summary
     
     def _analyze_user_behaviors(self, user_id: str) -> Dict[str, Any]:
-        """分析用户行为数据"""
+        """分析用户行为数据（基于写入时维护的行为汇总）"""
         try:
             # 导入行为分析器
             from services.behavior_analyzer import behavior_analyzer
             
-            # 获取用户行为数据
-            behavior_key = f"user:{user_id}:behaviors"
-            behaviors_raw = self.redis.lrange(behavior_key, 0, -1)
+            rollup = self.get_behavior_rollup(user_id)
             
-            if not behaviors_raw:
+            if not rollup.total:
                 return {
                     "total_behaviors": 0,
                     "message": "暂无行为数据"
                 }
             
-            # 解析行为数据
-            behaviors = []
-            for b in behaviors_raw:
-                try:
-                    behavior = json.loads(b)
-                    behaviors.append(behavior)
-                except:
-                    continue
-            
             # 使用行为分析器生成完整分析
-            analysis = behavior_analyzer.generate_behavior_summary(behaviors)
+            analysis = behavior_analyzer.generate_behavior_summary(rollup)
             
             return analysis
             
@@ -0,0 +1,36 @@
+"""
+测试公共夹具：fakeredis（带 Lua）共享同一份数据的同步/异步客户端
+"""
+
+import asyncio
+import os
+import sys
+
+import fakeredis
+import pytest
+from fakeredis import aioredis as fake_aioredis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def fake_server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def redis_client(fake_server):
+    return fakeredis.FakeRedis(server=fake_server, decode_responses=False)
+
+
+@pytest.fixture
+def async_redis_client(fake_server):
+    return fake_aioredis.FakeRedis(server=fake_server, decode_responses=False)
+
+
+@pytest.fixture
+def run():
+    """在同一个事件循环中运行协程（异步客户端的连接绑定在创建它的事件循环上）"""
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from services.ai_provider import AIProvider
+from services.provider_health import ProviderHealth
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    ai = AIProvider()
+    ai.providers = [
+        {"name": "primary", "type": "direct_api", "model": "a", "priority": 0, "health": ProviderHealth("primary")},
+        {"name": "backup", "type": "openai_sdk", "model": "b", "priority": 1, "health": ProviderHealth("backup")}
+    ]
+    ai.hedge_enabled = True
+    ai.hedge_default_delay = 0.02
+    ai.calls = {"primary": {"delay": 0.01, "error": None}, "backup": {"delay": 0.01, "error": None}}
+
+    def fake(name):
+        async def call(self, provider, messages):
+            behaviour = ai.calls[name]
+            await asyncio.sleep(behaviour["delay"])
+            if behaviour["error"]:
+                raise Exception(behaviour["error"])
+            return name, {"prompt_tokens": 10, "total_tokens": 15}
+        return call
+
+    monkeypatch.setattr(AIProvider, "_call_direct_api", fake("primary"))
+    monkeypatch.setattr(AIProvider, "_call_openai_sdk", fake("backup"))
+    return ai
+
+
+def test_fast_primary_is_not_hedged(provider, run):
+    assert run(provider.send_message("你好", [])) == "primary"
+    assert provider.hedge_stats == {"requests": 1, "hedged": 0, "hedge_wins": 0, "extra_tokens": 0}
+
+
+def test_cancelled_in_flight_loser_counts_its_prompt(provider, run):
+    provider.calls["primary"]["delay"] = 1
+
+    assert run(provider.send_message("你好", [])) == "backup"
+    assert provider.hedge_stats["hedge_wins"] == 1
+    assert provider.hedge_stats["extra_tokens"] == 10
+
+
+def test_loser_that_already_failed_is_not_counted(provider, run):
+    provider.calls["primary"].update(delay=0.04, error="boom")
+    provider.calls["backup"]["delay"] = 0.1
+
+    assert run(provider.send_message("你好", [])) == "backup"
+    assert provider.hedge_stats["hedged"] == 1
+    assert provider.hedge_stats["extra_tokens"] == 0
+
+
+def test_loser_still_queued_for_a_slot_is_not_counted(provider, run):
+    provider.calls["primary"]["delay"] = 0.1
+
+    async def send_while_backup_is_busy():
+        provider.set_concurrency_limit("backup", 1)
+        async with provider.concurrency_limits["backup"]:
+            return await provider.send_message("你好", [])
+
+    assert run(send_while_backup_is_busy()) == "primary"
+    assert provider.hedge_stats["hedged"] == 1
+    assert provider.hedge_stats["extra_tokens"] == 0
@@ -0,0 +1,55 @@
+import asyncio
+import json
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from services.ai_provider import AIProvider
+from services.provider_health import ProviderHealth
+
+
+def _sse_handler(pieces, interval, stall=0):
+    async def handler(request):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for piece in pieces:
+            await asyncio.sleep(interval)
+            chunk = {"choices": [{"delta": {"content": piece}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await asyncio.sleep(stall)
+        await response.write(b"data: [DONE]\n\n")
+        return response
+    return handler
+
+
+async def _stream(handler, total_timeout, read_timeout):
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", handler)
+    async with TestServer(app) as server:
+        ai = AIProvider()
+        ai.http_timeout = aiohttp.ClientTimeout(total=total_timeout)
+        ai.http_stream_timeout = aiohttp.ClientTimeout(total=None, sock_read=read_timeout)
+        provider = {
+            "name": "siliconflow", "type": "direct_api", "api_key": "k", "model": "m",
+            "base_url": str(server.make_url("/v1")), "priority": 0, "health": ProviderHealth("siliconflow")
+        }
+        try:
+            return [piece async for piece in ai._stream_direct_api(provider, [{"role": "user", "content": "你好"}])]
+        finally:
+            await ai.close()
+
+
+def test_stream_may_outlast_the_pooled_total_timeout(run):
+    pieces = ["喵", "~", "你", "好", "呀"]
+    handler = _sse_handler(pieces, interval=0.1)
+
+    assert run(_stream(handler, total_timeout=0.3, read_timeout=1)) == pieces
+
+
+def test_stalled_stream_hits_the_read_timeout(run):
+    handler = _sse_handler(["喵"], interval=0, stall=1)
+
+    with pytest.raises(asyncio.TimeoutError):
+        run(_stream(handler, total_timeout=30, read_timeout=0.2))
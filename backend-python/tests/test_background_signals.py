@@ -0,0 +1,57 @@
+from services import task_signals
+from services.background_tasks import BackgroundTaskManager
+from services.session_manager import SessionManager
+from services.user_profile_service import UserProfileService
+
+
+def _manager(redis_client):
+    manager = BackgroundTaskManager(SessionManager(redis_client), UserProfileService(redis_client))
+    manager.batch_window = 0
+    return manager
+
+
+def test_queued_work_wakes_the_worker(redis_client, async_redis_client, run):
+    manager = _manager(redis_client)
+    manager.session_manager.summary_queue.mark("s1", delay=60)
+
+    pipe = redis_client.pipeline()
+    task_signals.push_signal(pipe, task_signals.PROFILE)
+    pipe.execute()
+
+    assert run(manager._wait_for_signals(async_redis_client)) == {task_signals.SUMMARY, task_signals.PROFILE}
+    assert redis_client.llen(task_signals.SIGNAL_KEY) == 0
+
+
+def test_due_summary_task_returns_without_blocking(redis_client, async_redis_client, run):
+    manager = _manager(redis_client)
+    manager.idle_timeout = 3600
+    # 到期的重试任务不会推送信号，由等待超时兜底
+    manager.session_manager.summary_queue.mark("s1")
+    redis_client.delete(task_signals.SIGNAL_KEY)
+
+    assert run(manager._wait_for_signals(async_redis_client)) == {task_signals.SUMMARY}
+
+
+def test_signal_list_is_capped(redis_client):
+    pipe = redis_client.pipeline()
+    for _ in range(task_signals.SIGNAL_MAX + 10):
+        task_signals.push_signal(pipe, task_signals.PROFILE)
+    pipe.execute()
+
+    assert redis_client.llen(task_signals.SIGNAL_KEY) == task_signals.SIGNAL_MAX
+
+
+def test_wait_for_signals_takes_a_bounded_share(redis_client, async_redis_client, run):
+    manager = _manager(redis_client)
+
+    pipe = redis_client.pipeline()
+    for _ in range(task_signals.SIGNAL_POP_MAX * 2):
+        task_signals.push_signal(pipe, task_signals.PROFILE)
+    task_signals.push_signal(pipe, task_signals.SUMMARY)
+    pipe.execute()
+    total = redis_client.llen(task_signals.SIGNAL_KEY)
+
+    kinds = run(manager._wait_for_signals(async_redis_client))
+    assert kinds == {task_signals.SUMMARY, task_signals.PROFILE}
+    # 其余信号留给其他工作进程
+    assert redis_client.llen(task_signals.SIGNAL_KEY) == total - task_signals.SIGNAL_POP_MAX
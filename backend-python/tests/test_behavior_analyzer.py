@@ -0,0 +1,98 @@
+from services.behavior_analyzer import BehaviorColumns, behavior_analyzer
+
+# 固定的行为样本；期望结果由列式改写之前的逐条分析实现计算得到
+BEHAVIORS = [
+    {"type": "pet_click", "timestamp": "2025-10-06T08:15:00", "metadata": {"petState": "idle"}},
+    {"type": "pet_click", "timestamp": "2025-10-06T08:40:00", "metadata": {}},
+    {"type": "pet_drag", "timestamp": "2025-10-06T21:05:00", "metadata": {}},
+    {"type": "chat_session", "timestamp": "2025-10-07T21:30:00", "metadata": {"duration": 240000, "message_count": 12}},
+    {"type": "state_change", "timestamp": "2025-10-07T22:00:00", "metadata": {"from_state": "idle", "to_state": "sleep"}},
+    {"type": "state_change", "timestamp": "2025-10-08T07:10:00", "metadata": {"from_state": "sleep", "to_state": "idle"}},
+    {"type": "state_change", "metadata": {"from_state": "idle", "to_state": "sleep", "timestamp": "2025-10-09T23:45:00.250"}},
+    {"type": "chat_session", "metadata": {"duration": 900000, "message_count": 30, "timestamp": "2025-10-10T20:00:00.500"}},
+    {"type": "pet_click", "timestamp": "2025-10-11T13:20:00", "metadata": {}},
+    {"type": "feed", "timestamp": "2025-10-12T21:10:00", "metadata": {}},
+]
+
+EXPECTED_SUMMARY = {
+    "total_behaviors": 10,
+    "interaction_patterns": {
+        "total_interactions": 10,
+        "click_count": 3,
+        "drag_count": 1,
+        "chat_count": 2,
+        "state_change_count": 3,
+        "click_ratio": 0.3,
+        "drag_ratio": 0.1,
+        "chat_ratio": 0.2,
+        "interaction_level": "极低",
+        "interaction_style": "观察型"
+    },
+    "personality_traits": {
+        "外向性": "极低",
+        "控制欲": "低",
+        "社交需求": "极低",
+        "耐心程度": "中",
+        "参与度": "中",
+        "使用习惯": "轻度用户",
+        "聊天偏好": "正常交流型"
+    },
+    "time_patterns": {
+        # 次数相同的小时按时间先后排列（改写前按首次出现顺序，为 [21, 8, 22]）
+        "peak_hours": [21, 8, 7],
+        "peak_days": ["周一", "周二", "周三"],
+        "time_pattern": "夜猫子型",
+        "total_active_hours": 7,
+        "most_active_hour": 21,
+        "hour_distribution": {8: 2, 21: 3, 22: 1, 7: 1, 23: 1, 20: 1, 13: 1}
+    },
+    "state_preferences": {
+        "total_state_changes": 3,
+        "favorite_state": "sleep",
+        "state_preferences": {"sleep": 2, "idle": 1},
+        "state_change_frequency": 0.3
+    },
+    "engagement": {
+        "score": 45.06,
+        "level": "中",
+        "breakdown": {"interaction": 3.0, "diversity": 12.5, "time_span": 4.36, "chat_depth": 25.2}
+    }
+}
+
+
+def test_summary_matches_per_behavior_analysis():
+    summary = behavior_analyzer.generate_behavior_summary(BEHAVIORS)
+    summary.pop("analyzed_at")
+    assert summary == EXPECTED_SUMMARY
+
+
+def test_mixed_aware_and_naive_timestamps_are_normalized_to_utc():
+    behaviors = [
+        {"type": "pet_click", "timestamp": "2025-10-06T08:00:00", "metadata": {}},
+        {"type": "pet_click", "metadata": {"timestamp": "2025-10-06T10:00:00.000Z"}},
+        {"type": "pet_click", "metadata": {"timestamp": "2025-10-06T20:00:00+08:00"}},
+    ]
+    columns = BehaviorColumns(behaviors)
+    # 08:00（按 UTC 计）到 12:00 UTC
+    assert columns.time_span_seconds() == 4 * 3600
+    # 时段取时间戳本身的小时
+    assert sorted(columns.hour_counter()) == [8, 10, 20]
+
+    summary = behavior_analyzer.generate_behavior_summary(behaviors)
+    assert summary["interaction_patterns"]["interaction_level"] == "低"
+
+
+def test_malformed_metadata_and_missing_types_do_not_fail():
+    behaviors = [
+        {"metadata": "oops", "timestamp": "2025-10-06T08:00:00"},
+        {"type": None, "metadata": {"timestamp": "not a time"}},
+        {"type": "chat_session", "metadata": {"duration": "long", "message_count": 4}},
+        {"type": "chat_session", "metadata": None},
+    ]
+    columns = BehaviorColumns(behaviors)
+    assert columns.count("unknown") == 2
+    assert columns.distinct_types() == 2
+    assert columns.timestamp_count == 1
+    assert columns.chat_duration_total == 0
+    assert columns.chat_message_total == 4
+    assert behavior_analyzer.generate_behavior_summary(behaviors)["total_behaviors"] == 4
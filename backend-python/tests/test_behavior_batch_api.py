@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+from models import BehaviorBatchRequest
+
+
+@pytest.fixture(scope="module")
+def run():
+    # main 中的异步客户端绑定在首次使用的事件循环上，本模块共用一个事件循环
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+def _batch(batch_id, seqs, client_id="tracker-1", user_id="api-user"):
+    return BehaviorBatchRequest(
+        client_id=client_id,
+        batch_id=batch_id,
+        behaviors=[{"user_id": user_id, "behavior_type": "pet_click", "seq": seq, "metadata": {}} for seq in seqs]
+    )
+
+
+def test_repeated_sequence_in_one_batch_is_recorded_once(run):
+    result = run(main.ingest_behavior_batch(_batch("b1", [1, 1, 2], user_id="seq-user")))
+    assert result["recorded"] == 2
+    assert result["duplicates"] == 1
+
+
+def test_copy_arriving_while_batch_is_processing_gets_409(run):
+    # 上一次请求已领取批次、尚未写入应答
+    claimed = run(main.behavior_dedup.claim("tracker-1", [20], "b2"))
+    assert claimed == {20}
+
+    with pytest.raises(HTTPException) as error:
+        run(main.ingest_behavior_batch(_batch("b2", [20], user_id="race-user")))
+    assert error.value.status_code == 409
+
+
+def test_concurrent_copies_of_a_batch_keep_the_first_ack(run):
+    async def send_twice():
+        return await asyncio.gather(
+            main.ingest_behavior_batch(_batch("b3", [30, 31, 32], user_id="race-user")),
+            main.ingest_behavior_batch(_batch("b3", [30, 31, 32], user_id="race-user")),
+            return_exceptions=True
+        )
+
+    results = run(send_twice())
+    recorded = [r for r in results if isinstance(r, dict) and not r.get("duplicate")]
+    assert len(recorded) == 1 and recorded[0]["recorded"] == 3
+    # 另一个请求要么稍后重试（409），要么拿到第一次的应答，不会写入 recorded=0 的应答
+    for other in results:
+        if other is not recorded[0]:
+            assert (isinstance(other, HTTPException) and other.status_code == 409) or other["recorded"] == 3
+
+    retried = run(main.ingest_behavior_batch(_batch("b3", [30, 31, 32], user_id="race-user")))
+    assert retried["duplicate"] is True
+    assert retried["recorded"] == 3
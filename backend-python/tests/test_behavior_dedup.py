@@ -0,0 +1,57 @@
+import asyncio
+import time
+
+from services import behavior_dedup
+from services.behavior_dedup import BehaviorDedup
+
+
+def test_claim_returns_each_new_sequence_once(async_redis_client, run):
+    dedup = BehaviorDedup(async_redis_client)
+    assert run(dedup.claim("c1", [1, 2, 2, 3])) == {1, 2, 3}
+    assert run(dedup.claim("c1", [3, 4])) == {4}
+
+
+def test_sequences_outside_the_window_are_claimable_again(async_redis_client, run):
+    dedup = BehaviorDedup(async_redis_client)
+    dedup.window = 1
+    assert run(dedup.claim("c1", [1])) == {1}
+    assert run(dedup.claim("c1", [1])) == set()
+
+    time.sleep(1.1)
+    assert run(dedup.claim("c1", [1])) == {1}
+
+
+def test_batch_is_claimed_once_until_released(async_redis_client, run):
+    dedup = BehaviorDedup(async_redis_client)
+    assert run(dedup.claim("c1", [1, 2], "b1")) == {1, 2}
+    # 同一批次的并发请求
+    assert run(dedup.claim("c1", [1, 2], "b1")) is None
+    assert run(dedup.get_ack("c1", "b1")) is None
+
+    # 写入失败：归还序号和批次，重试可以重新处理
+    run(dedup.release("c1", {1, 2}, "b1"))
+    assert run(dedup.claim("c1", [1, 2], "b1")) == {1, 2}
+
+
+def test_saved_ack_is_not_removed_by_release(async_redis_client, run):
+    dedup = BehaviorDedup(async_redis_client)
+    assert run(dedup.claim("c1", [1], "b1")) == {1}
+
+    async def save():
+        pipe = async_redis_client.pipeline()
+        dedup.save_ack(pipe, "c1", "b1", {"recorded": 1})
+        await pipe.execute()
+
+    run(save())
+    run(dedup.release("c1", set(), "b1"))
+    assert run(dedup.get_ack("c1", "b1")) == {"recorded": 1}
+    assert run(dedup.claim("c1", [1], "b1")) is None
+
+
+def test_processing_marker_expires(async_redis_client, run, monkeypatch):
+    monkeypatch.setattr(behavior_dedup, "PROCESSING_TTL", 1)
+    dedup = BehaviorDedup(async_redis_client)
+    assert run(dedup.claim("c1", [], "b1")) == set()
+    assert run(dedup.claim("c1", [], "b1")) is None
+    time.sleep(1.1)
+    assert run(dedup.claim("c1", [], "b1")) == set()
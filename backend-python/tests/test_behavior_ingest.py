@@ -0,0 +1,57 @@
+import hashlib
+
+from services import record_codec
+from services.user_profile_service import PROFILE_DIRTY_KEY, UserProfileService
+
+
+def _service(redis_client, async_redis_client):
+    return UserProfileService(redis_client, async_redis=async_redis_client)
+
+
+def test_get_user_ids_async_matches_single_lookups(redis_client, async_redis_client, run):
+    service = _service(redis_client, async_redis_client)
+    cached = service.get_user_id("alice")
+
+    ids = run(service.get_user_ids_async(["alice", "bob", "bob", "default"]))
+
+    assert ids["alice"] == cached
+    assert ids["bob"] == hashlib.md5(b"bob").hexdigest()
+    assert redis_client.get("user:bob:mapping") == ids["bob"].encode()
+    # default 用户只分配一个ID，之后的单个查询返回同一个ID
+    assert service.get_user_id("default") == ids["default"]
+
+
+def test_get_user_ids_async_keeps_existing_mapping(redis_client, async_redis_client, run):
+    redis_client.set("user:default:mapping", "existing-default-id")
+    service = _service(redis_client, async_redis_client)
+
+    assert run(service.get_user_ids_async(["default"])) == {"default": "existing-default-id"}
+
+
+def test_grouped_behaviors_are_written_per_user_in_one_pipeline(redis_client, async_redis_client, run):
+    service = _service(redis_client, async_redis_client)
+    events = {
+        "u1": [("pet_click", {"x": 1}), ("pet_drag", {})],
+        "u2": [("pet_feed", None)],
+        "u3": []
+    }
+
+    assert run(service.record_behaviors_async(events)) == 3
+
+    u1 = record_codec.decode_many(redis_client.lrange("user:u1:behaviors", 0, -1))
+    assert [(b["type"], b["metadata"]) for b in u1] == [("pet_click", {"x": 1}), ("pet_drag", {})]
+    assert record_codec.decode_many(redis_client.lrange("user:u2:behaviors", 0, -1))[0]["metadata"] == {}
+    assert not redis_client.exists("user:u3:behaviors")
+
+    assert sorted(redis_client.zrange(PROFILE_DIRTY_KEY, 0, -1)) == [b"u1", b"u2"]
+    assert run(service.get_behavior_rollup_async("u1")).total == 2
+
+
+def test_behavior_list_is_capped(redis_client, async_redis_client, run):
+    service = _service(redis_client, async_redis_client)
+
+    run(service.record_behaviors_async({"u1": [("pet_click", {"n": n}) for n in range(250)]}))
+
+    behaviors = record_codec.decode_many(redis_client.lrange("user:u1:behaviors", 0, -1))
+    assert len(behaviors) == 200
+    assert behaviors[0]["metadata"] == {"n": 50}
@@ -0,0 +1,98 @@
+import json
+import random
+from datetime import datetime, timedelta
+
+from services import behavior_rollup, record_codec
+from services.behavior_analyzer import BehaviorColumns, behavior_analyzer
+from services.user_profile_service import UserProfileService
+
+
+def _behaviors(count, seed=7):
+    rng = random.Random(seed)
+    start = datetime(2025, 10, 1)
+    behaviors = []
+    for _ in range(count):
+        moment = start + timedelta(minutes=rng.randint(0, 60 * 24 * 20))
+        behavior_type = rng.choice(["pet_click", "pet_drag", "chat_session", "state_change", "feed", None])
+        metadata = {}
+        if behavior_type == "chat_session":
+            metadata = {"duration": rng.randint(0, 900000), "message_count": rng.randint(0, 30)}
+        elif behavior_type == "state_change":
+            metadata = {"from_state": rng.choice(["idle", "sleep"]), "to_state": rng.choice(["idle", "sleep", "walk"])}
+        if rng.random() < 0.5:
+            metadata["timestamp"] = moment.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            behaviors.append({"type": behavior_type, "metadata": metadata})
+        else:
+            behaviors.append({"type": behavior_type, "timestamp": moment.isoformat(), "metadata": metadata})
+    return behaviors
+
+
+def _summary(data):
+    summary = behavior_analyzer.generate_behavior_summary(data)
+    summary.pop("analyzed_at")
+    return json.loads(json.dumps(summary, ensure_ascii=False))
+
+
+def test_incremental_rollup_matches_full_recompute(redis_client):
+    behaviors = _behaviors(300)
+    # 按不同大小的批次增量记录
+    position = 0
+    for size in [1, 7, 50, 2, 120, 120]:
+        pipe = redis_client.pipeline()
+        behavior_rollup.record(pipe, "u1", behaviors[position:position + size])
+        pipe.execute()
+        position += size
+
+    service = UserProfileService(redis_client)
+    rollup = service.get_behavior_rollup("u1")
+    assert rollup.total == 300
+    assert _summary(rollup) == _summary(behaviors)
+    assert rollup.transitions == {
+        name.partition(":")[2]: count
+        for name, count in behavior_rollup.aggregate(behaviors)[0].items()
+        if name.startswith("transition:")
+    }
+
+
+def test_backfill_builds_rollup_from_existing_list_once(redis_client):
+    behaviors = _behaviors(40, seed=3)
+    redis_client.rpush("user:u2:behaviors", *[json.dumps(b) for b in behaviors])
+
+    service = UserProfileService(redis_client)
+    assert _summary(service.get_behavior_rollup("u2")) == _summary(behaviors)
+
+    # 汇总已存在时不再覆盖
+    pipe = redis_client.pipeline()
+    behavior_rollup.record(pipe, "u2", behaviors[:1])
+    pipe.execute()
+    assert service._backfill_rollup(
+        keys=[behavior_rollup.rollup_key("u2"), behavior_rollup.span_key("u2")],
+        args=behavior_rollup.backfill_args(behaviors)
+    ) == 0
+    assert service.get_behavior_rollup("u2").total == 41
+
+
+def test_peak_hour_ties_prefer_the_earlier_hour(redis_client):
+    behaviors = [
+        {"type": "pet_click", "timestamp": "2025-10-06T22:00:00", "metadata": {}},
+        {"type": "pet_click", "timestamp": "2025-10-07T09:00:00", "metadata": {}},
+        {"type": "pet_click", "timestamp": "2025-10-08T15:00:00", "metadata": {}},
+        {"type": "pet_click", "timestamp": "2025-10-08T15:30:00", "metadata": {}},
+    ]
+    pipe = redis_client.pipeline()
+    behavior_rollup.record(pipe, "u3", behaviors)
+    pipe.execute()
+    rollup = UserProfileService(redis_client).get_behavior_rollup("u3")
+
+    for data in (behaviors, BehaviorColumns(behaviors), rollup):
+        patterns = behavior_analyzer.analyze_active_time_patterns(data)
+        assert patterns["peak_hours"] == [15, 9, 22]
+        assert patterns["most_active_hour"] == 15
+        assert patterns["peak_days"] == ["周三", "周一", "周二"]
+
+
+def test_rollup_reads_behaviors_stored_by_record_codec(redis_client):
+    behaviors = _behaviors(10, seed=11)
+    redis_client.rpush("user:u4:behaviors", *record_codec.encode_many(behaviors))
+    service = UserProfileService(redis_client)
+    assert service.get_behavior_rollup("u4").total == 10
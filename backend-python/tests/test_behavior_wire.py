@@ -0,0 +1,93 @@
+import gzip
+import json
+
+import msgpack
+import pytest
+
+from services import behavior_wire
+from services.behavior_wire import UnsupportedEncodingError, WireFormatError, decode_batch
+
+HEADER = {"c": "tracker-1", "b": "b1", "u": "alice", "s": "sess-1", "ts": 1760277600000}
+EVENTS = [
+    {"t": "pet_click", "q": 1, "d": 0, "m": {"x": 1}},
+    {"t": "pet_drag", "q": 2, "d": 1500, "u": "bob"}
+]
+EXPECTED = {
+    "client_id": "tracker-1",
+    "batch_id": "b1",
+    "behaviors": [
+        {"user_id": "alice", "behavior_type": "pet_click", "seq": 1,
+         "metadata": {"x": 1, "session_id": "sess-1", "timestamp": "2025-10-12T14:00:00.000Z"}},
+        {"user_id": "bob", "behavior_type": "pet_drag", "seq": 2,
+         "metadata": {"session_id": "sess-1", "timestamp": "2025-10-12T14:00:01.500Z"}}
+    ]
+}
+
+
+def _ndjson():
+    return "\n".join(json.dumps(line) for line in [HEADER, *EVENTS]).encode()
+
+
+def _msgpack():
+    return msgpack.packb({"h": HEADER, "e": EVENTS})
+
+
+def test_json_is_passed_through():
+    body = json.dumps(EXPECTED).encode()
+    assert decode_batch(body, "application/json; charset=utf-8") == EXPECTED
+    assert decode_batch(body, None) == EXPECTED
+
+
+def test_compact_formats_decode_like_json():
+    assert decode_batch(_ndjson(), "application/x-ndjson") == EXPECTED
+    assert decode_batch(_msgpack(), "application/msgpack") == EXPECTED
+
+
+def test_gzip_body():
+    assert decode_batch(gzip.compress(_msgpack()), "application/msgpack", "gzip") == EXPECTED
+
+
+def test_truncated_gzip_body_is_rejected():
+    body = gzip.compress(_ndjson())
+    with pytest.raises(WireFormatError):
+        decode_batch(body[:len(body) // 2], "application/x-ndjson", "gzip")
+    # 只缺少校验尾部时已解压的行都完整，也不能当作完整批次接收
+    with pytest.raises(WireFormatError, match="不完整"):
+        decode_batch(body[:-8], "application/x-ndjson", "gzip")
+    with pytest.raises(WireFormatError):
+        decode_batch(b"not gzip", "application/x-ndjson", "gzip")
+
+
+def test_oversized_body_is_rejected(monkeypatch):
+    monkeypatch.setattr(behavior_wire, "MAX_BATCH_BYTES", 64)
+    # 压缩后很小、解压后超过上限
+    bomb = gzip.compress(b" " * 10000)
+    assert len(bomb) < 64
+
+    with pytest.raises(WireFormatError, match="过大"):
+        decode_batch(bomb, "application/json", "gzip")
+    with pytest.raises(WireFormatError, match="过大"):
+        decode_batch(b" " * 65, "application/json")
+
+
+def test_unsupported_encodings():
+    with pytest.raises(UnsupportedEncodingError):
+        decode_batch(_ndjson(), "text/csv")
+    with pytest.raises(UnsupportedEncodingError):
+        decode_batch(_ndjson(), "application/x-ndjson", "br")
+
+
+def test_malformed_bodies():
+    with pytest.raises(WireFormatError):
+        decode_batch(b"[]", "application/json")
+    with pytest.raises(WireFormatError):
+        decode_batch(b"", "application/x-ndjson")
+    with pytest.raises(WireFormatError):
+        decode_batch(msgpack.packb([1, 2]), "application/msgpack")
+    with pytest.raises(WireFormatError):
+        decode_batch(msgpack.packb({"h": HEADER, "e": "x"}), "application/msgpack")
+
+
+def test_non_mapping_event_counts_as_invalid():
+    batch = decode_batch(msgpack.packb({"h": HEADER, "e": [1]}), "application/msgpack")
+    assert batch["behaviors"] == [{}]
@@ -0,0 +1,46 @@
+from services.persona_cache import PersonaCache
+
+
+class _PublishDuringRead:
+    """在 GET 流水线执行期间模拟管理后台保存新配置并发布变更通知"""
+
+    def __init__(self, cache, pipe, redis_client):
+        self.cache = cache
+        self.pipe = pipe
+        self.redis_client = redis_client
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    async def execute(self):
+        result = await self.pipe.execute()
+        self.redis_client.set("pet:config:name", "新名字")
+        self.cache.invalidate()
+        return result
+
+
+def test_persona_is_cached_until_invalidated(redis_client, async_redis_client, run):
+    redis_client.set("pet:config:name", "咪咪")
+    cache = PersonaCache(async_redis_client)
+
+    assert run(cache.get_persona())["name"] == "咪咪"
+    redis_client.set("pet:config:name", "新名字")
+    assert run(cache.get_persona())["name"] == "咪咪"
+
+    cache.invalidate()
+    assert run(cache.get_persona())["name"] == "新名字"
+
+
+def test_invalidation_during_refresh_is_not_lost(redis_client, async_redis_client, run, monkeypatch):
+    redis_client.set("pet:config:name", "咪咪")
+    cache = PersonaCache(async_redis_client)
+    pipeline = async_redis_client.pipeline
+    monkeypatch.setattr(
+        async_redis_client, "pipeline",
+        lambda *args, **kwargs: _PublishDuringRead(cache, pipeline(*args, **kwargs), redis_client)
+    )
+
+    assert run(cache.get_persona())["name"] == "咪咪"
+
+    monkeypatch.setattr(async_redis_client, "pipeline", pipeline)
+    assert run(cache.get_persona())["name"] == "新名字"
@@ -0,0 +1,72 @@
+import time
+
+from services.user_profile_service import PROFILE_DIRTY_KEY, UserProfileService
+
+
+def _service(redis_client, timeout=300):
+    service = UserProfileService(redis_client)
+    service.dirty_visibility_timeout = timeout
+    return service
+
+
+def _mark(redis_client, *user_ids):
+    pipe = redis_client.pipeline()
+    for user_id in user_ids:
+        UserProfileService.mark_profile_dirty(pipe, user_id)
+    pipe.execute()
+
+
+def test_claim_keeps_users_until_ack(redis_client):
+    service = _service(redis_client)
+    _mark(redis_client, "u1", "u2", "u3")
+
+    users, deadline = service.claim_dirty_users(2)
+    assert users == ["u1", "u2"]
+    # 领取后仍在索引中，分数为可见性超时时间，不会被再次领取
+    assert redis_client.zscore(PROFILE_DIRTY_KEY, "u1") == deadline
+    assert service.claim_dirty_users(10)[0] == ["u3"]
+
+    assert service.ack_dirty_users(users, deadline) == 2
+    assert redis_client.zrange(PROFILE_DIRTY_KEY, 0, -1) == [b"u3"]
+
+
+def test_unacked_users_are_claimed_again_after_visibility_timeout(redis_client):
+    service = _service(redis_client, timeout=0.05)
+    _mark(redis_client, "u1")
+
+    users, _ = service.claim_dirty_users(10)
+    assert users == ["u1"]
+    assert service.claim_dirty_users(10)[0] == []
+
+    # 工作进程在确认前退出
+    time.sleep(0.1)
+    assert service.claim_dirty_users(10)[0] == ["u1"]
+
+
+def test_ack_keeps_users_marked_or_deferred_while_processing(redis_client):
+    service = _service(redis_client)
+    _mark(redis_client, "u1", "u2", "u3")
+    users, deadline = service.claim_dirty_users(10)
+
+    _mark(redis_client, "u1")
+    service.defer_profile_update("u2", time.time() + 60)
+
+    assert service.ack_dirty_users(users, deadline) == 1
+    assert sorted(redis_client.zrange(PROFILE_DIRTY_KEY, 0, -1)) == [b"u1", b"u2"]
+
+
+def test_profile_write_with_stale_fencing_token_is_rejected(redis_client):
+    service = _service(redis_client)
+    payload = {
+        "user_id": "u1", "dictionary_version": "v1", "new_messages": [], "rebuild": 0,
+        "checkpoint": "", "seq": 0
+    }
+
+    def result(value):
+        return {"message_count": 0, "dictionary_version": "v1", "new_counts": {},
+                "fields": {"chat_style": value}, "interests": None}
+
+    assert service._write_inference_results([(payload, result("new"))], {"u1": 7}) == set()
+    assert service._write_inference_results([(payload, result("old"))], {"u1": 5}) == {"u1"}
+    assert redis_client.hget("user:u1:profile", "chat_style") == b"new"
+    assert redis_client.get("user:u1:profile_fencing_token") == b"7"
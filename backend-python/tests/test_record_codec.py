@@ -0,0 +1,70 @@
+import importlib.util
+import json
+import os
+
+import msgpack
+import pytest
+
+from services import record_codec
+
+ADMIN_CODEC_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "..", "desktop-pet-admin", "backend", "services", "record_codec.py"
+)
+
+MESSAGE = {"role": "user", "content": "今天天气真好 🌞", "timestamp": "2024-03-01T21:15:30.250"}
+BEHAVIOR = {"type": "pet_click", "timestamp": "2024-03-01T21:15:30", "metadata": {"x": 1, "source": "tray"}}
+
+
+def _load_admin_codec():
+    spec = importlib.util.spec_from_file_location("admin_record_codec", ADMIN_CODEC_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_msgpack_round_trip_uses_short_keys():
+    raw = record_codec.encode(MESSAGE)
+    assert set(msgpack.unpackb(raw)) == {"r", "c", "ts"}
+    assert len(raw) < len(json.dumps(MESSAGE).encode())
+
+    assert record_codec.decode(raw) == MESSAGE
+    # 整秒时间戳解码后带毫秒，仍可被 fromisoformat 解析为同一时间
+    assert record_codec.decode(record_codec.encode(BEHAVIOR)) == {**BEHAVIOR, "timestamp": "2024-03-01T21:15:30.000"}
+
+
+def test_old_json_records_are_still_readable():
+    old_items = [json.dumps(MESSAGE), json.dumps(BEHAVIOR).encode(), json.dumps(MESSAGE, ensure_ascii=False).encode()]
+    mixed = old_items + [record_codec.encode(MESSAGE)]
+
+    assert record_codec.decode_many(mixed) == [MESSAGE, BEHAVIOR, MESSAGE, MESSAGE]
+
+
+def test_records_that_cannot_be_compacted_stay_json():
+    unknown_key = {**MESSAGE, "emotion": "happy"}
+    aware = {**MESSAGE, "timestamp": "2024-03-01T21:15:30+08:00"}
+
+    assert record_codec.encode(unknown_key) == json.dumps(unknown_key).encode()
+    assert record_codec.decode(record_codec.encode(aware)) == aware
+
+
+def test_json_codec_for_rollback(monkeypatch):
+    monkeypatch.setattr(record_codec, "RECORD_CODEC", "json")
+    assert record_codec.encode(MESSAGE) == json.dumps(MESSAGE).encode()
+
+
+def test_malformed_record_raises():
+    with pytest.raises(ValueError):
+        record_codec.decode(msgpack.packb([1, 2]))
+
+
+def test_admin_codec_matches_backend():
+    admin_codec = _load_admin_codec()
+
+    # 管理后台只读不写：它的长键表必须是主后端短键表的逆映射
+    assert admin_codec._LONG_KEYS == record_codec._LONG_KEYS
+    assert admin_codec._LONG_KEYS == {short: key for key, short in record_codec._SHORT_KEYS.items()}
+
+    items = [record_codec.encode(MESSAGE), record_codec.encode(BEHAVIOR), json.dumps(MESSAGE).encode()]
+    assert admin_codec.decode_many(items) == record_codec.decode_many(items)
+    with pytest.raises(ValueError):
+        admin_codec.decode(msgpack.packb([1, 2]))
@@ -0,0 +1,31 @@
+from services.session_manager import SUMMARY_EVERY, SessionManager
+
+
+def test_append_reports_when_summary_threshold_is_crossed(redis_client, async_redis_client, run):
+    manager = SessionManager(redis_client, async_redis_client)
+    message = {"role": "user", "content": "你好", "timestamp": "2024-01-01T10:00:00"}
+
+    first = manager.append_messages("s1", [message] * (SUMMARY_EVERY - 1), user_id="u1")
+    assert first == {"message_count": SUMMARY_EVERY - 1, "summary_due": False}
+
+    # 一次追加两条，跨过阈值（而不是恰好落在阈值上）也应触发
+    second = run(manager.append_messages_async("s1", [message, message], user_id="u1"))
+    assert second == {"message_count": SUMMARY_EVERY + 1, "summary_due": True}
+
+    context = manager.get_full_session_context("s1")
+    assert [(m["role"], m["content"]) for m in context] == [("user", "你好")] * (SUMMARY_EVERY + 1)
+    assert redis_client.ttl("session:s1:context") > 0
+
+
+def test_summary_from_stale_lease_holder_is_rejected(redis_client):
+    manager = SessionManager(redis_client)
+    manager.append_messages("s1", [{"role": "user", "content": "你好", "timestamp": "2024-01-01T10:00:00"}])
+
+    assert manager.save_session_summary("s1", {"summary": "新的总结"}, fencing_token=8) is True
+    # 租约过期后旧持有者（令牌更小）才写回结果
+    assert manager.save_session_summary("s1", {"summary": "旧的总结"}, fencing_token=7) is False
+
+    summary = manager.get_session_summary("s1")
+    assert summary["summary"] == "新的总结"
+    assert summary["fencing_token"] == 8
+    assert summary["message_count_at_summary"] == 1
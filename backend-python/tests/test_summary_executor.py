@@ -0,0 +1,95 @@
+import asyncio
+
+from services.summary_executor import SummaryExecutor
+from services.summary_queue import ATTEMPTS_KEY, PENDING_KEY, SummaryQueue
+from services.task_lease import LeaseHeldError
+
+
+def _queue(redis_client, *session_ids):
+    queue = SummaryQueue(redis_client)
+    queue.retry_delay = 60
+    for session_id in session_ids:
+        queue.mark(session_id)
+    return queue
+
+
+def _executor(queue, handler, concurrency=2):
+    executor = SummaryExecutor(queue, handler)
+    executor.concurrency = concurrency
+    return executor
+
+
+def test_drain_respects_the_concurrency_limit(redis_client, run):
+    queue = _queue(redis_client, *[f"s{i}" for i in range(5)])
+    running, peak, done = set(), [0], []
+
+    async def handler(task):
+        running.add(task["session_id"])
+        peak[0] = max(peak[0], len(running))
+        await asyncio.sleep(0.01)
+        running.discard(task["session_id"])
+        done.append(task["session_id"])
+
+    executor = _executor(queue, handler)
+    run(executor.drain())
+
+    assert sorted(done) == [f"s{i}" for i in range(5)]
+    assert peak[0] == 2
+    assert executor.stats()["completed"] == 5
+    assert queue.stats() == {"pending": 0, "due": 0, "processing": 0, "dead_letter": 0}
+
+
+def test_timed_out_task_is_requeued_with_backoff(redis_client, run):
+    queue = _queue(redis_client, "s1")
+
+    async def handler(task):
+        await asyncio.sleep(1)
+
+    executor = _executor(queue, handler)
+    executor.task_timeout = 0.01
+    run(executor.drain())
+
+    assert executor.stats_counters["timeouts"] == 1
+    assert queue.stats()["due"] == 0 and queue.stats()["pending"] == 1
+    assert redis_client.hget(ATTEMPTS_KEY, "s1") == b"1"
+
+
+def test_task_held_by_another_worker_is_released(redis_client, run):
+    queue = _queue(redis_client, "s1")
+
+    async def handler(task):
+        raise LeaseHeldError("summary:s1", retry_after=30)
+
+    executor = _executor(queue, handler)
+    run(executor.drain())
+
+    assert executor.stats_counters["failed"] == 0
+    # 归还不计入尝试次数
+    assert redis_client.hget(ATTEMPTS_KEY, "s1") is None
+    assert redis_client.zscore(PENDING_KEY, "s1") is not None
+
+
+def test_rate_limit_pauses_claiming(redis_client, run):
+    queue = _queue(redis_client, "s1", "s2")
+    calls = []
+
+    async def handler(task):
+        calls.append(task["session_id"])
+        raise RuntimeError("429 rate limit exceeded")
+
+    executor = _executor(queue, handler, concurrency=1)
+    executor.rate_limit_backoff = executor._current_backoff = 60
+
+    async def drain_briefly():
+        try:
+            await asyncio.wait_for(executor.drain(), timeout=0.2)
+        except asyncio.TimeoutError:
+            pass
+
+    # 暂停期间不领取新任务
+    run(drain_briefly())
+
+    assert calls == ["s1"]
+    assert executor.stats()["paused"] is True
+    assert executor.stats_counters["rate_limited"] == 1
+    assert executor._current_backoff == 120
@@ -0,0 +1,166 @@
+import json
+import time
+
+from services import task_signals
+from services.summary_queue import (
+    ATTEMPTS_KEY, DEAD_LETTER_KEY, LEGACY_QUEUE_KEY, PENDING_KEY, PROCESSING_KEY, SummaryQueue
+)
+
+
+def _queue(redis_client, async_redis_client=None, visibility_timeout=300, max_attempts=3, retry_delay=30):
+    queue = SummaryQueue(redis_client, async_redis_client)
+    queue.visibility_timeout = visibility_timeout
+    queue.max_attempts = max_attempts
+    queue.retry_delay = retry_delay
+    return queue
+
+
+def _ids(tasks):
+    return [task["session_id"] for task in tasks]
+
+
+def test_mark_is_deduplicated_and_wakes_the_worker(redis_client):
+    queue = _queue(redis_client)
+
+    assert queue.mark("s1") is True
+    assert queue.mark("s1") is False
+    assert redis_client.zcard(PENDING_KEY) == 1
+    assert redis_client.lrange(task_signals.SIGNAL_KEY, 0, -1) == [task_signals.SUMMARY.encode()]
+
+
+def test_mark_async_shares_the_queue(redis_client, async_redis_client, run):
+    queue = _queue(redis_client, async_redis_client)
+
+    assert run(queue.mark_async("s1")) is True
+    assert queue.mark("s1") is False
+    assert _ids(queue.claim()) == ["s1"]
+
+
+def test_claim_and_ack(redis_client):
+    queue = _queue(redis_client)
+    queue.mark("s1")
+    queue.mark("s2", delay=60)
+
+    claimed = queue.claim()
+    assert claimed == [{"session_id": "s1", "attempts": 1}]
+    # 处理中不会被再次领取
+    assert queue.claim() == []
+
+    queue.ack("s1")
+    assert redis_client.zscore(PROCESSING_KEY, "s1") is None
+    assert redis_client.hget(ATTEMPTS_KEY, "s1") is None
+    assert queue.stats() == {"pending": 1, "due": 0, "processing": 0, "dead_letter": 0}
+
+
+def test_marked_while_processing_is_claimable_after_ack(redis_client):
+    queue = _queue(redis_client)
+    queue.mark("s1")
+    queue.claim()
+
+    # 处理期间再次标记：排在可见性超时之后，不会被并发领取
+    assert queue.mark("s1") is True
+    assert queue.claim() == []
+
+    queue.ack("s1")
+    assert _ids(queue.claim()) == ["s1"]
+
+
+def test_unacked_task_is_claimed_again_after_visibility_timeout(redis_client):
+    queue = _queue(redis_client, visibility_timeout=0.05)
+    queue.mark("s1")
+    assert queue.claim() == [{"session_id": "s1", "attempts": 1}]
+
+    # 工作进程在确认前退出
+    time.sleep(0.1)
+    assert queue.claim() == [{"session_id": "s1", "attempts": 2}]
+
+
+def test_visibility_timeout_after_max_attempts_moves_to_dead_letter(redis_client):
+    queue = _queue(redis_client, visibility_timeout=0.05, max_attempts=1)
+    queue.mark("s1")
+    queue.claim()
+
+    time.sleep(0.1)
+    assert queue.claim() == []
+    dead = queue.get_dead_letters()
+    assert len(dead) == 1
+    assert dead[0]["session_id"] == "s1" and dead[0]["error"] == "visibility timeout"
+    assert queue.stats()["pending"] == 0
+
+
+def test_fail_backs_off_then_dead_letters(redis_client):
+    queue = _queue(redis_client, max_attempts=2, retry_delay=0)
+    queue.mark("s1")
+
+    queue.claim()
+    assert queue.fail("s1", "timeout") is True
+    assert queue.claim() == [{"session_id": "s1", "attempts": 2}]
+    assert queue.fail("s1", "timeout") is False
+
+    assert queue.stats() == {"pending": 0, "due": 0, "processing": 0, "dead_letter": 1}
+    dead = queue.get_dead_letters()[0]
+    assert (dead["session_id"], dead["attempts"], dead["error"]) == ("s1", 2, "timeout")
+
+
+def test_fail_of_unclaimed_task_is_ignored(redis_client):
+    queue = _queue(redis_client)
+    queue.mark("s1")
+
+    assert queue.fail("s1", "late") is True
+    assert redis_client.llen(DEAD_LETTER_KEY) == 0
+    assert _ids(queue.claim()) == ["s1"]
+
+
+def test_release_does_not_count_an_attempt(redis_client):
+    queue = _queue(redis_client)
+    queue.mark("s1")
+    queue.claim()
+
+    queue.release("s1", delay=0)
+    assert redis_client.hget(ATTEMPTS_KEY, "s1") is None
+    assert queue.claim() == [{"session_id": "s1", "attempts": 1}]
+
+
+def test_next_due_in(redis_client):
+    queue = _queue(redis_client)
+    assert queue.next_due_in() is None
+
+    queue.mark("s1", delay=60)
+    assert 59 < queue.next_due_in() <= 60
+
+
+def test_migrate_legacy_queue(redis_client):
+    queue = _queue(redis_client)
+    for queued_at in ("2024-01-01T10:00:00", "2024-01-01T09:00:00"):
+        redis_client.sadd(LEGACY_QUEUE_KEY, json.dumps({"session_id": "s1", "queued_at": queued_at}))
+    redis_client.sadd(LEGACY_QUEUE_KEY, "not json")
+
+    assert queue.migrate_legacy_queue() == 1
+    assert not redis_client.exists(LEGACY_QUEUE_KEY)
+    assert _ids(queue.claim()) == ["s1"]
+
+
+def test_fail_backoff_uses_the_attempt_count_seen_by_the_script(redis_client):
+    queue = _queue(redis_client, visibility_timeout=0.05, max_attempts=5, retry_delay=10)
+    queue.mark("s1")
+    queue.claim()
+    # 可见性超时后被另一个工作进程再次领取（第 2 次）
+    time.sleep(0.1)
+    assert queue.claim() == [{"session_id": "s1", "attempts": 2}]
+
+    before = time.time()
+    assert queue.fail("s1", "timeout") is True
+    retry_at = redis_client.zscore(PENDING_KEY, "s1")
+    assert before + 20 <= retry_at <= time.time() + 20
+
+
+def test_dead_letter_payload_is_valid_json(redis_client):
+    queue = _queue(redis_client, max_attempts=1)
+    queue.mark('s"1')
+    queue.claim()
+
+    error = 'AI API 错误: {"message": "bad\\nrequest"}'
+    assert queue.fail('s"1', error) is False
+    dead = queue.get_dead_letters()[0]
+    assert (dead["session_id"], dead["attempts"], dead["error"]) == ('s"1', 1, error)
+    assert "failed_at" in dead
@@ -0,0 +1,24 @@
+from services.task_lease import TaskLease
+
+
+def test_acquire_is_exclusive_and_tokens_increase(redis_client):
+    lease = TaskLease(redis_client, ttl=60)
+    first = lease.acquire("summary:s1")
+    assert first is not None
+    assert lease.acquire("summary:s1") is None
+    assert lease.remaining("summary:s1") > 0
+
+    assert lease.release("summary:s1", first)
+    second = lease.acquire("summary:s1")
+    assert second > first
+
+
+def test_release_with_stale_token_keeps_new_holder(redis_client):
+    lease = TaskLease(redis_client, ttl=60)
+    stale = lease.acquire("profile:u1")
+    # 租约过期后被其他进程获取
+    redis_client.delete("lease:profile:u1")
+    current = lease.acquire("profile:u1")
+
+    assert not lease.release("profile:u1", stale)
+    assert redis_client.get("lease:profile:u1") == str(current).encode()
@@ -0,0 +1,57 @@
+from services import record_codec
+from services.turn_commit_queue import TurnCommitQueue
+from services.user_profile_service import UserProfileService
+
+
+def _queue(redis_client, async_redis_client):
+    profile_service = UserProfileService(redis_client, async_redis=async_redis_client)
+    return TurnCommitQueue(async_redis_client, profile_service)
+
+
+def _turn(user_id="u1"):
+    return {"user_id": user_id, "session_id": "s1", "profile": {}}
+
+
+def test_commit_writes_history_behavior_and_counters(redis_client, async_redis_client, run):
+    queue = _queue(redis_client, async_redis_client)
+    run(queue.enqueue(_turn(), "你好", "你好呀", "2025-10-12T14:00:00"))
+
+    history = record_codec.decode_many(redis_client.lrange("user:u1:chat_history", 0, -1))
+    assert [m["content"] for m in history] == ["你好", "你好呀"]
+    assert redis_client.get("user:u1:chat_history_seq") == b"2"
+    assert len(redis_client.lrange("user:u1:behaviors", 0, -1)) == 1
+    profile = redis_client.hgetall("user:u1:profile")
+    assert profile[b"total_interactions"] == b"1"
+    assert profile[b"intimacy_score"] == b"1"
+    assert profile[b"relationship_level"] == "陌生人".encode()
+    assert redis_client.hget("user:u1:behavior_rollup", "type:chat") == b"1"
+    assert redis_client.zscore("user:profile_dirty", "u1") is not None
+
+
+def test_retried_batch_is_not_applied_twice(redis_client, async_redis_client, run):
+    queue = _queue(redis_client, async_redis_client)
+    batch = [
+        {"turn_id": f"t{i}", "user_id": "u1", "user_message": "hi", "reply": "hello",
+         "timestamp": "2025-10-12T14:00:00"}
+        for i in range(3)
+    ]
+    run(queue._commit_batch(batch))
+    # 提交已成功但应答丢失时，重试整批
+    run(queue._commit_batch(batch))
+
+    assert redis_client.llen("user:u1:chat_history") == 6
+    assert redis_client.get("user:u1:chat_history_seq") == b"6"
+    assert redis_client.hget("user:u1:profile", "intimacy_score") == b"3"
+    assert redis_client.hget("user:u1:behavior_rollup", "total") == b"3"
+    assert queue.stats["duplicates"] == 3
+
+
+def test_relationship_level_follows_intimacy_in_same_script(redis_client, async_redis_client, run):
+    queue = _queue(redis_client, async_redis_client)
+    redis_client.hset("user:u1:profile", mapping={"intimacy_score": 9, "relationship_level": "陌生人"})
+    run(queue.enqueue(_turn(), "hi", "hello", "2025-10-12T14:00:00"))
+    assert redis_client.hget("user:u1:profile", "relationship_level") == "初识".encode()
+
+    redis_client.hset("user:u1:profile", "intimacy_score", 250)
+    run(queue.enqueue(_turn(), "hi", "hello", "2025-10-12T14:00:01"))
+    assert redis_client.hget("user:u1:profile", "relationship_level") == "挚友".encode()
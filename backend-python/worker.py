@@ -0,0 +1,53 @@
+"""
+桌面宠物后台工作进程
+独立于 Web 进程运行会话总结和用户画像更新，可启动多个实例水平扩展：
+任务通过 Redis 队列和租约在实例之间分配，同一任务同一时间只有一个实例处理
+
+用法：
+    python worker.py
+Web 进程设置 BACKGROUND_TASKS_ENABLED=false 后只处理请求
+"""
+
+import signal
+from dotenv import load_dotenv
+
+# 先加载环境变量，后台任务模块在导入时读取配置
+load_dotenv()
+
+from services.redis_manager import RedisManager
+from services.user_profile_service import UserProfileService
+from services.session_manager import SessionManager
+from services.background_tasks import BackgroundTaskManager
+from services.llm_profile_analyzer import llm_analyzer
+
+
+def main():
+    redis_client = RedisManager.get_client()
+    
+    try:
+        from services.llm_enhanced_analyzer import LLMEnhancedAnalyzer
+        profile_service = UserProfileService(redis_client, LLMEnhancedAnalyzer(llm_analyzer.ai_provider))
+    except Exception as e:
+        print(f"⚠️  LLM分析器加载失败，使用基础画像: {str(e)}")
+        profile_service = UserProfileService(redis_client)
+    
+    session_manager = SessionManager(redis_client)
+    task_manager = BackgroundTaskManager(session_manager, profile_service)
+    
+    def handle_signal(signum, frame):
+        print(f"🛑 收到信号 {signum}，正在停止工作进程...")
+        task_manager.request_stop()
+    
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+    
+    print("🐱 桌面宠物后台工作进程已启动")
+    try:
+        task_manager.run()
+    finally:
+        RedisManager.close()
+        print("✅ 后台工作进程已退出")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,9 @@ from services.redis_service import RedisService
 
 router = APIRouter(prefix="/api/pet", tags=["宠物配置"])
 
+# 配置变更通知频道（聊天后端订阅该频道以刷新宠物人设缓存）
+PET_CONFIG_CHANNEL = "pet:config:updates"
+
 
 class PetConfigUpdate(BaseModel):
     """宠物配置更新请求"""
@@ -96,9 +99,11 @@ async def update_pet_config(
             client.set("pet:config:voice_enabled", "true" if updates.voice_enabled else "false")
             updated_fields.append("voice_enabled")
         
-        # 记录更新时间
+        # 记录更新时间并通知聊天后端
         if updated_fields:
-            client.set("pet:config:last_updated", datetime.now().isoformat())
+            last_updated = datetime.now().isoformat()
+            client.set("pet:config:last_updated", last_updated)
+            client.publish(PET_CONFIG_CHANNEL, last_updated)
         
         return {
             "success": True,
@@ -134,6 +139,9 @@ async def reset_pet_config(token: str = Query(..., description="管理员令牌"
         for key, value in default_config.items():
             client.set(key, value)
         
+        # 通知聊天后端刷新宠物人设缓存
+        client.publish(PET_CONFIG_CHANNEL, default_config["pet:config:last_updated"])
+        
         return {
             "success": True,
             "message": "宠物配置已重置为默认值"
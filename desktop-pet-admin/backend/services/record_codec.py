@@ -0,0 +1,34 @@
+"""
+列表记录解码
+与主后端 services/record_codec.py 的存储格式一致（backend-python/tests/test_record_codec.py 校验两边的短键表和解码结果）：聊天历史、会话上下文、行为记录的条目
+可能是旧的 JSON 字符串，也可能是短键 msgpack（时间戳为 epoch 毫秒），按首字节识别
+"""
+
+import json
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List
+
+import msgpack
+
+_LONG_KEYS = {"r": "role", "c": "content", "ts": "timestamp", "t": "type", "m": "metadata"}
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def decode(raw) -> Dict:
+    """解码一条记录（JSON 或 msgpack）"""
+    if isinstance(raw, str) or raw[:1] == b"{":
+        return json.loads(raw)
+
+    packed = msgpack.unpackb(raw, raw=False, strict_map_key=False)
+    if not isinstance(packed, dict):
+        raise ValueError("记录必须是映射")
+    record = {_LONG_KEYS.get(key, key): value for key, value in packed.items()}
+    timestamp = record.get("timestamp")
+    if isinstance(timestamp, int) and not isinstance(timestamp, bool):
+        record["timestamp"] = (_EPOCH + timedelta(milliseconds=timestamp)).isoformat(timespec="milliseconds")
+    return record
+
+
+def decode_many(raw_items: Iterable) -> List[Dict]:
+    return [decode(raw) for raw in raw_items]
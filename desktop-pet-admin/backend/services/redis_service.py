@@ -8,12 +8,14 @@ import json
 from typing import Dict, List, Optional, Any
 from datetime import datetime
 from config import config
+from services import record_codec
 
 
 class RedisService:
     """Redis 服务类"""
     
     _instance: Optional[redis.Redis] = None
+    _binary_instance: Optional[redis.Redis] = None
     
     @classmethod
     def get_client(cls) -> redis.Redis:
@@ -35,9 +37,25 @@ class RedisService:
                 raise
         return cls._instance
     
+    @classmethod
+    def get_binary_client(cls) -> redis.Redis:
+        """获取不解码响应的 Redis 客户端（读取 msgpack 编码的列表条目）"""
+        if cls._binary_instance is None:
+            cls._binary_instance = redis.Redis(
+                host=config.REDIS_HOST,
+                port=config.REDIS_PORT,
+                password=config.REDIS_PASSWORD,
+                db=config.REDIS_DB,
+                decode_responses=False
+            )
+        return cls._binary_instance
+    
     @classmethod
     def close(cls):
         """关闭 Redis 连接"""
+        if cls._binary_instance:
+            cls._binary_instance.close()
+            cls._binary_instance = None
         if cls._instance:
             cls._instance.close()
             cls._instance = None
@@ -108,8 +126,13 @@ class RedisService:
         
         keys_to_delete = [
             f"user:{user_id}:profile",
+            f"user:{user_id}:profile_fencing_token",
             f"user:{user_id}:chat_history",
+            f"user:{user_id}:chat_history_seq",
+            f"user:{user_id}:keyword_counts",
             f"user:{user_id}:behaviors",
+            f"user:{user_id}:behavior_rollup",
+            f"user:{user_id}:behavior_span",
             f"user:{user_id}:active_session",
             f"user:{user_id}:last_profile_update",
             f"user:{user_id}:mapping"
@@ -120,16 +143,19 @@ class RedisService:
             if client.delete(key):
                 deleted_count += 1
         
+        # 从待刷新画像索引中移除
+        client.zrem("user:profile_dirty", user_id)
+        
         return deleted_count
     
     @staticmethod
     def get_user_chat_history(user_id: str, limit: int = 50) -> List[Dict]:
         """获取用户聊天历史"""
-        client = RedisService.get_client()
+        client = RedisService.get_binary_client()
         history_key = f"user:{user_id}:chat_history"
         
         messages = client.lrange(history_key, -limit, -1)
-        return [json.loads(msg) for msg in messages]
+        return record_codec.decode_many(messages)
     
     @staticmethod
     def get_complete_user_profile(user_id: str) -> Optional[Dict]:
@@ -276,11 +302,11 @@ class RedisService:
     @staticmethod
     def get_session_context(session_id: str) -> List[Dict]:
         """获取会话对话内容"""
-        client = RedisService.get_client()
+        client = RedisService.get_binary_client()
         context_key = f"session:{session_id}:context"
         
         messages = client.lrange(context_key, 0, -1)
-        return [json.loads(msg) for msg in messages]
+        return record_codec.decode_many(messages)
     
     @staticmethod
     def get_session_summary(session_id: str) -> Optional[Dict]:
@@ -329,8 +355,8 @@ class RedisService:
         # 计算总消息数
         total_messages = sum(client.llen(key) for key in session_contexts)
         
-        # 待总结队列
-        pending_summaries = client.scard("session:summary_queue")
+        # 待总结队列（等待中 + 处理中）
+        pending_summaries = client.zcard("summary_queue:pending") + client.zcard("summary_queue:processing")
         
         # 内存信息
         memory_info = client.info('memory')
@@ -10,6 +10,15 @@ class BehaviorTracker {
         this.maxQueueSize = 5;
         this.flushInterval = 10000; // 10秒自动发送一次
         
+        // 去重：每条行为带递增序号，发送失败的批次用同一批次ID重发，服务端据此跳过已接收的行为
+        this.nextSeq = 0;
+        this.nextBatch = 0;
+        this.pendingBatch = null; // 已发出但未确认的批次
+        this.flushing = false;
+        
+        // 紧凑编码：gzip 压缩的 NDJSON（批次头携带公共字段，时间戳差值编码）；服务端不支持时回退到 JSON
+        this.compactWire = typeof CompressionStream !== 'undefined';
+        
         // 统计数据
         this.stats = {
             clickCount: 0,
@@ -221,6 +230,7 @@ class BehaviorTracker {
         const behavior = {
             user_id: 'default', // 后续可从存储中获取真实用户ID
             behavior_type: type,
+            seq: this.nextSeq++,
             metadata: {
                 ...metadata,
                 session_id: this.sessionId,
@@ -241,42 +251,105 @@ class BehaviorTracker {
      * 批量发送行为数据
      */
     async flushBehaviors() {
-        if (this.behaviorQueue.length === 0) return;
+        // 同一时间只发送一个批次，避免重发和新批次并发
+        if (this.flushing) return;
         
-        const behaviors = [...this.behaviorQueue];
-        this.behaviorQueue = [];
+        // 上一批次未确认时原样重发（同一批次ID），否则取出队列组成新批次
+        if (!this.pendingBatch) {
+            if (this.behaviorQueue.length === 0) return;
+            this.pendingBatch = {
+                batch_id: `${this.sessionId}_${this.nextBatch++}`,
+                behaviors: [...this.behaviorQueue]
+            };
+            this.behaviorQueue = [];
+        }
+        
+        const batch = this.pendingBatch;
+        this.flushing = true;
         
         try {
+            const compact = this.compactWire;
             const response = await fetch(`${this.API_BASE}/api/behaviors/batch`, {
                 method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({
-                    behaviors: behaviors
+                ...(compact ? await this.encodeCompactBatch(batch) : {
+                    headers: {
+                        'Content-Type': 'application/json'
+                    },
+                    body: JSON.stringify({
+                        client_id: this.sessionId,
+                        batch_id: batch.batch_id,
+                        behaviors: batch.behaviors
+                    })
                 })
             });
             
-            if (response.ok) {
-                console.log(`✅ 已发送${behaviors.length}条行为数据`);
+            if (compact && response.status === 415) {
+                // 服务端不支持紧凑编码，保留批次，之后改用 JSON
+                this.compactWire = false;
+                console.warn('⚠️ 服务端不支持紧凑编码，改用 JSON 发送');
+            } else if (response.ok) {
+                const result = await response.json();
+                this.pendingBatch = null;
+                console.log(`✅ 已发送${batch.behaviors.length}条行为数据` +
+                    (result.duplicate || result.duplicates ? '（服务端已跳过重复数据）' : ''));
+            } else if (response.status >= 400 && response.status < 500 &&
+                       response.status !== 408 && response.status !== 409 && response.status !== 429) {
+                // 请求本身无效，重发也不会成功，丢弃该批次
+                this.pendingBatch = null;
+                console.warn(`⚠️ 行为数据被拒绝，已丢弃: ${response.status}`);
             } else {
+                // 发送失败（或同一批次的上一次请求仍在处理），保留批次，下次用同一批次ID重发
                 console.warn(`⚠️ 行为数据发送失败: ${response.status}`);
-                // 发送失败，放回队列
-                this.behaviorQueue.unshift(...behaviors);
             }
         } catch (error) {
+            // 发送失败（可能服务端已写入但响应丢失），保留批次，下次用同一批次ID重发
             console.error('❌ 行为数据发送错误:', error);
-            // 发送失败，放回队列
-            this.behaviorQueue.unshift(...behaviors);
+        } finally {
+            this.flushing = false;
         }
     }
     
+    /**
+     * 把批次编码为 gzip 压缩的 NDJSON（格式见后端 services/behavior_wire.py）
+     */
+    async encodeCompactBatch(batch) {
+        const first = batch.behaviors[0];
+        const header = {
+            c: this.sessionId,
+            b: batch.batch_id,
+            u: first.user_id,
+            s: first.metadata.session_id,
+            ts: Date.parse(first.metadata.timestamp)
+        };
+        
+        let cursor = header.ts;
+        const lines = [JSON.stringify(header)];
+        for (const behavior of batch.behaviors) {
+            const { session_id, timestamp, ...metadata } = behavior.metadata;
+            const time = Date.parse(timestamp);
+            const event = { t: behavior.behavior_type, q: behavior.seq, d: time - cursor, m: metadata };
+            if (behavior.user_id !== header.u) event.u = behavior.user_id;
+            if (session_id !== header.s) event.s = session_id;
+            lines.push(JSON.stringify(event));
+            cursor = time;
+        }
+        
+        const stream = new Blob([lines.join('\n')]).stream().pipeThrough(new CompressionStream('gzip'));
+        return {
+            headers: {
+                'Content-Type': 'application/x-ndjson',
+                'Content-Encoding': 'gzip'
+            },
+            body: await new Response(stream).arrayBuffer()
+        };
+    }
+    
     /**
      * 启动自动发送定时器
      */
     startAutoFlush() {
         setInterval(() => {
-            if (this.behaviorQueue.length > 0) {
+            if (this.behaviorQueue.length > 0 || this.pendingBatch) {
                 this.flushBehaviors();
             }
         }, this.flushInterval);